@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import time
+import getopt
+import threading
+import bisect
+import array
+import collections
+
+from btle_data import RssiStats
+
+# columns of the per-packet angle file and the pattern table
+ANGLE_COLUMNS = ['epoch', 'addr', 'ch', 'rssi', 'angle']
+PATTERN_COLUMNS = ['addr', 'angle', 'ch', 'count', 'min', 'max', 'mean', 'median', 'mode', 'std', 'range']
+
+# Angle binned RSSI stats per channel (a radiation pattern table) for one
+# advertising address, or all addresses for '*'.  Each angle is rounded to
+# the nearest multiple of binSize degrees.
+class BtleAnglePattern:
+    def __init__(self, addr='*', binSize=5):
+        self.addr = addr
+        self.binSize = binSize
+        self.stats = dict()
+
+    def getBin(self, angle):
+        return round(angle / self.binSize) * self.binSize
+
+    def add(self, angle, ch, rssi):
+        key = (self.getBin(angle), ch)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = RssiStats()
+            self.stats[key] = stats
+        stats.add(rssi)
+
+    # return the table rows sorted by angle and channel
+    def getRows(self):
+        rows = list()
+        for angle, ch in sorted(self.stats):
+            stats = self.stats[(angle, ch)]
+            values = stats.getStats()
+            if values is None:
+                values = (0,0,0,0,0,0,0)
+            rows.append([self.addr, str(angle), ch, str(stats.count)] + [str(v) for v in values])
+        return rows
+
+# Timestamped track of the positioner angle.  A thread polls getPosition
+# (returns the angle in degrees, or None if there is no answer) every
+# interval seconds between start and stop, stamping each answer with the
+# middle of the request.  Packets are added with their time on the local
+# clock and wait until the track covers that time, then the angle is
+# interpolated from the samples either side and the packet goes into the
+# patterns, so the pattern is built up while the positioner is moving.
+class BtleAngleTrack:
+    def __init__(self, getPosition, interval=0.2, binSize=5, addrs=[]):
+        self.getPosition = getPosition
+        self.interval = interval
+        self.times = array.array('d')
+        self.angles = array.array('d')
+
+        self.lock = threading.Lock()
+        self.thread = None
+        self.runFlag = False
+        self.tStart = None
+        self.tEnd = None
+
+        # (t, epoch, addr, ch, rssi) waiting for the track to reach t, and the
+        # packets with their angle
+        self.pending = collections.deque()
+        self.packets = list()
+        self.outside = 0
+
+        self.patterns = {'*': BtleAnglePattern('*', binSize)}
+        for addr in addrs:
+            if addr not in ("", "*"):
+                self.patterns[addr.lower()] = BtleAnglePattern(addr.lower(), binSize)
+
+    # start polling at the local time t (default now)
+    def start(self, t=None):
+        self.tStart = time.time() if t is None else t
+        self.runFlag = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # stop polling, packets after the local time t (default now) are ignored
+    def stop(self, t=None):
+        self.tEnd = time.time() if t is None else t
+        self.runFlag = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while self.runFlag:
+            t0 = time.time()
+            angle = self.getPosition()
+            t1 = time.time()
+            if angle is not None:
+                with self.lock:
+                    self.times.append((t0 + t1) / 2)
+                    self.angles.append(float(angle))
+                    self.processPending()
+            time.sleep(max(0, self.interval - (time.time() - t0)))
+
+    # return the angle at the local time t, or None if t is outside the track
+    def getAngle(self, t):
+        if len(self.times) == 0 or t < self.times[0] or t > self.times[-1]:
+            return None
+
+        i = bisect.bisect_left(self.times, t)
+        if self.times[i] == t:
+            return self.angles[i]
+        t0 = self.times[i-1]
+        a0 = self.angles[i-1]
+        return a0 + (self.angles[i] - a0) * (t - t0) / (self.times[i] - t0)
+
+    # add a packet with its local time t and the sniffer time epoch, packets
+    # from outside start/stop are skipped
+    def add(self, t, epoch, addr, ch, rssi):
+        if self.tStart is None or t < self.tStart or (self.tEnd is not None and t > self.tEnd):
+            return
+        with self.lock:
+            self.pending.append((t, epoch, addr, ch, rssi))
+            self.processPending()
+
+    def processPending(self):
+        while self.pending and len(self.times) and self.pending[0][0] <= self.times[-1]:
+            self.addPacket(self.pending.popleft())
+
+    def addPacket(self, packet):
+        t, epoch, addr, ch, rssi = packet
+        angle = self.getAngle(t)
+        if angle is None:
+            self.outside = self.outside + 1
+            return
+
+        self.packets.append((epoch, addr, ch, rssi, angle))
+        self.patterns['*'].add(angle, ch, rssi)
+        pattern = self.patterns.get(addr.lower())
+        if pattern is not None:
+            pattern.add(angle, ch, rssi)
+
+    # Place the packets still waiting for the track, once it is stopped.
+    # Packets up to one interval past the last sample get the last angle.
+    def flush(self):
+        with self.lock:
+            while self.pending:
+                packet = self.pending.popleft()
+                if len(self.times) and self.times[-1] < packet[0] <= self.times[-1] + self.interval:
+                    packet = (self.times[-1],) + packet[1:]
+                self.addPacket(packet)
+
+    # Write the angle of every packet (angle_<fname>), the pattern tables
+    # (pattern_<fname>) and the positioner samples (track_<fname>) next to
+    # the data file fname.
+    def writeFiles(self, fname):
+        path, base = os.path.split(fname)
+        with open(os.path.join(path, 'angle_' + base), 'w') as outFile:
+            outFile.write(','.join(ANGLE_COLUMNS) + '\n')
+            for epoch, addr, ch, rssi, angle in self.packets:
+                outFile.write(repr(epoch) + ',' + addr + ',' + ch + ',' + str(rssi) + ',' + '{:.2f}'.format(angle) + '\n')
+
+        writePattern(os.path.join(path, 'pattern_' + base), self.patterns.values())
+
+        with open(os.path.join(path, 'track_' + base), 'w') as outFile:
+            outFile.write('time,angle\n')
+            for t, angle in zip(self.times, self.angles):
+                outFile.write(repr(t) + ',' + repr(angle) + '\n')
+
+# write the rows of the patterns as a CSV table
+def writePattern(fname, patterns):
+    with open(fname, 'w') as outFile:
+        outFile.write(','.join(PATTERN_COLUMNS) + '\n')
+        for pattern in patterns:
+            for row in pattern.getRows():
+                outFile.write(','.join(row) + '\n')
+
+# rebuild the pattern tables from an angle_*.csv file with another bin size
+def readAngleFile(fname, binSize=5, addrs=[]):
+    patterns = {'*': BtleAnglePattern('*', binSize)}
+    for addr in addrs:
+        patterns[addr.lower()] = BtleAnglePattern(addr.lower(), binSize)
+
+    with open(fname, 'r') as inFile:
+        inFile.readline()
+        for line in inFile:
+            epoch, addr, ch, rssi, angle = line.rstrip('\n').split(',')
+            patterns['*'].add(float(angle), ch, rssi)
+            if addr in patterns:
+                patterns[addr].add(float(angle), ch, rssi)
+
+    return patterns
+
+# print usage info
+def usage():
+    print("\nDescription: rebuild the angle binned RSSI pattern tables from angle_*.csv files written by scan segments.\n")
+    print("\nUsage:\n")
+    print(" ",__file__, " [-h] [-b bin_deg] [-f filter_addr] angle_file.csv ...\n")
+    print("     -h: help\n")
+    print("     -b bin_deg: angle bin size in degrees (default 5)")
+    print("     -f filter_addr: also write the pattern of the specified advertising address")
+    print("     Each pattern is written to pattern_<bin_deg>deg_<file> next to the angle file")
+    print("\n")
+
+# main function for command line entry point
+def main(argv):
+    binSize = 5
+    addrs = list()
+
+    # grab command line args
+    try:
+        opts, args = getopt.getopt(argv,"hb:f:",["bin=","filter="])
+    except getopt.GetoptError:
+        usage()
+        return 1
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            return 0
+        elif opt in ("-b", "--bin"):
+            binSize = float(arg) if '.' in arg else int(arg)
+        elif opt in ("-f", "--filter"):
+            addrs.append(arg.lower())
+
+    if not args:
+        usage()
+        return 1
+
+    for fname in args:
+        path, base = os.path.split(fname)
+        if base.startswith('angle_'):
+            base = base[len('angle_'):]
+        outName = os.path.join(path, 'pattern_' + str(binSize) + 'deg_' + base)
+        writePattern(outName, readAngleFile(fname, binSize, addrs).values())
+        print("Wrote " + outName)
+
+    return 0
+
+# callable from command line
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
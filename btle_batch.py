@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import time
+import getopt
+
+from concurrent.futures import ProcessPoolExecutor
+
+import btle_data
+
+# columns of the consolidated stats table
+BATCH_COLUMNS = ['device', 'range', 'txPower', 'angle', 'ch', 'count', 'min', 'max',
+                 'mean', 'median', 'mode', 'std', 'range_rssi', 'bad_rows', 'file']
+
+# Summarize a single data file written by generateDataFile.  The metadata
+# lines are read back with BtleMetaData and the RSSI of every Bluetooth row
+# is accumulated per channel, optionally only for one advertising address.
+# Rows with a missing or out of range RSSI or channel are skipped and 
+# counted.  Returns (fname, metaData, {ch: RssiStats}, numRows, badRows).
+def summarizeFile(fname, _filter=""):
+    metaData = btle_data.BtleMetaData(readDefaults=False)
+    chStats = dict()
+    numRows = 0
+    badRows = 0
+
+    with open(fname, 'r') as inFile:
+        for line in inFile:
+            fields = line.rstrip('\n').split(',')
+            if len(fields) < 3:
+                continue
+
+            if fields[btle_data.CSV_TYPE] != 'Bluetooth':
+                metaData.parseOutputLine(fields)
+                continue
+
+            if _filter != "" and fields[btle_data.CSV_ADDR] != _filter:
+                continue
+
+            try:
+                ch = fields[btle_data.CSV_CH]
+                rssi = int(fields[btle_data.CSV_RSSI])
+            except (IndexError, ValueError):
+                badRows = badRows + 1
+                continue
+            if rssi < -128 or rssi > 127:
+                badRows = badRows + 1
+                continue
+
+            stats = chStats.get(ch)
+            if stats is None:
+                stats = btle_data.RssiStats()
+                chStats[ch] = stats
+            stats.add(rssi)
+            numRows = numRows + 1
+
+    return (fname, metaData, chStats, numRows, badRows)
+
+# find every data file below the given paths, files are passed through
+def findDataFiles(paths):
+    fnames = list()
+    for path in paths:
+        if os.path.isfile(path):
+            fnames.append(path)
+            continue
+
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                if f.startswith('btle_sniffer_') and f.endswith('.csv'):
+                    fnames.append(os.path.join(root, f))
+
+    return sorted(fnames)
+
+# sort key for angles, numeric angles first in numeric order then scans
+def angleKey(angle):
+    try:
+        return (0, float(angle), angle)
+    except ValueError:
+        return (1, 0, angle)
+
+# build the rows of the stats table from the file summaries, sorted by
+# device, range, angle and channel
+def makeTable(summaries):
+    rows = list()
+    for fname, metaData, chStats, numRows, badRows in summaries:
+        for ch in chStats:
+            stats = chStats[ch].getStats()
+            if stats is None:
+                stats = (0,0,0,0,0,0,0)
+
+            rows.append([metaData.device, metaData.range, metaData.txPower, metaData.angle,
+                         ch, str(chStats[ch].count)] + [str(v) for v in stats] + [str(badRows), fname])
+
+    rows.sort(key=lambda r: (r[0], angleKey(r[1]), angleKey(r[3]), r[4], r[-1]))
+    return rows
+
+# write the stats table as a CSV file
+def writeTable(fname, rows):
+    with open(fname, 'w') as outFile:
+        outFile.write(','.join(BATCH_COLUMNS) + '\n')
+        for row in rows:
+            outFile.write(','.join([v.replace(',', '.') for v in row]) + '\n')
+
+# print usage info
+def usage():
+    print("\nDescription: summarize every btle_sniffer data file below the given directories into a single per-device/per-angle/per-channel RSSI stats table.\n")
+    print("\nUsage:\n")
+    print(" ",__file__, " [-h] [-j jobs] [-f filter_addr] [-o out_file] [dir_or_file ...]\n")
+    print("     -h: help\n")
+    print("     -j jobs: number of worker processes (default is the number of cores)")
+    print("     -f filter_addr: only use rows with the specified advertising address")
+    print("     -o out_file: stats table to write (default btle_batch_stats.csv)")
+    print("     dir_or_file: directories to search for btle_sniffer_*.csv files (default pact_data)")
+    print("\n")
+
+# main function for command line entry point
+def main(argv):
+    jobs = os.cpu_count()
+    _filter = ""
+    outName = 'btle_batch_stats.csv'
+
+    # grab command line args
+    try:
+        opts, args = getopt.getopt(argv,"hj:f:o:",["jobs=","filter=","out="])
+    except getopt.GetoptError:
+        usage()
+        return 1
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            return 0
+        elif opt in ("-j", "--jobs"):
+            jobs = int(arg)
+        elif opt in ("-f", "--filter"):
+            _filter = arg.lower()
+        elif opt in ("-o", "--out"):
+            outName = arg
+
+    if len(args) == 0:
+        args = ['pact_data']
+
+    fnames = findDataFiles(args)
+    if len(fnames) == 0:
+        print("No data files found!")
+        return 1
+
+    start = time.perf_counter()
+
+    # the files are independent so each one is summarized in its own process,
+    # larger files first to keep the workers busy until the end
+    fnames.sort(key=os.path.getsize, reverse=True)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        summaries = list(executor.map(summarizeFile, fnames, [_filter]*len(fnames)))
+
+    rows = makeTable(summaries)
+    writeTable(outName, rows)
+
+    for fname, metaData, chStats, numRows, badRows in summaries:
+        if badRows > 0:
+            print("Skipped " + str(badRows) + " bad rows in " + fname)
+
+    numRows = sum([s[3] for s in summaries])
+    elapsed = time.perf_counter() - start
+    print("Summarized " + str(len(fnames)) + " files, " + str(numRows) + " packets in {:3.2f} s ({:3.0f} packets/s) with ".format(elapsed, numRows/elapsed) + str(jobs) + " workers")
+    print("Wrote " + str(len(rows)) + " rows to " + outName)
+
+    return 0
+
+# callable from command line
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,616 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import time
+import random
+import statistics
+import getopt
+import subprocess
+import threading
+import tempfile
+import shutil
+import resource
+import io
+import contextlib
+import multiprocessing
+
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+import btle_data
+import btle_gen
+
+# Generate timestamp strings in the tshark '-t ad' format starting at t0 with
+# the given step between samples.
+def makeTimestamps(t0, num, step):
+    stamps = list()
+    for i in range(num):
+        stamps.append((t0 + timedelta(seconds=i*step)).strftime('%Y-%m-%d %H:%M:%S.%f'))
+    return stamps
+
+# Compare the cached timestamp parser against the original strptime/mktime
+# conversion.  Covers every second around the DST transitions of the given
+# year in the local time zone plus odd microsecond widths.  Returns the
+# number of mismatches found.
+def checkTimeParser(year=2020):
+    stamps = list()
+
+    # every second for 2 hours around each DST change, found by stepping
+    # through the year an hour at a time
+    t = time.mktime((year, 1, 1, 0, 0, 0, 0, 0, -1))
+    isdst = time.localtime(t).tm_isdst
+    for hr in range(366*24):
+        tHr = t + 3600*hr
+        if time.localtime(tHr).tm_isdst != isdst:
+            isdst = time.localtime(tHr).tm_isdst
+            stamps.extend(makeTimestamps(datetime.fromtimestamp(tHr - 3600), 7200, 1.000001))
+
+    # short fractional parts take the strptime fallback, plus edge values
+    stamps.extend(['2020-05-07 09:39:42.4', '2020-05-07 09:39:42.40',
+                   '2020-05-07 09:39:42.000001', '2020-05-07 09:39:59.999999',
+                   '2020-12-31 23:59:59.999999', '2020-02-29 00:00:00.000000'])
+
+    parser = btle_data.BtleTimeParser()
+    mismatches = 0
+    for s in stamps:
+        if parser.parse(s) != btle_data.BtleTimeParser.slowParse(s):
+            print("Mismatch: ", s, parser.parse(s), btle_data.BtleTimeParser.slowParse(s))
+            mismatches = mismatches + 1
+
+    print("Checked " + str(len(stamps)) + " timestamps, " + str(mismatches) + " mismatches")
+    return mismatches
+
+# Time the original conversion against the cached parser for num packets at
+# roughly 300 packets per second.
+def benchTimeParser(num=200000):
+    stamps = makeTimestamps(datetime(2020, 5, 7, 9, 39, 42, 402593), num, 0.003217)
+
+    start = time.perf_counter()
+    for s in stamps:
+        btle_data.BtleTimeParser.slowParse(s)
+    tSlow = time.perf_counter() - start
+
+    parser = btle_data.BtleTimeParser()
+    start = time.perf_counter()
+    for s in stamps:
+        parser.parse(s)
+    tFast = time.perf_counter() - start
+
+    print("Timestamp parsing, " + str(num) + " rows:")
+    print("   strptime/mktime = {:3.3f} s ({:3.0f} rows/s)".format(tSlow, num/tSlow))
+    print("   BtleTimeParser  = {:3.3f} s ({:3.0f} rows/s)".format(tFast, num/tFast))
+    print("   speedup         = {:3.1f}x".format(tSlow/tFast))
+
+# Compare RssiStats against the statistics module run over the full sample
+# lists the way updateStats used to.  Returns the number of mismatches found.
+def checkRssiStats(trials=1000):
+    rng = random.Random(1)
+    mismatches = 0
+    for i in range(trials):
+        lo = rng.randint(-128, -20)
+        hi = rng.randint(lo, min(127, lo + rng.choice([2, 20, 100])))
+        rssi = [float(rng.randint(lo, hi)) for j in range(rng.randint(2, 500))]
+
+        stats = btle_data.RssiStats()
+        for v in rssi:
+            stats.add(v)
+
+        expected = (min(rssi), max(rssi), statistics.mean(rssi), statistics.median(rssi),
+                    max(set(rssi), key=rssi.count), statistics.stdev(rssi), max(rssi) - min(rssi))
+        if repr(stats.getStats()) != repr(expected):
+            print("Mismatch: ", stats.getStats(), expected)
+            mismatches = mismatches + 1
+
+    print("Checked " + str(trials) + " RSSI sample sets, " + str(mismatches) + " mismatches")
+    return mismatches
+
+# Give every step'th generated packet an RSSI byte of 0xC8 (-200, out of
+# range for the stats) and check that the built in decoder and the tshark
+# path both drop just those packets, counted as dropped.rssi, and that an
+# index entry is left unchanged by a bad RSSI.  Returns the number of
+# mismatches found.
+def checkBadRssi(num=2000, step=10):
+    from btle_pcapng import BtlePcapngDecoder
+
+    gen = btle_gen.BtleTrafficGen()
+    packets = list(gen.getPackets(num))
+    original = list(packets)
+    for i in range(0, num, step):
+        t, ch, scanAddr, advAddr, rssi, crcOk = packets[i]
+        packets[i] = (t, ch, scanAddr, advAddr, str(-0xc8), crcOk)
+    numBad = len(range(0, num, step))
+    good = [packet for i, packet in enumerate(packets) if i % step != 0]
+
+    mismatches = 0
+    decoder = BtlePcapngDecoder()
+    records = decoder.feed(gen.header + b''.join([gen.makeEpb(packet) for packet in packets]))
+    if decoder.badRssi != numBad or len(records) != len(good):
+        print("Bad RSSI: decoder dropped " + str(decoder.badRssi) + " of " + str(numBad) + ", " +
+              str(len(records)) + " records, expected " + str(len(good)))
+        mismatches = mismatches + 1
+
+    # packets dropped for a bad CRC or a scan address are counted as that
+    sniffer = makeSniffer(useTshark=True)
+    sniffer.processLines([gen.makeOutRow(packet) for packet in packets])
+    counts = makeSniffer(useTshark=True)
+    counts.processLines([gen.makeOutRow(packet) for packet in good])
+    numDropped = sum([1 for i in range(0, num, step) if counts.acceptPacket(gen.makeOutRow(original[i]).split(','))])
+    if (sniffer.metrics.getCounter('dropped.rssi') != numDropped or
+        sniffer.statsIndex.allEntry.count != counts.statsIndex.allEntry.count):
+        print("Bad RSSI: tshark path dropped " + str(sniffer.metrics.getCounter('dropped.rssi')) + " of " +
+              str(numDropped) + ", " + str(sniffer.statsIndex.allEntry.count) + " packets indexed, expected " +
+              str(counts.statsIndex.allEntry.count))
+        mismatches = mismatches + 1
+
+    entry = btle_data.BtleAddrEntry()
+    entry.add(0, 0.0, '-60')
+    try:
+        entry.add(0, 1.0, str(-0xc8))
+    except ValueError:
+        pass
+    if entry.count != 1 or len(entry.buffers[0]) != 1 or entry.stats[0].count != 1:
+        print("Bad RSSI: entry changed by a bad RSSI")
+        mismatches = mismatches + 1
+
+    print("Checked " + str(num) + " packets with " + str(numBad) + " bad RSSI bytes, " + str(mismatches) + " mismatches")
+    return mismatches
+
+# Compress a generated capture in small frames and check that reading it 
+# back from blocks at the start, around the header and around each frame 
+# boundary gives the same blocks and records as decoding the whole capture,
+# and that the stream read back while it is being compressed (as the 
+# sniffer does with -z) is the same as the capture so far.  Returns the 
+# number of mismatches found.
+def checkArchive(num=20000, pcapngName='btle_archive_check.pcapng', frameSize=65536):
+    from btle_pcapng import (BtlePcapngDecoder, BtlePcapngArchive, BtlePcapngArchiveReader, compressPcapngFile, 
+                             iterPcapngBlocks, getZstandard, readPcapngFile, readPcapngHeader)
+
+    btle_gen.BtleTrafficGen().writeFiles(pcapngName, os.devnull, num)
+    with open(pcapngName, 'rb') as inFile:
+        data = inFile.read()
+
+    # the blocks of the capture and the records decoded from each
+    decoder = BtlePcapngDecoder()
+    blocks = list()
+    blockRecords = list()
+    for pos, btype, blen, endian in iterPcapngBlocks(data):
+        blocks.append(data[pos:pos + blen])
+        blockRecords.append(decoder.feed(blocks[-1]))
+
+    mismatches = 0
+    codecs = ['gzip'] + (['zstd'] if getZstandard() is not None else [])
+    for codec in codecs:
+        archiveName = compressPcapngFile(pcapngName, codec, frameSize=frameSize)
+        reader = BtlePcapngArchiveReader(archiveName)
+        if readPcapngFile(archiveName) != readPcapngFile(pcapngName):
+            print(archiveName + ": records differ from the uncompressed capture")
+            mismatches = mismatches + 1
+
+        starts = set([0, 1, len(blocks) - 1, len(blocks)])
+        for block in [reader.headerBlocks] + reader.frameBlocks:
+            starts.update([block - 1, block, block + 1])
+        for start in sorted(s for s in starts if 0 <= s <= len(blocks)):
+            end = min(len(blocks), start + 50)
+            expected = [record for records in blockRecords[start:end] for record in records]
+            if list(reader.iterBlocks(start, end)) != blocks[start:end]:
+                print(archiveName + ": blocks from " + str(start) + " differ")
+                mismatches = mismatches + 1
+            if reader.readRecords(start, end) != expected:
+                print(archiveName + ": records from block " + str(start) + " differ")
+                mismatches = mismatches + 1
+
+        os.remove(archiveName)
+        os.remove(archiveName + '.idx')
+
+        # write the capture in uneven chunks, reading the stream back from 
+        # the frames written so far and the bytes still in memory
+        archive = BtlePcapngArchive(archiveName, codec, frameSize=frameSize)
+        header = readPcapngHeader(io.BytesIO(data))
+        for pos in range(0, len(data), 40000):
+            archive.write(data[pos:pos + 40000])
+            end = min(len(data), pos + 40000)
+            for start in (0, end // 3, max(0, end - frameSize - 1)):
+                if b''.join(archive.iterData(start, end)) != data[start:end]:
+                    print(archiveName + ": stream from " + str(start) + " to " + str(end) + " differs while writing")
+                    mismatches = mismatches + 1
+            if archive.getHeader() != header:
+                print(archiveName + ": header differs while writing")
+                mismatches = mismatches + 1
+        archive.close()
+        os.remove(archiveName)
+        os.remove(archiveName + '.idx')
+
+    os.remove(pcapngName)
+    print("Checked reading " + "/".join(codecs) + " archives of " + str(num) + " packets by block, " + 
+          str(mismatches) + " mismatches")
+    return mismatches
+
+# Stream a generated capture through the built in pipeline once in one go 
+# and once cut off part way through a block at a few points, each time 
+# resumed like a dropped stream, and check that the records decoded and 
+# buf.pcapng come out the same.  Returns the number of mismatches found.
+def checkResume(num=5000, pcapngName='btle_resume_check.pcapng', numCuts=3):
+    from btle_pcapng import iterPcapngBlocks
+
+    btle_gen.BtleTrafficGen().writeFiles(pcapngName, os.devnull, num)
+    with open(pcapngName, 'rb') as inFile:
+        data = inFile.read()
+    blocks = list(iterPcapngBlocks(data))
+    cuts = [blocks[len(blocks) * (i + 1) // (numCuts + 1)] for i in range(numCuts)]
+    cuts = [pos + blen // 2 + 1 for pos, btype, blen, endian in cuts]
+
+    results = list()
+    for streamCuts in ([], cuts):
+        sniffer = makeSniffer()
+        sniffer.runFlag = True
+        records = list()
+        aggregate = sniffer.aggregateRecords
+        sniffer.aggregateRecords = lambda batch: (records.extend(batch[1]), aggregate(batch))
+
+        # each stream command ends at the next cut, the last one follows 
+        # the file until the whole capture is decoded
+        remaining = list(streamCuts)
+        def getStreamCmd(endpoint, offset=0):
+            if remaining:
+                end = remaining.pop(0)
+                return ["bash", "-c", "tail -c +" + str(offset + 1) + " " + pcapngName + " | head -c " + str(end - offset)]
+            return ["tail", "-c", "+" + str(offset + 1), "-f", pcapngName]
+        sniffer.getStreamCmd = getStreamCmd
+
+        def stopStream():
+            while sniffer.decoder is None or sniffer.decoder.offset < len(data):
+                time.sleep(0.01)
+            sniffer.streamStop.set()
+            sniffer.endpoints[0].streamProcess.terminate()
+        thread = threading.Thread(target=stopStream)
+        thread.start()
+        sniffer.runDecoder([getStreamCmd(sniffer.endpoints[0])])
+        thread.join()
+
+        with open('buf.pcapng', 'rb') as inFile:
+            results.append((records, inFile.read(), sniffer.endpoints[0].reconnects))
+        os.remove('buf.pcapng')
+
+    mismatches = 0
+    (records, buf, reconnects), (resumedRecords, resumedBuf, resumedReconnects) = results
+    if resumedReconnects != len(cuts):
+        print("Resumed stream: " + str(resumedReconnects) + " reconnects, expected " + str(len(cuts)))
+        mismatches = mismatches + 1
+    if resumedRecords != records or len(records) != num:
+        print("Resumed stream: " + str(len(resumedRecords)) + " records, " + str(len(records)) + " in one go, " + 
+              str(num) + " captured")
+        mismatches = mismatches + 1
+    if resumedBuf != buf or buf != data:
+        print("Resumed stream: buf.pcapng differs")
+        mismatches = mismatches + 1
+
+    os.remove(pcapngName)
+    print("Checked resuming a stream of " + str(num) + " packets cut " + str(len(cuts)) + " times, " + 
+          str(mismatches) + " mismatches")
+    return mismatches
+
+# Measure the live plot frame time once a capture has grown to num packets
+# split over 3 channels at 300 packets/s.  The capture is filled up front and
+# then 40 updates of 0.5 s worth of packets each (2 Hz) are timed.  The figure
+# is drawn off screen with the Agg backend at the size used by the GUI.  
+# windowLen is the live view window in seconds, 0 for the full capture.
+def benchPlot(num=200000, windowLen=0, rate=300):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import btle_plot
+
+    fig = Figure(figsize=(18.0, 7.5))
+    FigureCanvasAgg(fig)
+    axes = [fig.add_subplot(3,1,i) for i in range(1,4)]
+    livePlot = btle_plot.BtleLivePlot(fig, axes)
+
+    rng = random.Random(1)
+    entry = btle_data.BtleAddrEntry('*', int(windowLen * btle_data.BTLE_MAX_RATE))
+    ticks = 40
+    perTick = rate // 2
+    for n in range(num - ticks*perTick):
+        entry.add(n % 3, n / rate, rng.randint(-70, -50))
+
+    tDraw = list()
+    for n in range(num - ticks*perTick, num):
+        entry.add(n % 3, n / rate, rng.randint(-70, -50))
+        if n % perTick == perTick - 1:
+            livePlot.update(entry, "All BTLE Devices", windowLen=windowLen)
+            tDraw.append(livePlot.frameTimes[-1])
+
+    print("Live plot, " + str(num) + " packets, window = " + str(windowLen) + " s:")
+    print("   first frame     = {:3.1f} ms (full draw)".format(tDraw[0]*1000))
+    print("   avg frame       = {:3.1f} ms".format(sum(tDraw[1:])/len(tDraw[1:])*1000))
+    print("   max frame       = {:3.1f} ms".format(max(tDraw[1:])*1000))
+    print("   budget at 2 Hz  = 500 ms")
+
+# packet counts and stages run by the stage benchmarks by default
+BENCH_SIZES = [10000, 100000, 1000000]
+BENCH_STAGES = ['decode', 'pipeline', 'archive', 'tshark', 'datafile']
+
+# Make a sniffer for benchmarking the processing side, no commands are run 
+# for the sniffer host and no GUI is loaded.
+def makeSniffer(useTshark=False, archiveCodec=None):
+    import btle_sniffer
+    import btle_ssh
+    return btle_sniffer.BtleSniffer(useTshark=useTshark, sshSession=btle_ssh.BtleNullSession(), archiveCodec=archiveCodec)
+
+# decode the pcapng capture in 64 kB chunks, the size the tee reads
+def benchDecode(pcapngName, chunkSize=65536):
+    from btle_pcapng import BtlePcapngDecoder
+
+    decoder = BtlePcapngDecoder()
+    start = time.perf_counter()
+    with open(pcapngName, 'rb') as inFile:
+        data = inFile.read(chunkSize)
+        while data:
+            decoder.feed(data)
+            data = inFile.read(chunkSize)
+    return {'packets': decoder.packets, 'seconds': time.perf_counter() - start}
+
+# Stream the capture through the built in pipeline (runDecoder: tee to 
+# buf.pcapng, decode and aggregate stages) as fast as cat can feed it, while
+# a UI tick (index snapshot and stats) runs every tick seconds like the
+# GUI timeout.  The tick times show the latency the UI sees under load.
+# With archiveCodec the stream is also compressed (the archive stage).
+def benchPipeline(pcapngName, tick=0.5, archiveCodec=None):
+    sniffer = makeSniffer(archiveCodec=archiveCodec)
+    ticks = list()
+    done = threading.Event()
+
+    def ticker():
+        while not done.wait(tick):
+            start = time.perf_counter()
+            sniffer.calcStats(sniffer.getSnapshot())
+            ticks.append(time.perf_counter() - start)
+
+    thread = threading.Thread(target=ticker)
+    thread.start()
+    start = time.perf_counter()
+    sniffer.runDecoder([["cat", pcapngName]])
+    elapsed = time.perf_counter() - start
+    done.set()
+    thread.join()
+
+    return {'packets': sniffer.decoder.packets, 'seconds': elapsed, 'ticks': ticks}
+
+# Add the tshark output file to the index the way animatePlot does.  The 
+# rows are appended to a live copy of the file one tick's worth (rate 
+# packets/s for tick seconds) at a time and each tick reads the new rows with
+# the incremental reader, adds them to the index and takes the snapshot and
+# stats.
+def benchTshark(outName, rate=300, tick=0.5):
+    import btle_sniffer
+
+    sniffer = makeSniffer(useTshark=True)
+    sniffer.outReader = btle_sniffer.BtleOutReader('bench_live.out')
+    perTick = max(1, int(rate * tick))
+    ticks = list()
+    numRows = 0
+
+    with open(outName, 'r') as inFile, open('bench_live.out', 'w') as liveFile:
+        done = False
+        while not done:
+            rows = list()
+            for line in inFile:
+                rows.append(line)
+                if len(rows) == perTick:
+                    break
+            done = len(rows) < perTick
+            liveFile.writelines(rows)
+            liveFile.flush()
+
+            start = time.perf_counter()
+            lines = sniffer.outReader.readLines()
+            with sniffer.indexLock:
+                sniffer.processLines(lines)
+            sniffer.calcStats(sniffer.getSnapshot())
+            ticks.append(time.perf_counter() - start)
+            numRows = numRows + sum(1 for line in lines if line.count(',') >= 5)
+
+    return {'packets': numRows, 'seconds': sum(ticks), 'ticks': ticks}
+
+# write the data file from buf.pcapng and from btle_sniffer.out, like 
+# generateDataFile does at the end of a capture.  Both files hold num packets.
+def benchDataFile(pcapngName, outName, num):
+    shutil.copy(pcapngName, 'buf.pcapng')
+    if outName != 'btle_sniffer.out':
+        shutil.copy(outName, 'btle_sniffer.out')
+
+    result = {'packets': 2*num, 'seconds': 0}
+    for useTshark in (False, True):
+        sniffer = makeSniffer(useTshark)
+        start = time.perf_counter()
+        sniffer.writeDataFile('btle_bench.csv', sniffer.metaData.getOutput())
+        result['seconds'] = result['seconds'] + time.perf_counter() - start
+    return result
+
+# Run one stage benchmark in workDir and return its results plus the peak 
+# RSS of the process.  Runs in a fresh process for each stage so the peak 
+# RSS belongs to that stage alone; the output of the sniffer is dropped.
+def runStage(stage, workDir, num, rate):
+    os.chdir(workDir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        if stage == 'decode':
+            result = benchDecode('bench.pcapng')
+        elif stage == 'pipeline':
+            result = benchPipeline('bench.pcapng')
+        elif stage == 'archive':
+            result = benchPipeline('bench.pcapng', archiveCodec='gzip')
+        elif stage == 'tshark':
+            result = benchTshark('btle_sniffer.out', rate)
+        elif stage == 'datafile':
+            result = benchDataFile('bench.pcapng', 'btle_sniffer.out', num)
+        else:
+            raise ValueError("Unknown stage: " + stage)
+
+    result['maxRss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+# Generate num synthetic packets for each size and run each stage on them,
+# printing the throughput, the tick latency (for the stages with a UI tick)
+# and the peak RSS.  The files are generated in a temporary directory that
+# is removed at the end.
+def benchStages(sizes=BENCH_SIZES, stages=BENCH_STAGES, rate=300, numAddrs=20, crcFailRatio=0.02, scanRatio=0.05):
+    workDir = tempfile.mkdtemp(prefix='btle_bench_')
+    with open(os.path.join(workDir, 'defaults.txt'), 'w') as defaultFile:
+        defaultFile.write('testEnv,Benchmark\ndevice,Synthetic\nrange,0\nangle,0\ntxPower,0\ngps,0\n')
+
+    print("Stage benchmarks, " + str(rate) + " packets/s, " + str(numAddrs) + " addrs, crc fail " + 
+          str(crcFailRatio) + ", scan " + str(scanRatio) + ":")
+    print("   {:<9} {:>9} {:>8} {:>11} {:>14} {:>14} {:>9}".format('stage', 'packets', 'time s', 'packets/s',
+                                                                  'tick avg ms', 'tick max ms', 'RSS MB'))
+    try:
+        for num in sizes:
+            gen = btle_gen.BtleTrafficGen(rate=rate, numAddrs=numAddrs, crcFailRatio=crcFailRatio, scanRatio=scanRatio)
+            gen.writeFiles(os.path.join(workDir, 'bench.pcapng'), os.path.join(workDir, 'btle_sniffer.out'), num)
+
+            for stage in stages:
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    result = executor.submit(runStage, stage, workDir, num, rate).result()
+
+                ticks = result.get('ticks')
+                tickAvg = '{:3.2f}'.format(sum(ticks)/len(ticks)*1000) if ticks else '-'
+                tickMax = '{:3.2f}'.format(max(ticks)*1000) if ticks else '-'
+                print("   {:<9} {:>9} {:>8.2f} {:>11.0f} {:>14} {:>14} {:>9.1f}".format(stage, result['packets'], 
+                      result['seconds'], result['packets']/result['seconds'], tickAvg, tickMax, result['maxRss']))
+    finally:
+        shutil.rmtree(workDir)
+
+# modules that only the GUI (or the columnar reader) needs, importing the
+# data model or the sniffer must not load them
+GUI_MODULES = ('matplotlib', 'PySimpleGUI', 'tkinter', 'numpy', 'readline')
+
+# Import the module in a fresh interpreter with -X importtime and return 
+# (name, self us, cumulative us) for every module it loaded, in load order.
+def getImportTimes(module):
+    cmd = [sys.executable, '-X', 'importtime', '-c', 'import ' + module]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError("import " + module + " failed:\n" + result.stderr)
+
+    times = list()
+    for line in result.stderr.splitlines():
+        fields = line.split(':', 1)[-1].split('|')
+        if not line.startswith('import time:') or len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        times.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+    return times
+
+# Time the import of each module num times (the best run is reported so the
+# result is stable enough for CI to track), list the slowest modules it 
+# loads and check that no GUI modules are loaded.  Returns the number of
+# failures, counting an import slower than maxMs (if set) as a failure.
+def benchImportTime(modules=('btle_data', 'btle_sniffer'), num=5, maxMs=0):
+    failures = 0
+    for module in modules:
+        runs = list()
+        for i in range(num):
+            times = getImportTimes(module)
+            runs.append(([t[2] for t in times if t[0] == module][-1], times))
+        runs.sort(key=lambda r: r[0])
+        totals = [r[0] for r in runs]
+        best = runs[0][1]
+
+        print("Import " + module + ": best {:3.1f} ms, median {:3.1f} ms, ".format(totals[0]/1000, totals[len(totals)//2]/1000) + 
+              str(len(best)) + " modules")
+        for name, selfUs, cumUs in sorted(best, key=lambda t: t[1], reverse=True)[:5]:
+            print("   {:<30} {:3.1f} ms".format(name, selfUs/1000))
+
+        gui = sorted(set([t[0] for t in best if t[0].split('.')[0] in GUI_MODULES]))
+        if gui:
+            print("   GUI modules loaded: " + ", ".join(gui))
+            failures = failures + 1
+        if maxMs > 0 and totals[0]/1000 > maxMs:
+            print("   slower than the limit of {:3.1f} ms".format(maxMs))
+            failures = failures + 1
+
+    return failures
+
+# print usage info
+def usage():
+    print("\nDescription: benchmarks and consistency checks for the btle_sniffer hot paths.\n")
+    print("\nUsage:\n")
+    print(" ",__file__, " [-h] [-i] [-m max_ms] [-n num_rows] [-z time_zone] [-b] [-s sizes] [-t stages] [-r rate] [-a num_addrs] [-c crc_fail_ratio] [-x scan_ratio]\n")
+    print("     -h: help\n")
+    print("     -i: only run the import time benchmark (python -X importtime)")
+    print("     -m max_ms: fail if importing a module takes longer than max_ms")
+    print("     -n num_rows: number of rows to use for each benchmark")
+    print("     -z time_zone: run with the given TZ, e.g. America/New_York")
+    print("     -b: only run the stage benchmarks on synthetic traffic (see btle_gen.py)")
+    print("     -s sizes: comma separated packet counts for the stage benchmarks (default 10000,100000,1000000)")
+    print("     -t stages: comma separated stages to run (default " + ",".join(BENCH_STAGES) + ")")
+    print("     -r rate: average packets/s of the synthetic traffic (default 300)")
+    print("     -a num_addrs: number of advertising addresses (default 20)")
+    print("     -c crc_fail_ratio: fraction of packets with a bad CRC (default 0.02)")
+    print("     -x scan_ratio: fraction of packets that are scan requests (default 0.05)")
+    print("\n")
+
+# main function for command line entry point
+def main(argv):
+    num = 200000
+    importOnly = False
+    maxMs = 0
+    stagesOnly = False
+    sizes = BENCH_SIZES
+    stages = BENCH_STAGES
+    rate = 300
+    numAddrs = 20
+    crcFailRatio = 0.02
+    scanRatio = 0.05
+
+    # grab command line args
+    try:
+        opts, args = getopt.getopt(argv,"him:n:z:bs:t:r:a:c:x:",["import","max=","num=","tz=","stages-only","sizes=","stages=","rate=","addrs=","crc=","scan="])
+    except getopt.GetoptError:
+        usage()
+        return 1
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            return 0
+        elif opt in ("-i", "--import"):
+            importOnly = True
+        elif opt in ("-m", "--max"):
+            maxMs = float(arg)
+        elif opt in ("-n", "--num"):
+            num = int(arg)
+        elif opt in ("-z", "--tz"):
+            os.environ['TZ'] = arg
+            time.tzset()
+        elif opt in ("-b", "--stages-only"):
+            stagesOnly = True
+        elif opt in ("-s", "--sizes"):
+            sizes = [int(float(v)) for v in arg.split(',')]
+        elif opt in ("-t", "--stages"):
+            stages = arg.split(',')
+        elif opt in ("-r", "--rate"):
+            rate = float(arg)
+        elif opt in ("-a", "--addrs"):
+            numAddrs = int(arg)
+        elif opt in ("-c", "--crc"):
+            crcFailRatio = float(arg)
+        elif opt in ("-x", "--scan"):
+            scanRatio = float(arg)
+
+    if stagesOnly:
+        benchStages(sizes, stages, rate, numAddrs, crcFailRatio, scanRatio)
+        return 0
+
+    failures = benchImportTime(maxMs=maxMs)
+    if importOnly:
+        return 1 if failures else 0
+
+    failures = failures + checkTimeParser() + checkRssiStats() + checkBadRssi() + btle_gen.checkTrafficGen() + checkArchive() + checkResume()
+    benchTimeParser(num)
+    benchPlot(num)
+    benchPlot(num, windowLen=60)
+
+    return 1 if failures else 0
+
+# callable from command line
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
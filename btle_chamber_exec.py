@@ -3,12 +3,35 @@ import sys
 import os
 import time
 import gc
+import getopt
 import threading
 import btle_sniffer
+import btle_ssh
+import btle_angle
 from EMCenter_Controller import emcenter_ctrl
 
+# Positioner controller wrapper that makes each call to the controller hold
+# lock, so the commands and queries of different threads (e.g. the angle 
+# track polling the position while the profile seeks or starts a scan) 
+# don't interleave on the connection to the EMCenter.  kill is not locked,
+# so a call that hangs can still be stopped.
+class BtleLockedController():
+    def __init__(self, ctrl, lock):
+        self.ctrl = ctrl
+        self.lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self.ctrl, name)
+        if not callable(attr) or name == 'kill':
+            return attr
+
+        def lockedCall(*args, **kwargs):
+            with self.lock:
+                return attr(*args, **kwargs)
+        return lockedCall
+
 class BtleChamberExec():
-    def __init__(self):
+    def __init__(self, headless=False, archiveCodec=None, archiveLevel=None):
         super().__init__()
         self.stopExpireTime = 0    
         self.stopTimerRunning = False
@@ -18,8 +41,15 @@ class BtleChamberExec():
         self.t1 = None
         self.t2 = None
 
-        self.btleSniffer = btle_sniffer.BtleSniffer(autoMode=True)
-        self.emcenterCtrl = emcenter_ctrl.EMCenterController(remoteAddr='192.168.152.36', remotePort='61000')
+        self.btleSniffer = btle_sniffer.BtleSniffer(autoMode=True, liveWrite=True, headless=headless,
+                                                    archiveCodec=archiveCodec, archiveLevel=archiveLevel)
+
+        # the angle track polls the positioner from its own thread while the
+        # profile moves it and watches the scan from another, so every call 
+        # to the controller takes the lock
+        self.ctrlLock = threading.Lock()
+        self.emcenterCtrl = BtleLockedController(emcenter_ctrl.EMCenterController(remoteAddr='192.168.152.36', 
+                                                                                  remotePort='61000'), self.ctrlLock)
 
     def run(self):
         self.btleSniffer.run()
@@ -82,15 +112,134 @@ class BtleChamberExec():
 
             self.scanTimerRunning = False
 
-def main(argv):
+    # set the positioner limits, cycles, speed and acceleration used by the
+    # static angle captures
+    def setupPositioner(self):
+        # Set axis movement limits
+        self.emcenterCtrl.setUpperLimit(self.emcenterCtrl.mastAxis, limit=359.9)
+        self.emcenterCtrl.setUpperLimit(self.emcenterCtrl.tableAxis, limit=150)
+        self.emcenterCtrl.setLowerLimit(self.emcenterCtrl.mastAxis, limit=0)
+        self.emcenterCtrl.setLowerLimit(self.emcenterCtrl.tableAxis, limit=-200)
+
+        # Set nmumber of cycles (for scanning, 0=inf)
+        self.emcenterCtrl.setCycles(self.emcenterCtrl.mastAxis, cycles=1)
+        self.emcenterCtrl.setCycles(self.emcenterCtrl.tableAxis, cycles=1)
+
+        # set positioner speed to 20%
+        self.emcenterCtrl.setSpeed(self.emcenterCtrl.mastAxis, speed=20)
+        self.emcenterCtrl.setSpeed(self.emcenterCtrl.tableAxis, speed=20)
+
+        # set positioner acceleration to 1s 
+        self.emcenterCtrl.setAcceleration(self.emcenterCtrl.mastAxis, accel=1)
+        self.emcenterCtrl.setAcceleration(self.emcenterCtrl.tableAxis, accel=1)
+
+    # return True if the positioner is ready for commands
+    def positionerOk(self):
+        status = self.emcenterCtrl.getStatus(update=True)
+        if status[0] == self.emcenterCtrl.OK and status[1] == 'OK':
+            return True
+        print('Positioner Error!')
+        return False
+
+    # return the current angle of the axis in degrees, or None if the 
+    # positioner doesn't answer
+    def getPosition(self, axis):
+        status = self.emcenterCtrl.getPosition(axis)
+        try:
+            return float(status[1])
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    def isScanning(self, axis):
+        scanning = self.emcenterCtrl.isScanning(axis)
+        return scanning[1] == '1'
+
+    # wait for a scan on the axis to finish, with a time limit to avoid an
+    # inf loop (2000s is plenty)
+    def waitForScan(self, scanAxis):
+        counter = 0
+        scanning = self.isScanning(scanAxis)
+        while scanning:
+            time.sleep(10)
+            print('Still scanning...')
+
+            counter = counter + 1
+            if counter > 200:
+                break
+            
+            # get latest scanning status
+            scanning = self.isScanning(scanAxis)
+
+    # Run a scan on the axis as one segment of the capture.  The segment 
+    # starts when the scan is started and ends when the positioner reports 
+    # that it is done.  The axis position is tracked during the scan so 
+    # each packet gets its angle and the segment gets an angle binned RSSI 
+    # pattern table.
+    def scanSegment(self, scanAxis, angle):
+        self.emcenterCtrl.seekPosition(self.emcenterCtrl.mastAxis, pos=0)
+        self.emcenterCtrl.seekPosition(self.emcenterCtrl.tableAxis, pos=40)
+
+        self.emcenterCtrl.setSpeed(self.emcenterCtrl.mastAxis,speed=2)
+        self.emcenterCtrl.setSpeed(self.emcenterCtrl.tableAxis,speed=10)
+
+        self.updateMetadata(angle=angle)
+        time.sleep(20)
+
+        track = btle_angle.BtleAngleTrack(lambda: self.getPosition(scanAxis), addrs=[self.btleSniffer.filter])
+        self.btleSniffer.startSegment(angleTrack=track)
+        self.emcenterCtrl.startScan(scanAxis)
+        self.waitForScan(scanAxis)
+        self.btleSniffer.endSegment()
+
+    # Scripted profile to automate anechoic chamber collection, run on its 
+    # own thread while the sniffer UI runs.  The capture keeps running for
+    # the whole profile and each angle is a segment of it with its own data
+    # files: 8 segments on the Mast from 0-360 in 45 deg increments, then a
+    # scan on each axis.  The capture is stopped at the end.
+    def runProfile(self, captureTime=500):
+        self.btleSniffer.captureStarted.wait()
 
-    # Scripted loop to automate anechoic chamber collection 
+        if self.positionerOk():
+            self.setupPositioner()
+
+            for pos in range(0, 360, 45):
+                print("Running segment for angle = " + str(pos))
+
+                # move to the correct position
+                self.emcenterCtrl.seekPosition(self.emcenterCtrl.mastAxis, pos=pos)
+                self.emcenterCtrl.seekPosition(self.emcenterCtrl.tableAxis, pos=40)
+                time.sleep(20)
+
+                self.updateMetadata(angle=pos)
+                self.btleSniffer.startSegment()
+                time.sleep(captureTime)
+                self.btleSniffer.endSegment()
+
+            # Now run scan 1 - Mast Axis, then scan 2 - Table Axis
+            if self.positionerOk():
+                self.scanSegment(self.emcenterCtrl.mastAxis, 'H-Axis. 0 to 360. 360 to 0')
+            if self.positionerOk():
+                self.scanSegment(self.emcenterCtrl.tableAxis, 'V-Axis. 0 to 110. 110 to -240. -240 to 110')
+
+        self.stop()
+
+    # run the profile as a single capture session
+    def runSession(self):
+        t = threading.Thread(target=self.runProfile)
+        t.start()
+        self.btleSniffer.run()
+        t.join()
+        self.btleSniffer.wait()
+
+# Scripted loop to automate anechoic chamber collection, restarting the 
+# sniffer and wireshark for each angle.
+def runPerAngle(headless=False, archiveCodec=None, archiveLevel=None):
     # Run 8 iterations on Mast from 0-360 in 45 deg increments
     pos = 0
     for i in range(10):
         print("Running test (" + str(i) + ") for angle = " + str(pos))
 
-        btle = BtleChamberExec()
+        btle = BtleChamberExec(headless, archiveCodec, archiveLevel)
 
         if i<8:
             status = btle.emcenterCtrl.getStatus(update=True)
@@ -111,7 +260,7 @@ def main(argv):
 
                 # set positioner acceleration to 1s 
                 btle.emcenterCtrl.setAcceleration(btle.emcenterCtrl.mastAxis, accel=1)
-                btle.emcenterCtrl.setAcceleration(btle.emcenterCtrl.mastAxis, accel=1)
+                btle.emcenterCtrl.setAcceleration(btle.emcenterCtrl.tableAxis, accel=1)
 
                 # move to the correct position
                 btle.emcenterCtrl.seekPosition(btle.emcenterCtrl.mastAxis, pos=pos)
@@ -160,6 +309,54 @@ def main(argv):
                 btle.setScanTimer(20, btle.emcenterCtrl.tableAxis)
                 btle.btleSniffer.run()
 
+# print usage info
+def usage():
+    print("\nDescription: automated anechoic chamber collection with the EMCenter positioner.\n")
+    print("\nUsage:\n")
+    print(" ",__file__, " [-h] [-r] [-H] [-z codec[:level]]\n")
+    print("     -h: help\n")
+    print("     -r: restart the sniffer and wireshark for every angle instead of capturing")
+    print("         all angles as segments of one capture")
+    print("     -H: headless, run the sniffer without the plot and UI")
+    print("     -z codec[:level]: store the captures compressed with gzip or zstd")
+    print("\n")
+
+def main(argv):
+    perAngle = False
+    headless = False
+    archiveCodec = None
+    archiveLevel = None
+
+    # grab command line args
+    try:
+        opts, args = getopt.getopt(argv,"hrHz:",["restart","headless","archive="])
+    except getopt.GetoptError:
+        usage()
+        return 1
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            return 0
+        elif opt in ("-r", "--restart"):
+            perAngle = True
+        elif opt in ("-H", "--headless"):
+            headless = True
+        elif opt in ("-z", "--archive"):
+            archiveCodec, _, level = arg.partition(':')
+            archiveLevel = int(level) if level else None
+            if archiveCodec not in btle_sniffer.ARCHIVE_CODECS:
+                usage()
+                return 1
+
+    if perAngle:
+        runPerAngle(headless, archiveCodec, archiveLevel)
+    else:
+        BtleChamberExec(headless, archiveCodec, archiveLevel).runSession()
+
+    # close the ssh connection shared by all the iterations
+    btle_ssh.getSession().stop()
+
     print('DONE WITH AUTOMATED BTLE TEST!')
 
     return 0
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import struct
+import getopt
+import array
+
+import numpy
+
+# Columnar capture file (.btlc), written next to btle_sniffer_*.csv.  All
+# values are little endian:
+#
+#   header        BTLC_HEADER (magic, version, sizes and column offsets)
+#   metadata      metaLen bytes of UTF-8 text, the BtleMetaData.getOutput lines
+#   address table numAddrs fixed width ASCII entries of BTLC_ADDR_LEN bytes
+#   epoch         numRows float64, 8 byte aligned
+#   channel       numRows uint8
+#   rssi          numRows int8
+#   address       numRows uint16 index into the address table, 2 byte aligned
+#
+# Every column is a plain array at a known offset so a capture can be mapped
+# with numpy.memmap and used without any parsing.
+BTLC_MAGIC = b'BTLECOL\x00'
+BTLC_VERSION = 1
+BTLC_HEADER = struct.Struct('<8sIIQII4Q')
+BTLC_ADDR_LEN = 17
+BTLC_MAX_ADDRS = 65536
+
+# Collects the packets of a capture and writes them as a columnar file when
+# closed.  The address strings are dictionary encoded in the order they are
+# first seen.
+class BtleColumnarWriter:
+    def __init__(self, fname, metaLines=[]):
+        self.fname = fname
+        self.metaLines = list(metaLines)
+        self.epoch = array.array('d')
+        self.ch = array.array('B')
+        self.rssi = array.array('b')
+        self.addrIdx = array.array('H')
+        self.addrs = dict()
+
+    def __len__(self):
+        return len(self.epoch)
+
+    def append(self, epoch, ch, rssi, addr):
+        idx = self.addrs.get(addr)
+        if idx is None:
+            idx = len(self.addrs)
+            if idx >= BTLC_MAX_ADDRS:
+                raise ValueError("Too many addresses for the columnar file: " + str(idx + 1))
+            self.addrs[addr] = idx
+
+        self.epoch.append(epoch)
+        self.ch.append(int(ch))
+        self.rssi.append(int(rssi))
+        self.addrIdx.append(idx)
+
+    # write a column at the current position after padding to its alignment
+    def writeColumn(self, outFile, col):
+        pad = -outFile.tell() % col.itemsize
+        outFile.write(b'\x00' * pad)
+        offset = outFile.tell()
+        if sys.byteorder != 'little' and col.itemsize > 1:
+            col = array.array(col.typecode, col)
+            col.byteswap()
+        col.tofile(outFile)
+        return offset
+
+    def close(self):
+        meta = ''.join(self.metaLines).encode('utf-8')
+        table = b''.join([addr.encode('ascii').ljust(BTLC_ADDR_LEN, b'\x00') for addr in self.addrs])
+
+        with open(self.fname, 'wb') as outFile:
+            # the header is rewritten once the column offsets are known
+            outFile.write(b'\x00' * BTLC_HEADER.size)
+            outFile.write(meta)
+            outFile.write(table)
+            offsets = [self.writeColumn(outFile, col) for col in (self.epoch, self.ch, self.rssi, self.addrIdx)]
+
+            outFile.seek(0)
+            outFile.write(BTLC_HEADER.pack(BTLC_MAGIC, BTLC_VERSION, len(meta), len(self.epoch),
+                                           len(self.addrs), BTLC_ADDR_LEN, *offsets))
+
+# Memory mapped view of a columnar file.  epoch, ch, rssi and addrIdx are
+# read only numpy arrays backed by the file, addrs is the address table and
+# metaLines the metadata lines from the header.
+class BtleColumnarFile:
+    def __init__(self, fname):
+        self.fname = fname
+
+        with open(fname, 'rb') as inFile:
+            header = inFile.read(BTLC_HEADER.size)
+            if len(header) < BTLC_HEADER.size or header[:8] != BTLC_MAGIC:
+                raise ValueError(fname + " is not a columnar capture file")
+
+            magic, version, metaLen, numRows, numAddrs, addrLen, epochOff, chOff, rssiOff, addrOff = BTLC_HEADER.unpack(header)
+            if version != BTLC_VERSION:
+                raise ValueError(fname + ": unsupported columnar file version " + str(version))
+
+            meta = inFile.read(metaLen).decode('utf-8')
+            table = inFile.read(numAddrs * addrLen)
+
+        self.metaLines = meta.splitlines(keepends=True)
+        self.addrs = [table[i:i+addrLen].rstrip(b'\x00').decode('ascii') for i in range(0, len(table), addrLen)]
+
+        self.epoch = self.mapColumn('<f8', epochOff, numRows)
+        self.ch = self.mapColumn('u1', chOff, numRows)
+        self.rssi = self.mapColumn('i1', rssiOff, numRows)
+        self.addrIdx = self.mapColumn('<u2', addrOff, numRows)
+
+    def mapColumn(self, dtype, offset, numRows):
+        # numpy can't map an empty region
+        if numRows == 0:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.memmap(self.fname, dtype=dtype, mode='r', offset=offset, shape=(numRows,))
+
+    def __len__(self):
+        return len(self.epoch)
+
+    # return the metadata as a dict of name to value, e.g. 'Angle': '45'
+    def getMetaData(self):
+        metaData = dict()
+        for line in self.metaLines:
+            fields = line.rstrip('\n').split(',')
+            if len(fields) == 3:
+                metaData[fields[1]] = fields[2]
+        return metaData
+
+    # return the packets for one advertising address as a boolean mask
+    def getAddrMask(self, addr):
+        if addr not in self.addrs:
+            return numpy.zeros(len(self), dtype=bool)
+        return self.addrIdx == self.addrs.index(addr)
+
+# Convert a btle_sniffer_*.csv data file to a columnar file with the same
+# name and the .btlc extension.  Returns the number of packets written.
+def convertCsvFile(csvName, fname=None):
+    if fname is None:
+        fname = os.path.splitext(csvName)[0] + '.btlc'
+
+    metaLines = list()
+    rows = list()
+    with open(csvName, 'r') as inFile:
+        for line in inFile:
+            fields = line.rstrip('\n').split(',')
+            if len(fields) > 1 and fields[1] == 'Bluetooth':
+                rows.append(fields)
+            elif len(fields) == 3 and fields[1] != 'Padding':
+                metaLines.append(line)
+
+    writer = BtleColumnarWriter(fname, metaLines)
+    for fields in rows:
+        writer.append(float(fields[5]), fields[-1], fields[3], fields[2])
+    writer.close()
+
+    return len(writer)
+
+# Check a columnar file against the CSV it was made from.  Returns the number
+# of mismatched rows.
+def verifyFile(csvName, fname):
+    capture = BtleColumnarFile(fname)
+    mismatches = 0
+    i = 0
+    with open(csvName, 'r') as inFile:
+        for line in inFile:
+            fields = line.rstrip('\n').split(',')
+            if len(fields) < 2 or fields[1] != 'Bluetooth':
+                continue
+
+            if i >= len(capture):
+                got = None
+            else:
+                got = (repr(float(capture.epoch[i])), str(capture.ch[i]), str(capture.rssi[i]), capture.addrs[capture.addrIdx[i]])
+            if got != (fields[5], fields[-1], fields[3], fields[2]):
+                print(fname, " row ", i, ": ", got, " != ", fields)
+                mismatches = mismatches + 1
+            i = i + 1
+
+    if i != len(capture):
+        print(fname, ": ", len(capture), " rows, expected ", i)
+        mismatches = mismatches + 1
+
+    return mismatches
+
+# print usage info
+def usage():
+    print("\nDescription: convert btle_sniffer_*.csv data files to the memory mappable columnar format (.btlc).\n")
+    print("\nUsage:\n")
+    print(" ",__file__, " [-h] [-v] file.csv ...\n")
+    print("     -h: help\n")
+    print("     -v: verify each columnar file against its CSV after converting")
+    print("\n")
+
+# main function for command line entry point
+def main(argv):
+    verify = False
+
+    # grab command line args
+    try:
+        opts, args = getopt.getopt(argv,"hv",["verify"])
+    except getopt.GetoptError:
+        usage()
+        return 1
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            return 0
+        elif opt in ("-v", "--verify"):
+            verify = True
+
+    if not args:
+        usage()
+        return 1
+
+    mismatches = 0
+    for csvName in args:
+        fname = os.path.splitext(csvName)[0] + '.btlc'
+        num = convertCsvFile(csvName, fname)
+        print(fname + ": " + str(num) + " packets, " + str(os.path.getsize(fname)) + " bytes (csv " + str(os.path.getsize(csvName)) + " bytes)")
+        if verify:
+            mismatches = mismatches + verifyFile(csvName, fname)
+
+    if verify:
+        print("Total mismatches: ", mismatches)
+    return 1 if mismatches else 0
+
+# callable from command line
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import time
+import math
+import array
+import bisect
+
+from datetime import datetime
+from fractions import Fraction
+
+# Data model of the sniffer: field indexes, capture metadata, timestamp
+# parsing and the per-address RSSI stats.  Only uses the standard library
+# so it imports quickly for scripts that just read or summarize captures.
+
+# field indexes for BLTE data
+BTLE_TIME = 0
+BTLE_CH = 1
+BTLE_SCAN_ADDR = 2
+BTLE_ADV_ADDR = 3
+BTLE_RSSI = 4
+BTLE_CRCOK = 5
+
+# field indexes for the MIT-LL data file rows written by generateDataFile, 
+# the channel is always the last field
+CSV_TIME = 0
+CSV_TYPE = 1
+CSV_ADDR = 2
+CSV_RSSI = 3
+CSV_TX_POWER = 4
+CSV_EPOCH = 5
+CSV_CH = -1
+
+# map advertising channel number (as read from the data file) to plot index
+BTLE_CH_INDEX = {"37": 0, "38": 1, "39": 2}
+
+# highest packet rate per channel (packets/s) the live view window is sized for
+BTLE_MAX_RATE = 500
+
+# the RSSI values the stats and the plot buffers (signed char) can hold, as 
+# the strings read from the data file
+BTLE_RSSI_VALUES = frozenset([str(i) for i in range(-128, 128)])
+
+class BtleMetaData:
+    def __init__(self, readDefaults=True):
+
+        self.testEnv = ''
+        self.device = ''
+        self.range = ''
+        self.angle = ''
+        self.txPower = ''
+        self.gps = ''
+        
+        if readDefaults:
+            self.getDefaults()
+    
+    def setDefaults(self):
+        with open('defaults.txt', 'w') as defaultFile:
+            print("Writing default metadata...")
+            defaultFile.write('testEnv,' + self.testEnv + '\n')
+            defaultFile.write('device,' + self.device + '\n')
+            defaultFile.write('range,' + self.range + '\n')
+            defaultFile.write('angle,' + self.angle + '\n')
+            defaultFile.write('txPower,' + self.txPower + '\n')
+            defaultFile.write('gps,' + self.gps + '\n')
+
+    def getDefaults(self):
+        with open('defaults.txt','r') as defaultFile:
+            print("Reading default metadata...")
+            lines = defaultFile.readlines()
+
+            for line in lines:
+                line = line.rstrip()
+                val = line.split(',')
+                if len(val) != 2:
+                    print("Unexpected default value line!")
+                    continue
+                
+                if val[0] == "testEnv":
+                    self.testEnv = val[1]
+                if val[0] == "device":
+                    self.device= val[1]
+                if val[0] == "range":
+                    self.range = val[1]
+                if val[0] == "angle":
+                    self.angle = val[1]
+                if val[0] == "txPower":
+                    self.txPower = val[1]
+                if val[0] == "gps":
+                    self.gps = val[1]
+
+        return
+
+    def makeOutputLine(self, name, val):
+        output = str(datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f') + ',' + name + ',' + val.replace(',','.'))
+        return output + '\n'
+
+    def getOutput(self):
+        output = list()
+        output.append(self.makeOutputLine("Environment", self.testEnv))
+        output.append(self.makeOutputLine("Device", self.device))
+        output.append(self.makeOutputLine("Range", self.range))
+        output.append(self.makeOutputLine("Angle", self.angle))
+        output.append(self.makeOutputLine("TxPower", self.txPower))
+        output.append(self.makeOutputLine("GPS", self.gps))
+        return output
+
+    # read back a metadata line written by getOutput, already split on ','.  
+    # Returns False if the line is not a metadata line.
+    def parseOutputLine(self, fields):
+        if len(fields) != 3:
+            return False
+
+        if fields[1] == "Environment":
+            self.testEnv = fields[2]
+        elif fields[1] == "Device":
+            self.device = fields[2]
+        elif fields[1] == "Range":
+            self.range = fields[2]
+        elif fields[1] == "Angle":
+            self.angle = fields[2]
+        elif fields[1] == "TxPower":
+            self.txPower = fields[2]
+        elif fields[1] == "GPS":
+            self.gps = fields[2]
+        else:
+            return False
+
+        return True
+    
+# Fast decoder for timestamps in the tshark '-t ad' format, for example 
+# '2020-05-07 09:39:42.402593'.  The fixed width fields are sliced directly 
+# and the local epoch of the date/hour/minute prefix is cached, so only the 
+# first row of each minute pays for the datetime/mktime conversion.  Strings
+# that are not in the fixed width format fall back to strptime so the result
+# (or the exception raised) is always the same as the original conversion.
+class BtleTimeParser:
+    def __init__(self, maxCacheSize=4096):
+        self.maxCacheSize = maxCacheSize
+        self.cache = dict()
+        self.lastPrefix = None
+        self.lastEpoch = 0.0
+
+    # original conversion, used for the cache misses and odd formats
+    @staticmethod
+    def slowParse(s):
+        d = datetime.strptime(s, "%Y-%m-%d %H:%M:%S.%f")
+        return time.mktime(d.timetuple()) + d.microsecond/1.0e6
+
+    # convert the timestamp string to seconds since the epoch
+    def parse(self, s):
+        if len(s) != 26 or s[16] != ':' or s[19] != '.' or \
+           not s[17:19].isdigit() or not s[20:].isdigit():
+            return self.slowParse(s)
+
+        sec = int(s[17:19])
+        if sec > 59:
+            return self.slowParse(s)
+
+        prefix = s[:16]
+        if prefix != self.lastPrefix:
+            base = self.cache.get(prefix)
+            if base is None:
+                d = datetime.strptime(prefix, "%Y-%m-%d %H:%M")
+                base = time.mktime(d.timetuple())
+                if len(self.cache) >= self.maxCacheSize:
+                    self.cache.clear()
+                self.cache[prefix] = base
+            self.lastPrefix = prefix
+            self.lastEpoch = base
+
+        return (self.lastEpoch + sec) + int(s[20:])/1.0e6
+
+# Running RSSI statistics for a single channel, updated in O(1) per sample.
+# RSSI is an integer dBm, so the count, sum and sum of squares are kept as 
+# exact integers and the median and mode come from a 256 bin histogram 
+# covering the int8 range.  The results are the same as running the 
+# statistics module over the full list of float RSSI values.
+class RssiStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sum = 0
+        self.sumSq = 0
+        self.min = None
+        self.max = None
+        self.hist = [0] * 256
+        # distinct values in the order they were first seen, used to break 
+        # ties for the mode the same way max(set(rssi), key=rssi.count) does
+        self.order = list()
+
+    # add a single RSSI sample
+    def add(self, rssi):
+        rssi = int(rssi)
+        if rssi < -128 or rssi > 127:
+            raise ValueError("RSSI out of range: " + str(rssi))
+
+        self.count = self.count + 1
+        self.sum = self.sum + rssi
+        self.sumSq = self.sumSq + rssi*rssi
+
+        if self.min is None or rssi < self.min:
+            self.min = rssi
+        if self.max is None or rssi > self.max:
+            self.max = rssi
+
+        idx = rssi + 128
+        if self.hist[idx] == 0:
+            self.order.append(float(rssi))
+        self.hist[idx] = self.hist[idx] + 1
+
+    def copy(self):
+        stats = RssiStats()
+        stats.count = self.count
+        stats.sum = self.sum
+        stats.sumSq = self.sumSq
+        stats.min = self.min
+        stats.max = self.max
+        stats.hist = list(self.hist)
+        stats.order = list(self.order)
+        return stats
+
+    def getMean(self):
+        return self.sum / self.count
+
+    # return the value at the given position in the sorted samples
+    def getNth(self, n):
+        total = 0
+        for idx in range(256):
+            total = total + self.hist[idx]
+            if total > n:
+                return float(idx - 128)
+
+    def getMedian(self):
+        if self.count % 2 == 1:
+            return self.getNth(self.count // 2)
+        else:
+            i = self.count // 2
+            return (self.getNth(i - 1) + self.getNth(i)) / 2
+
+    def getMode(self):
+        return max(set(self.order), key=lambda v: self.hist[int(v) + 128])
+
+    # sample standard deviation, correctly rounded from the exact variance
+    # like statistics.stdev
+    def getStd(self):
+        var = Fraction(self.count*self.sumSq - self.sum*self.sum, self.count*(self.count - 1))
+        n = var.numerator
+        m = var.denominator
+        q = (n.bit_length() - m.bit_length() - 2*sys.float_info.mant_dig - 3) // 2
+        if q >= 0:
+            m = m << 2*q
+        else:
+            n = n << -2*q
+        a = math.isqrt(n // m)
+        a = a | (a*a*m != n)
+        if q >= 0:
+            return float(a << q)
+        return a / (1 << -q)
+
+    # return (min, max, mean, median, mode, std, range) or None if there are
+    # not enough samples yet
+    def getStats(self):
+        if self.count < 2:
+            return None
+        return (float(self.min), float(self.max), self.getMean(), self.getMedian(),
+                self.getMode(), self.getStd(), float(self.max) - float(self.min))
+
+# Ring buffer of (time, RSSI) samples backed by arrays of float64 time and 
+# int8 RSSI.  The arrays grow until they reach the capacity and then the 
+# oldest samples are overwritten, so memory stays bounded.  A capacity of 0 
+# means the buffer keeps every sample.
+class BtleRingBuffer:
+    def __init__(self, capacity=0):
+        self.capacity = capacity
+        self.t = array.array('d')
+        self.rssi = array.array('b')
+        self.start = 0
+
+    def __len__(self):
+        return len(self.t)
+
+    def append(self, t, rssi):
+        if self.capacity == 0 or len(self.t) < self.capacity:
+            self.t.append(t)
+            self.rssi.append(rssi)
+        else:
+            self.t[self.start] = t
+            self.rssi[self.start] = rssi
+            self.start = (self.start + 1) % self.capacity
+
+    # return (time, RSSI) arrays in time order.  If windowLen is set only the
+    # samples within windowLen seconds of the most recent one are returned.
+    def getData(self, windowLen=0):
+        if self.start == 0:
+            t = self.t
+            rssi = self.rssi
+        else:
+            t = self.t[self.start:] + self.t[:self.start]
+            rssi = self.rssi[self.start:] + self.rssi[:self.start]
+
+        if windowLen > 0 and len(t) > 0:
+            first = bisect.bisect_left(t, t[-1] - windowLen)
+            if first > 0:
+                t = t[first:]
+                rssi = rssi[first:]
+        return t, rssi
+
+    # change the capacity, keeping the most recent samples
+    def resize(self, capacity):
+        t, rssi = self.getData()
+        if capacity > 0 and len(t) > capacity:
+            t = t[-capacity:]
+            rssi = rssi[-capacity:]
+        self.capacity = capacity
+        self.t = array.array('d', t)
+        self.rssi = array.array('b', rssi)
+        self.start = 0
+
+# Plot buffers and running stats for ch 37, 38 and 39 plus the total number
+# of packets received, for a single advertising address.  The plot buffers 
+# only need to cover the live view window, the stats cover the full capture.
+class BtleAddrEntry:
+    def __init__(self, addr='', capacity=0):
+        self.addr = addr
+        self.count = 0
+        self.buffers = [BtleRingBuffer(capacity) for i in range(3)]
+        self.stats = [RssiStats(), RssiStats(), RssiStats()]
+
+        # combo box label, only rebuilt when the count changes
+        self.label = ''
+        self.labelCount = -1
+
+    # add a packet, chIdx is 0-2 for ch 37-39 or None for other channels.  
+    # The RSSI is checked first so a bad one leaves the entry unchanged.
+    def add(self, chIdx, t, rssi):
+        if chIdx is not None:
+            rssi = int(rssi)
+            if rssi < -128 or rssi > 127:
+                raise ValueError("RSSI out of range: " + str(rssi))
+        self.count = self.count + 1
+        if chIdx is not None:
+            self.buffers[chIdx].append(t, rssi)
+            self.stats[chIdx].add(rssi)
+
+    # return (time, RSSI) arrays for the channel index within the window
+    def getData(self, chIdx, windowLen=0):
+        return self.buffers[chIdx].getData(windowLen)
+
+    def setCapacity(self, capacity):
+        for buf in self.buffers:
+            buf.resize(capacity)
+
+    # return a copy of the entry holding only the samples within the window,
+    # which can be used while the original keeps changing
+    def snapshot(self, windowLen=0):
+        entry = BtleAddrEntry(self.addr)
+        entry.count = self.count
+        for i in range(3):
+            t, rssi = self.buffers[i].getData(windowLen)
+            entry.buffers[i].t = array.array('d', t)
+            entry.buffers[i].rssi = array.array('b', rssi)
+            entry.stats[i] = self.stats[i].copy()
+        return entry
+
+    def getLabel(self):
+        if self.labelCount != self.count:
+            self.label = self.addr + ' ' + str(self.count)
+            self.labelCount = self.count
+        return self.label
+
+# Index of the received packets keyed by advertising address and channel.  
+# Entries are updated incrementally as packets arrive so that switching the 
+# displayed address is a dict lookup instead of a reparse of the data file.
+# The entry for all addresses together is kept separately.
+class BtleStatsIndex:
+    def __init__(self, windowLen=0, keepSamples=True):
+        self.windowLen = windowLen
+        self.keepSamples = keepSamples
+        self.reset()
+
+    def reset(self):
+        self.entries = dict()
+        self.allEntry = BtleAddrEntry('*', self.getCapacity())
+
+    # ring buffer capacity needed to hold windowLen seconds of samples at the
+    # highest expected packet rate, 0 (unbounded) if there is no window.  If
+    # the samples are not kept (only the stats are used) each buffer holds 
+    # just the latest sample.
+    def getCapacity(self):
+        if not self.keepSamples:
+            return 1
+        return int(self.windowLen * BTLE_MAX_RATE)
+
+    # change the live view window length in seconds, 0 for the full capture
+    def setWindow(self, windowLen):
+        self.windowLen = windowLen
+        for entry in [self.allEntry] + list(self.entries.values()):
+            entry.setCapacity(self.getCapacity())
+
+    def add(self, addr, ch, t, rssi):
+        chIdx = BTLE_CH_INDEX.get(ch)
+        self.allEntry.add(chIdx, t, rssi)
+
+        addr = addr.lower()
+        entry = self.entries.get(addr)
+        if entry is None:
+            entry = BtleAddrEntry(addr, self.getCapacity())
+            self.entries[addr] = entry
+        entry.add(chIdx, t, rssi)
+
+    # return the entry for the address, or all addresses for "" or "*"
+    def get(self, addr):
+        if addr in ("", "*"):
+            return self.allEntry
+        return self.entries.get(addr.lower())
+
+    # return the address entries sorted by descending packet count
+    def getSorted(self, minCount=0):
+        entries = [e for e in self.entries.values() if e.addr != '' and e.count > minCount]
+        return sorted(entries, key=lambda e: e.count, reverse=True)
+
+# Incrementally reads the tshark output file.  The byte offset into the file
+# is remembered between calls so only lines appended since the last call are
+# returned.  A trailing partial line is held until its newline arrives.
+class BtleOutReader:
+    def __init__(self, fname='btle_sniffer.out'):
+        self.fname = fname
+        self.inFile = None
+        self.offset = 0
+        self.partial = b''
+        self.lineNum = 0
+
+    # close the file and start over from the beginning on the next read
+    def reset(self):
+        if self.inFile is not None:
+            self.inFile.close()
+        self.inFile = None
+        self.offset = 0
+        self.partial = b''
+        self.lineNum = 0
+
+    # return a list of the complete lines appended since the last call
+    def readLines(self):
+        if self.inFile is None:
+            if not os.path.exists(self.fname):
+                return []
+            self.inFile = open(self.fname, 'rb')
+
+        # the file is truncated when a new capture starts, start over if so
+        if os.fstat(self.inFile.fileno()).st_size < self.offset:
+            self.reset()
+            return self.readLines()
+
+        self.inFile.seek(self.offset)
+        buf = self.inFile.read()
+        if not buf:
+            return []
+        self.offset = self.offset + len(buf)
+
+        # keep the last (partial) line until the rest of it is written
+        lines = (self.partial + buf).split(b'\n')
+        self.partial = lines.pop()
+
+        # FIXME - skip the first line, it is garbage
+        if self.lineNum == 0 and lines:
+            lines = lines[1:]
+            self.lineNum = 1
+        self.lineNum = self.lineNum + len(lines)
+
+        return [line.decode('utf-8', 'replace').rstrip() for line in lines]
+
+# Format a captured packet as a row of the MIT-LL data file (no newline).
+def makeDataRow(data, t, txPower):
+    return ','.join((data[BTLE_TIME], 'Bluetooth', data[BTLE_ADV_ADDR], data[BTLE_RSSI],
+                     txPower, str(t), data[BTLE_CH]))
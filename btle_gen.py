@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import time
+import random
+import struct
+import bisect
+import getopt
+import itertools
+
+from btle_pcapng import (readPcapngFile, PCAPNG_EPB, NORDIC_HDR_LEN, NORDIC_PKT_COUNTER, NORDIC_FLAGS,
+                         NORDIC_CHANNEL, NORDIC_RSSI, NORDIC_FLAG_CRCOK, BLE_ADV_IND, BLE_SCAN_REQ, BTLE_EPOCH)
+
+# capture the synthetic traffic is modelled on by default
+SEED_CAPTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pact_data', 'nRF52',
+                            'iPhone 11-3', 'btle_sniffer_05-11-2020-140626.pcapng')
+
+# advertising channels in the order they are used in an advertising event
+BTLE_ADV_CHANNELS = ("37", "38", "39")
+
+# gap between the packets of one advertising event in microseconds
+BTLE_EVENT_GAP = 300
+
+# Synthetic Nordic BLE sniffer traffic, seeded from a real capture.  The
+# pcapng section/interface blocks and a packet template are taken from the
+# seed capture and the RSSI of each channel is drawn from the seed's RSSI
+# distribution for that channel.  Packets come in advertising events (one
+# packet on each of ch 37, 38 and 39) with exponential gaps between events
+# for an average of rate packets/s.  The advertisers follow a Zipf
+# distribution (the first address is the busiest, like the phone under test
+# in a chamber run), scanRatio of the packets are scan requests with a
+# non-null scan address and crcFailRatio of them have a bad CRC.
+class BtleTrafficGen:
+    def __init__(self, seedFile=SEED_CAPTURE, rate=300, numAddrs=20, crcFailRatio=0.02, scanRatio=0.05, seed=1):
+        self.rate = rate
+        self.crcFailRatio = crcFailRatio
+        self.scanRatio = scanRatio
+        self.rng = random.Random(seed)
+
+        self.loadSeed(seedFile)
+
+        # advertising and scanning addresses as (string, little endian bytes)
+        self.advAddrs = [self.makeAddr() for i in range(numAddrs)]
+        self.scanAddrs = [self.makeAddr() for i in range(max(1, numAddrs // 4))]
+        self.addrWeights = list()
+        total = 0
+        for i in range(numAddrs):
+            total = total + 1.0 / (i + 1)
+            self.addrWeights.append(total)
+
+        self.counter = 0
+
+    # read the header blocks, the packet template and the RSSI distribution
+    # from the seed capture (little endian, as written by wireshark)
+    def loadSeed(self, fname):
+        with open(fname, 'rb') as inFile:
+            data = inFile.read()
+
+        self.header = bytearray()
+        self.template = None
+        pos = 0
+        while pos + 12 <= len(data) and self.template is None:
+            btype, blen = struct.unpack_from('<II', data, pos)
+            if btype == PCAPNG_EPB:
+                # an advertising packet with room for a scan request payload
+                p = pos + 28
+                ble = p + NORDIC_HDR_LEN + data[p + NORDIC_HDR_LEN]
+                capLen, = struct.unpack_from('<I', data, pos + 20)
+                if (data[ble + 4] & 0x0f) == BLE_ADV_IND and ble + 18 <= p + capLen:
+                    self.template = bytearray(data[pos:pos+blen])
+            else:
+                self.header = self.header + data[pos:pos+blen]
+            pos = pos + blen
+
+        if self.template is None:
+            raise ValueError(fname + ": no advertising packet to use as a template")
+
+        self.rssi = dict([(ch, list()) for ch in BTLE_ADV_CHANNELS])
+        records = readPcapngFile(fname)
+        for record in records:
+            if record[5] and record[2] == '' and record[1] in self.rssi:
+                self.rssi[record[1]].append(record[4])
+        self.t0 = records[0][BTLE_EPOCH]
+
+    def makeAddr(self):
+        addr = bytes([self.rng.randrange(256) for i in range(6)])
+        return (':'.join('%02x' % b for b in reversed(addr)), addr)
+
+    # yield num packets (forever if num is None) as (time, channel, scan 
+    # addr, adv addr, rssi, crc ok) with the time in integer microseconds, 
+    # the addresses as (string, bytes) and the rest in the same formats as the
+    # decoder records.  The packets start at the time of the seed capture 
+    # unless the epoch time t0 is given.
+    def getPackets(self, num, t0=None):
+        rng = self.rng
+        t = round((self.t0 if t0 is None else t0) * 1000000)
+        for i in (range(num) if num is not None else itertools.count()):
+            ch = BTLE_ADV_CHANNELS[i % 3]
+            if i % 3 == 0:
+                t = t + BTLE_EVENT_GAP + round(rng.expovariate(self.rate / 3) * 1000000)
+                advAddr = self.advAddrs[bisect.bisect(self.addrWeights, rng.random() * self.addrWeights[-1])]
+            else:
+                t = t + BTLE_EVENT_GAP
+
+            scanAddr = ('', None)
+            if rng.random() < self.scanRatio:
+                scanAddr = rng.choice(self.scanAddrs)
+            crcOk = 0 if rng.random() < self.crcFailRatio else 1
+
+            yield (t, ch, scanAddr, advAddr, rng.choice(self.rssi[ch]), crcOk)
+
+    # format a packet as a btle_sniffer.out row (tshark fields, no newline)
+    def makeOutRow(self, packet):
+        t, ch, scanAddr, advAddr, rssi, crcOk = packet
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t // 1000000)) + '.%06d' % (t % 1000000)
+        return ','.join((timestamp, ch, scanAddr[0], advAddr[0], rssi, str(crcOk)))
+
+    # return the pcapng enhanced packet block for a packet, made from the
+    # template with the time, counter, flags, channel, RSSI, PDU type and
+    # addresses filled in
+    def makeEpb(self, packet):
+        t, ch, scanAddr, advAddr, rssi, crcOk = packet
+        block = self.template
+        struct.pack_into('<II', block, 12, t >> 32, t & 0xffffffff)
+
+        p = 28
+        struct.pack_into('<H', block, p + NORDIC_PKT_COUNTER, self.counter)
+        self.counter = (self.counter + 1) & 0xffff
+        block[p + NORDIC_FLAGS] = (block[p + NORDIC_FLAGS] & ~NORDIC_FLAG_CRCOK) | crcOk
+        block[p + NORDIC_CHANNEL] = int(ch)
+        block[p + NORDIC_RSSI] = -int(rssi)
+
+        ble = p + NORDIC_HDR_LEN + block[p + NORDIC_HDR_LEN]
+        if scanAddr[1] is not None:
+            block[ble + 4] = (block[ble + 4] & 0xf0) | BLE_SCAN_REQ
+            block[ble + 6:ble + 12] = scanAddr[1]
+            block[ble + 12:ble + 18] = advAddr[1]
+        else:
+            block[ble + 4] = (block[ble + 4] & 0xf0) | BLE_ADV_IND
+            block[ble + 6:ble + 12] = advAddr[1]
+        return bytes(block)
+
+    # write num packets as a pcapng capture
+    def writePcapng(self, fname, num):
+        with open(fname, 'wb') as outFile:
+            outFile.write(self.header)
+            for packet in self.getPackets(num):
+                outFile.write(self.makeEpb(packet))
+
+    # write num packets as a btle_sniffer.out file.  Like the real file the
+    # first and the last lines are not used by generateDataFile, so they are
+    # padding here.
+    def writeOutFile(self, fname, num):
+        with open(fname, 'w') as outFile:
+            outFile.write('garbage line\n')
+            for packet in self.getPackets(num):
+                outFile.write(self.makeOutRow(packet) + '\n')
+            outFile.write('garbage line\n')
+
+    # Write a pcapng capture in real time, starting now (or at the epoch 
+    # time t0), like wireshark does while capturing, for duration seconds (0
+    # until killed).  If channel is given only the packets on that channel 
+    # are written, like a sniffer pinned to it; the advertising events are 
+    # the same as without it.
+    def writeLive(self, fname, duration=0, channel=None, t0=None):
+        if t0 is None:
+            t0 = time.time()
+        with open(fname, 'wb') as outFile:
+            outFile.write(self.header)
+            outFile.flush()
+            for packet in self.getPackets(None, t0):
+                if channel is not None and packet[1] != channel:
+                    continue
+                t = packet[0] / 1000000
+                if duration > 0 and t - t0 > duration:
+                    break
+                delay = t - time.time()
+                if delay > 0:
+                    outFile.flush()
+                    time.sleep(delay)
+                outFile.write(self.makeEpb(packet))
+
+    # write the same num packets as both a pcapng capture and a
+    # btle_sniffer.out file
+    def writeFiles(self, pcapngName, outName, num):
+        with open(pcapngName, 'wb') as pcapngFile, open(outName, 'w') as outFile:
+            pcapngFile.write(self.header)
+            outFile.write('garbage line\n')
+            for packet in self.getPackets(num):
+                pcapngFile.write(self.makeEpb(packet))
+                outFile.write(self.makeOutRow(packet) + '\n')
+            outFile.write('garbage line\n')
+
+# Check that the decoder gives back the rows of the generated btle_sniffer.out
+# for the generated pcapng.  Returns the number of mismatches found.
+def checkTrafficGen(num=20000, pcapngName='btle_gen_check.pcapng', outName='btle_gen_check.out'):
+    gen = BtleTrafficGen()
+    gen.writeFiles(pcapngName, outName, num)
+
+    mismatches = 0
+    records = readPcapngFile(pcapngName)
+    with open(outName, 'r') as inFile:
+        rows = inFile.read().splitlines()[1:-1]
+    if len(records) != len(rows):
+        print("Decoded " + str(len(records)) + " packets, expected " + str(len(rows)))
+        mismatches = mismatches + 1
+    for record, row in zip(records, rows):
+        if ','.join(record[:5]) + ',' + str(record[5]) != row:
+            print("Mismatch: ", record, row)
+            mismatches = mismatches + 1
+
+    os.remove(pcapngName)
+    os.remove(outName)
+    print("Checked " + str(num) + " generated packets, " + str(mismatches) + " mismatches")
+    return mismatches
+
+# print usage info
+def usage():
+    print("\nDescription: generate synthetic Nordic BLE sniffer traffic as a pcapng capture and/or a btle_sniffer.out file.\n")
+    print("\nUsage:\n")
+    print(" ",__file__, " [-h] [-n num] [-r rate] [-a num_addrs] [-c crc_fail_ratio] [-s scan_ratio] [-S seed] [-p out.pcapng] [-o out_file] [-L live.pcapng] [-d duration] [-C channel] [-T start] [seed_capture]\n")
+    print("     -h: help\n")
+    print("     -n num: number of packets (default 100000)")
+    print("     -r rate: average packets/s (default 300)")
+    print("     -a num_addrs: number of advertising addresses (default 20)")
+    print("     -c crc_fail_ratio: fraction of packets with a bad CRC (default 0.02)")
+    print("     -s scan_ratio: fraction of packets that are scan requests (default 0.05)")
+    print("     -S seed: random seed (default 1)")
+    print("     -p out.pcapng: pcapng capture to write")
+    print("     -o out_file: btle_sniffer.out file to write")
+    print("     -L live.pcapng: write a pcapng capture in real time like a running sniffer (a fake sniffer for testing)")
+    print("     -d duration: stop the live capture after duration seconds (default 0, until killed)")
+    print("     -C channel: only write the packets on advertising channel 37, 38 or 39 to the live capture")
+    print("     -T start: epoch time of the start of the live capture (default now)")
+    print("     seed_capture: real capture to take the packet format and RSSI from (default " + SEED_CAPTURE + ")")
+    print("\n")
+
+# main function for command line entry point
+def main(argv):
+    num = 100000
+    rate = 300
+    numAddrs = 20
+    crcFailRatio = 0.02
+    scanRatio = 0.05
+    seed = 1
+    pcapngName = None
+    outName = None
+    liveName = None
+    duration = 0
+    channel = None
+    start = None
+
+    # grab command line args
+    try:
+        opts, args = getopt.getopt(argv,"hn:r:a:c:s:S:p:o:L:d:C:T:",["num=","rate=","addrs=","crc=","scan=","seed=","pcapng=","out=","live=","duration=","channel=","start="])
+    except getopt.GetoptError:
+        usage()
+        return 1
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            return 0
+        elif opt in ("-n", "--num"):
+            num = int(float(arg))
+        elif opt in ("-r", "--rate"):
+            rate = float(arg)
+        elif opt in ("-a", "--addrs"):
+            numAddrs = int(arg)
+        elif opt in ("-c", "--crc"):
+            crcFailRatio = float(arg)
+        elif opt in ("-s", "--scan"):
+            scanRatio = float(arg)
+        elif opt in ("-S", "--seed"):
+            seed = int(arg)
+        elif opt in ("-p", "--pcapng"):
+            pcapngName = arg
+        elif opt in ("-o", "--out"):
+            outName = arg
+        elif opt in ("-L", "--live"):
+            liveName = arg
+        elif opt in ("-d", "--duration"):
+            duration = float(arg)
+        elif opt in ("-C", "--channel"):
+            channel = arg
+        elif opt in ("-T", "--start"):
+            start = float(arg)
+
+    if pcapngName is None and outName is None and liveName is None:
+        usage()
+        return 1
+
+    seedFile = args[0] if args else SEED_CAPTURE
+    gen = BtleTrafficGen(seedFile, rate, numAddrs, crcFailRatio, scanRatio, seed)
+
+    if liveName is not None:
+        gen.writeLive(liveName, duration, channel, start)
+        return 0
+
+    start = time.perf_counter()
+    if pcapngName is not None and outName is not None:
+        gen.writeFiles(pcapngName, outName, num)
+    elif pcapngName is not None:
+        gen.writePcapng(pcapngName, num)
+    else:
+        gen.writeOutFile(outName, num)
+    print("Generated " + str(num) + " packets in {:3.2f} s".format(time.perf_counter() - start))
+
+    return 0
+
+# callable from command line
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
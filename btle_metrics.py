@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import time
+import json
+import getopt
+import threading
+import collections
+
+# Count, total and max of a duration (or any other value), plus the last
+# 1000 values for the recent average and max.
+class BtleTimer:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = collections.deque(maxlen=1000)
+
+    def add(self, value):
+        self.count = self.count + 1
+        self.total = self.total + value
+        if value > self.max:
+            self.max = value
+        self.recent.append(value)
+
+    def getStats(self):
+        recent = list(self.recent)
+        return {'count': self.count, 'avg': self.total / self.count if self.count else 0.0, 'max': self.max,
+                'recentAvg': sum(recent) / len(recent) if recent else 0.0,
+                'recentMax': max(recent) if recent else 0.0}
+
+# Named counters and timers for the hot paths.  Each counter or timer is only
+# updated from one thread (e.g. the row counters by whichever thread adds
+# packets to the index) so they are not locked; readers take a copy.
+class BtleMetrics:
+    def __init__(self):
+        self.counters = collections.defaultdict(int)
+        self.timers = collections.defaultdict(BtleTimer)
+        self.startTime = time.time()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters[name] + n
+
+    def addTime(self, name, value):
+        self.timers[name].add(value)
+
+    # time the code in a with block, e.g. with metrics.timed('draw'):
+    def timed(self, name):
+        return BtleTimed(self, name)
+
+    def getCounter(self, name):
+        return self.counters.get(name, 0)
+
+    def getTimer(self, name):
+        return self.timers.get(name)
+
+    # return the counters and timer stats as a dict that can be written as JSON
+    def getSnapshot(self):
+        return {'uptime': time.time() - self.startTime,
+                'counters': dict(self.counters),
+                'timers': dict([(name, timer.getStats()) for name, timer in list(self.timers.items())])}
+
+class BtleTimed:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.addTime(self.name, time.perf_counter() - self.start)
+        return False
+
+# Appends a JSON line with the metrics to a log file every interval seconds
+# (and once more when stopped).  getExtra returns a dict of other stats to
+# add to each line, e.g. the tee and pipeline stage counters.
+class BtleMetricsLog:
+    def __init__(self, fname, metrics, interval=10, getExtra=None):
+        self.fname = fname
+        self.metrics = metrics
+        self.interval = interval
+        self.getExtra = getExtra
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopEvent.set()
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        with open(self.fname, 'a') as logFile:
+            while not self.stopEvent.wait(self.interval):
+                self.writeLine(logFile)
+            self.writeLine(logFile)
+
+    def writeLine(self, logFile):
+        line = self.metrics.getSnapshot()
+        line['time'] = time.time()
+        if self.getExtra is not None:
+            line.update(self.getExtra())
+        logFile.write(json.dumps(line) + '\n')
+        logFile.flush()
+
+# Sampling profiler for a whole capture session.  A thread takes the stack of
+# every other thread every interval seconds and counts each distinct stack,
+# so the cost does not depend on how many calls the code makes (unlike
+# cProfile) and it can stay on for long captures.  The result is written in
+# the folded stack format used by flame graph tools, one line per stack:
+#
+#   thread;outer function;...;inner function count
+class BtleSampler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopEvent.set()
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        myId = threading.get_ident()
+        while not self.stopEvent.wait(self.interval):
+            names = dict([(t.ident, t.name) for t in threading.enumerate()])
+            for ident, frame in sys._current_frames().items():
+                if ident == myId:
+                    continue
+                stack = list()
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(code.co_name + ' (' + os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + ')')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    # Return (function, samples) for the functions at the top of the most
+    # stacks.  If module is given the innermost function from a file whose 
+    # name starts with module is used instead, so time spent in library calls
+    # and waits is put down to the code that made them.
+    def getTop(self, num=15, module=None):
+        top = collections.Counter()
+        for stack, count in self.stacks.items():
+            names = stack.split(';')[1:]
+            if module is not None:
+                names = [name for name in names if name.split(' (', 1)[-1].startswith(module)]
+            if names:
+                top[names[-1]] += count
+        return top.most_common(num)
+
+    def write(self, fname):
+        with open(fname, 'w') as outFile:
+            for stack, count in self.stacks.most_common():
+                outFile.write(stack + ' ' + str(count) + '\n')
+
+    def report(self, num=15):
+        total = sum(self.stacks.values())
+        print('Profiler: ' + str(total) + ' thread stacks sampled every {:3.1f} ms'.format(self.interval*1000))
+        for title, module in (('top functions:', None), ('top btle_* functions:', 'btle_')):
+            print('  ' + title)
+            for name, count in self.getTop(num, module):
+                print('   {:5.1f}%  {}'.format(100.0*count/total if total else 0, name))
+
+# Print a summary of a metrics log: the last value of each counter and the
+# average and max of each timer over the session.
+def summarizeLog(fname):
+    last = None
+    with open(fname, 'r') as logFile:
+        for line in logFile:
+            if line.strip():
+                last = json.loads(line)
+
+    if last is None:
+        print(fname + ": empty log")
+        return
+
+    print(fname + ": {:3.0f} s".format(last['uptime']))
+    for name in sorted(last['counters']):
+        print('   {:<28} {}'.format(name, last['counters'][name]))
+    for name in sorted(last['timers']):
+        stats = last['timers'][name]
+        print('   {:<28} {:8} x avg {:8.3f} ms  max {:8.3f} ms'.format(name, stats['count'], stats['avg']*1000, stats['max']*1000))
+
+# print usage info
+def usage():
+    print("\nDescription: summarize btle_sniffer metrics logs (-M) or show the top functions of a profile (-P).\n")
+    print("\nUsage:\n")
+    print(" ",__file__, " [-h] [-p] file ...\n")
+    print("     -h: help\n")
+    print("     -p: the files are folded stack profiles instead of metrics logs")
+    print("\n")
+
+# main function for command line entry point
+def main(argv):
+    profiles = False
+
+    # grab command line args
+    try:
+        opts, args = getopt.getopt(argv,"hp",["profile"])
+    except getopt.GetoptError:
+        usage()
+        return 1
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            return 0
+        elif opt in ("-p", "--profile"):
+            profiles = True
+
+    if not args:
+        usage()
+        return 1
+
+    for fname in args:
+        if not profiles:
+            summarizeLog(fname)
+            continue
+
+        sampler = BtleSampler()
+        with open(fname, 'r') as inFile:
+            for line in inFile:
+                stack, count = line.rstrip('\n').rsplit(' ', 1)
+                sampler.stacks[stack] += int(count)
+        print(fname + ":")
+        sampler.report()
+
+    return 0
+
+# callable from command line
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
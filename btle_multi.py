@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import time
+import math
+import heapq
+import getopt
+import threading
+import collections
+
+from btle_pcapng import iterPcapngFile, iterPcapngData, iterFileChunks, readPcapngHeader, BTLE_EPOCH
+from btle_data import BTLE_CH, BTLE_ADV_ADDR, BTLE_RSSI
+import btle_ssh
+
+# sniffer board on the sniffer host
+PI_DEVICE = "/dev/ttyACM0"
+
+# wireshark option that pins the nRF Sniffer to one advertising channel (the
+# "Adv Hop" setting of the nRF Sniffer toolbar), by default it hops over all
+# three like the advertisers
+PI_ADV_CHANNEL_OPTION = "-o extcap.nrf_sniffer_ble.advhop:{}"
+
+# One nRF52 sniffer: the connection to its host, the board and the advertising
+# channel it is pinned to (None to follow the advertisers).  captureFile is
+# the capture file wireshark writes on the host, None to use the default
+# (BtleSniffer picks a different one for each board).  The rest is the state
+# of the running capture, set up by BtleSniffer.
+class BtleEndpoint:
+    def __init__(self, session=None, device=PI_DEVICE, channel=None, captureFile=None, name=None):
+        self.session = session
+        self.device = device
+        self.channel = channel
+        self.captureFile = captureFile
+        self.name = name if name is not None else os.path.basename(device)
+
+        # index in the merge and the local copy of the stream
+        self.idx = 0
+        self.bufName = 'buf.pcapng'
+
+        self.process = None
+        self.streamProcess = None
+        self.tee = None
+        self.decoder = None
+        self.decodeStage = None
+        self.offChannel = 0
+
+        # compressed copy of the stream (BtlePcapngArchive) and its stage
+        self.archive = None
+        self.archiveStage = None
+
+        # times the stream was resumed after dropping, and the stream offset
+        # it was last resumed at
+        self.reconnects = 0
+        self.checkpoint = 0
+
+        # pid (and process group) of the capture on the host when it runs 
+        # detached from the ssh session, see getDetachedCaptureCmd
+        self.capturePid = None
+
+    # Decode the local copy of the stream, or its first length bytes, and 
+    # return the records as an iterator.  If the stream is compressed the 
+    # archive is the copy, once its stage has caught up with length (or 
+    # timeout seconds have passed).
+    def iterCapture(self, length=None, timeout=10):
+        if self.archive is None:
+            return iterPcapngFile(self.bufName, length)
+        self.waitForArchive(length, timeout)
+        return iterPcapngData(self.archive.iterData(0, length))
+
+    # Return the header blocks of the local copy of the stream and an 
+    # iterator over the bytes between the stream offsets start and end, in 
+    # chunks, so a long part of the stream isn't read into memory at once
+    def readCapture(self, start, end, timeout=10):
+        if self.archive is None:
+            with open(self.bufName, 'rb') as inFile:
+                header = readPcapngHeader(inFile)
+            return header, iterFileRange(self.bufName, start, end)
+        self.waitForArchive(end, timeout)
+        return self.archive.getHeader(), self.archive.iterData(start, end)
+
+    # wait for the archive stage to write the stream up to offset
+    def waitForArchive(self, offset, timeout):
+        if offset is not None and not self.archive.waitFor(offset, timeout):
+            print("Archive of " + self.name + " is behind the stream, reading the " + str(self.archive.bytesIn) + 
+                  " bytes it has")
+
+    def getSession(self):
+        return self.session if self.session is not None else btle_ssh.getSession()
+
+    # return the command that sets up the host for capturing, None if there
+    # is nothing to set up
+    def getInitCmd(self):
+        return btle_ssh.getInitCmd()
+
+    # return the command that captures to captureFile on the host
+    def getCaptureCmd(self):
+        cmd = "wireshark -i " + self.device + " -k -w " + self.captureFile
+        if self.channel is not None:
+            cmd = cmd + " " + PI_ADV_CHANNEL_OPTION.format(self.channel)
+        return cmd
+
+    # Return the command that starts the capture on the host in the 
+    # background, detached from the ssh session so it keeps capturing if the
+    # session drops, and prints its pid.  wireshark gets a virtual display 
+    # (xvfb-run) as the forwarded one would go with the session.
+    def getDetachedCaptureCmd(self):
+        return getDetachCmd("xvfb-run -a " + self.getCaptureCmd())
+
+    # return the command that waits on the host for the detached capture to
+    # exit, polling it every second
+    def getWatchCmd(self):
+        return "while kill -0 " + str(self.capturePid) + " 2> /dev/null; do sleep 1; done"
+
+    # return the command that stops the detached capture (its whole process
+    # group, wireshark and its display), which succeeds if it has exited 
+    # already
+    def getStopCmd(self):
+        return "kill -- -" + str(self.capturePid) + " 2> /dev/null || ! kill -0 " + str(self.capturePid) + " 2> /dev/null"
+
+    # return a dict of the per sniffer counters
+    def getStats(self):
+        stats = {'name': self.name, 'channel': self.channel, 'offChannel': self.offChannel,
+                 'reconnects': self.reconnects, 'checkpoint': self.checkpoint}
+        if self.tee is not None:
+            stats['bytesIn'] = self.tee.bytesIn
+            stats['bytesPerSec'] = self.tee.bytesPerSec
+        if self.decoder is not None:
+            stats['packets'] = self.decoder.packets
+            stats['lost'] = self.decoder.lost
+            stats['badRssi'] = self.decoder.badRssi
+        return stats
+
+    def report(self):
+        stats = self.getStats()
+        print('Sniffer {} (ch {}): {:3.1f} kB/s, {} bytes, {} packets, {} lost by the sniffer, {} bad RSSI, {} off channel, {} reconnects'.format(
+              self.name, self.channel if self.channel is not None else 'all', stats.get('bytesPerSec', 0)/1000,
+              stats.get('bytesIn', 0), stats.get('packets', 0), stats.get('lost', 0), stats.get('badRssi', 0), self.offChannel, 
+              self.reconnects))
+
+# Fake sniffer for testing without the dongles.  The capture is generated on
+# this machine by btle_gen.py in real time, so the rest of the capture path 
+# (the capture file, tail and the stream) runs as it would with the real 
+# thing.  Fake sniffers with the same seed see the same advertisers and 
+# advertising events at the same times, they all start on the next whole 
+# second after the next one.
+class BtleGenEndpoint(BtleEndpoint):
+    def __init__(self, channel=None, captureFile=None, name=None, rate=300, seed=1):
+        if name is None:
+            name = 'gen' + (channel if channel is not None else '')
+        if captureFile is None:
+            captureFile = os.path.abspath('btle_gen_' + name + '.pcapng')
+        BtleEndpoint.__init__(self, btle_ssh.BtleLocalSession(), 'btle_gen', channel, captureFile, name)
+        self.rate = rate
+        self.seed = seed
+
+    def getInitCmd(self):
+        return None
+
+    def getCaptureCmd(self):
+        return "exec " + self.getGenCmd()
+
+    def getDetachedCaptureCmd(self):
+        return getDetachCmd(self.getGenCmd())
+
+    def getGenCmd(self):
+        cmd = sys.executable + " " + os.path.join(os.path.dirname(os.path.abspath(__file__)), 'btle_gen.py')
+        cmd = cmd + " -L " + self.captureFile + " -r " + str(self.rate) + " -S " + str(self.seed)
+        cmd = cmd + " -T " + str(math.ceil(time.time()) + 1)
+        if self.channel is not None:
+            cmd = cmd + " -C " + self.channel
+        return cmd
+
+# return the shell command that runs cmd in the background in a session of
+# its own, so it isn't hung up when the ssh session ends, and prints its pid
+def getDetachCmd(cmd):
+    return "setsid nohup " + cmd + " > /dev/null 2>&1 < /dev/null & echo $!"
+
+# Return the endpoint for a command line argument "[host][:device[:channel]]",
+# e.g. "ubuntu@pi_sniffer:/dev/ttyACM1:38".  A missing host uses the shared
+# session (or session if given, e.g. a BtleLocalSession) and the host "gen"
+# makes fake sniffer number idx (the device is ignored).
+def parseEndpoint(arg, session=None, idx=0):
+    parts = arg.split(':')
+    host = parts[0]
+    device = parts[1] if len(parts) > 1 and parts[1] != "" else PI_DEVICE
+    channel = parts[2] if len(parts) > 2 and parts[2] != "" else None
+    if channel is not None and channel not in ("37", "38", "39"):
+        raise ValueError("Bad advertising channel " + channel + " in " + arg)
+
+    if host == "gen":
+        return BtleGenEndpoint(channel, name='gen' + str(idx))
+    if host != "" and session is None:
+        session = btle_ssh.BtleSshSession(host)
+    return BtleEndpoint(session, device, channel)
+
+# Merges the record streams of several sniffers into one time ordered stream.
+# Each sniffer's records arrive in time order, in batches, but the sniffers
+# don't keep up with each other.  Records wait in a queue per sniffer and a
+# k-way merge (a heap of the queue heads) releases them in time order up to a
+# watermark: the newest time every sniffer has got to, so no sniffer can
+# still send an older record.  A sniffer that goes quiet (nothing on its
+# channel, or its stream stalled) would hold the rest back, so the watermark
+# is never more than skew seconds behind the newest record.  Records from a
+# sniffer more than skew behind arrive after the watermark has passed them;
+# they are passed on straight away and counted as late.
+class BtleMerger:
+    def __init__(self, numSources, skew=2.0):
+        self.skew = skew
+        self.pending = [collections.deque() for i in range(numSources)]
+        self.heads = list()
+        self.newest = [None] * numSources
+        self.watermark = float('-inf')
+        self.lock = threading.Lock()
+
+        # counters
+        self.packets = [0] * numSources
+        self.late = [0] * numSources
+        self.released = 0
+        self.peakPending = 0
+
+    # add a batch of records from source idx and return the records released
+    # by it in time order
+    def add(self, idx, records):
+        with self.lock:
+            out = list()
+            queue = self.pending[idx]
+            for record in records:
+                if record[BTLE_EPOCH] < self.watermark:
+                    self.late[idx] = self.late[idx] + 1
+                    out.append(record)
+                    continue
+                if not queue:
+                    heapq.heappush(self.heads, (record[BTLE_EPOCH], idx))
+                queue.append(record)
+
+            self.packets[idx] = self.packets[idx] + len(records)
+            if records and (self.newest[idx] is None or records[-1][BTLE_EPOCH] > self.newest[idx]):
+                self.newest[idx] = records[-1][BTLE_EPOCH]
+            self.peakPending = max(self.peakPending, sum(len(q) for q in self.pending))
+
+            seen = [t for t in self.newest if t is not None]
+            if seen:
+                slowest = min(seen) if len(seen) == len(self.newest) else float('-inf')
+                self.watermark = max(self.watermark, slowest, max(seen) - self.skew)
+            self.release(self.watermark, out)
+            return out
+
+    # release all the records still waiting, once the streams have ended
+    def flush(self):
+        with self.lock:
+            out = list()
+            self.release(float('inf'), out)
+            return out
+
+    def release(self, watermark, out):
+        heads = self.heads
+        while heads and heads[0][0] <= watermark:
+            epoch, idx = heapq.heappop(heads)
+            queue = self.pending[idx]
+            out.append(queue.popleft())
+            if queue:
+                heapq.heappush(heads, (queue[0][BTLE_EPOCH], idx))
+        self.released = self.released + len(out)
+
+    # return a dict of the current counters
+    def getStats(self):
+        return {'skew': self.skew, 'packets': list(self.packets), 'late': list(self.late), 'released': self.released,
+                'pending': [len(q) for q in self.pending], 'peakPending': self.peakPending}
+
+    def report(self):
+        print('Merge: {} released, pending {} (peak {}), late {}'.format(
+              self.released, [len(q) for q in self.pending], self.peakPending, self.late))
+
+# Drops packets seen before, e.g. the same packet captured by two sniffers
+# that are not pinned to different channels, or the same part of a stream fed
+# again.  A packet is a duplicate of an earlier one with the same address, 
+# channel and RSSI whose time is at most tolerance seconds away (exactly the
+# same time if tolerance is 0; sniffers on the same host have timestamps a
+# few ms apart).  The packets seen in the last window seconds (of packet 
+# time) are kept in a dict, older ones are evicted as newer ones come in, and
+# never more than maxKeys, so the memory used doesn't grow with the length of
+# the capture.  With a tolerance the times are put in buckets of tolerance 
+# seconds and the bucket either side is checked too.
+class BtleDedup:
+    def __init__(self, window=10.0, tolerance=0.0, maxKeys=1000000):
+        self.window = window
+        self.tolerance = tolerance
+        self.maxKeys = maxKeys
+        self.reset()
+
+    def reset(self):
+        self.keys = dict()
+        self.order = collections.deque()
+        self.newest = float('-inf')
+
+        # counters
+        self.packets = 0
+        self.removed = 0
+        self.peakKeys = 0
+
+    # return True if the packet is a duplicate, otherwise remember it
+    def isDuplicate(self, t, addr, ch, rssi):
+        self.packets = self.packets + 1
+        keys = self.keys
+        if self.tolerance > 0:
+            bucket = int(t // self.tolerance)
+            for b in (bucket, bucket - 1, bucket + 1):
+                seen = keys.get((b, addr, ch, rssi))
+                if seen is not None and abs(seen - t) <= self.tolerance:
+                    self.removed = self.removed + 1
+                    return True
+            key = (bucket, addr, ch, rssi)
+        else:
+            key = (t, addr, ch, rssi)
+            if key in keys:
+                self.removed = self.removed + 1
+                return True
+
+        keys[key] = t
+        self.order.append((t, key))
+        if t > self.newest:
+            self.newest = t
+        self.evict()
+        return False
+
+    # forget the packets from before the window
+    def evict(self):
+        order = self.order
+        keys = self.keys
+        limit = self.newest - self.window
+        if len(order) > self.peakKeys:
+            self.peakKeys = len(order)
+        while order and (order[0][0] < limit or len(order) > self.maxKeys):
+            t, key = order.popleft()
+            if keys.get(key) == t:
+                del keys[key]
+
+    # return the records that are not duplicates, without a tolerance the
+    # batch is checked in line and the window is only evicted at the end
+    def filter(self, records):
+        if self.tolerance > 0:
+            return [data for data in records if not self.isDuplicate(data[BTLE_EPOCH], data[BTLE_ADV_ADDR], data[BTLE_CH], data[BTLE_RSSI])]
+
+        keys = self.keys
+        order = self.order
+        out = list()
+        for data in records:
+            t = data[BTLE_EPOCH]
+            key = (t, data[BTLE_ADV_ADDR], data[BTLE_CH], data[BTLE_RSSI])
+            if key in keys:
+                continue
+            keys[key] = t
+            order.append((t, key))
+            out.append(data)
+            if t > self.newest:
+                self.newest = t
+
+        self.packets = self.packets + len(records)
+        self.removed = self.removed + len(records) - len(out)
+        self.evict()
+        return out
+
+    # return a dict of the current counters
+    def getStats(self):
+        return {'window': self.window, 'tolerance': self.tolerance, 'packets': self.packets, 'removed': self.removed,
+                'keys': len(self.keys), 'peakKeys': self.peakKeys}
+
+    def report(self):
+        print('Dedup: {} duplicates removed of {} packets, {} in the window (peak {})'.format(
+              self.removed, self.packets, len(self.keys), self.peakKeys))
+
+# Decode the packets of several pcapng captures (the first length bytes of
+# each if lengths is given) and yield them merged in time order.  The
+# captures are only read a chunk at a time.
+def iterMergedCaptures(fnames, lengths=None):
+    if lengths is None:
+        lengths = [None] * len(fnames)
+    yield from mergeRecords([iterPcapngFile(fname, length) for fname, length in zip(fnames, lengths)])
+
+# merge the records of several captures, each in time order, into one time
+# ordered stream
+def mergeRecords(iters):
+    return heapq.merge(*iters, key=lambda record: record[BTLE_EPOCH])
+
+# yield the bytes of a file between the offsets start and end, in chunks
+def iterFileRange(fname, start, end):
+    with open(fname, 'rb') as inFile:
+        inFile.seek(start)
+        yield from iterFileChunks(inFile, end - start)
+
+# print usage info
+def usage():
+    print("\nDescription: merge pcapng captures from several sniffers into one time ordered data stream.\n")
+    print("\nUsage:\n")
+    print(" ",__file__, " [-h] [-o out_file] capture.pcapng ...\n")
+    print("     -h: help\n")
+    print("     -o out_file: write the merged packets as tshark style rows (default prints the count per channel)")
+    print("\n")
+
+# main function for command line entry point
+def main(argv):
+    outName = None
+
+    # grab command line args
+    try:
+        opts, args = getopt.getopt(argv,"ho:",["out="])
+    except getopt.GetoptError:
+        usage()
+        return 1
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            return 0
+        elif opt in ("-o", "--out"):
+            outName = arg
+
+    if not args:
+        usage()
+        return 1
+
+    counts = collections.Counter()
+    outFile = open(outName, 'w') if outName is not None else None
+    for record in iterMergedCaptures(args):
+        counts[record[1]] += 1
+        if outFile is not None:
+            outFile.write(','.join(record[:5]) + ',' + str(record[5]) + '\n')
+    if outFile is not None:
+        outFile.close()
+
+    for ch in sorted(counts):
+        print("Ch " + ch + ": " + str(counts[ch]) + " packets")
+    return 0
+
+# callable from command line
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
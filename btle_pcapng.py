@@ -0,0 +1,903 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import time
+import io
+import gzip
+import zlib
+import bisect
+import struct
+import threading
+import getopt
+import shutil
+import subprocess
+
+# pcapng block types
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BOM = 0x1A2B3C4D
+PCAPNG_BOM_SWAPPED = 0x4D3C2B1A
+
+# largest block expected in a sniffer capture, a longer block length is 
+# taken to mean the stream is corrupt
+PCAPNG_MAX_BLOCK = 65536
+
+# link type written by the Nordic nRF Sniffer extcap
+LINKTYPE_NORDIC_BLE = 272
+
+# Nordic sniffer packet ids for received packets (v1/v2 use EVENT_PACKET,
+# v3 splits it into advertising and data PDUs)
+NORDIC_EVENT_PACKET_ADV_PDU = 0x02
+NORDIC_EVENT_PACKET = 0x06
+
+# offsets into the Nordic BLE pseudo header.  The board id is followed by
+# the UART header (payload length, protocol version, packet counter, packet
+# id) and then the packet header (header length, flags, channel, RSSI, event
+# counter, timestamp) which is followed by the BLE packet itself.
+NORDIC_PROTO_VER = 3
+NORDIC_PKT_COUNTER = 4
+NORDIC_PKT_ID = 6
+NORDIC_HDR_LEN = 7
+NORDIC_FLAGS = 8
+NORDIC_CHANNEL = 9
+NORDIC_RSSI = 10
+
+NORDIC_FLAG_CRCOK = 0x01
+
+# largest gap in the packet counter that is counted as lost packets
+NORDIC_MAX_LOST = 255
+
+# BLE advertising PDU types
+BLE_ADV_IND = 0
+BLE_ADV_DIRECT_IND = 1
+BLE_ADV_NONCONN_IND = 2
+BLE_SCAN_REQ = 3
+BLE_SCAN_RSP = 4
+BLE_CONNECT_IND = 5
+BLE_ADV_SCAN_IND = 6
+BLE_ADV_EXT_IND = 7
+
+# access address used on the advertising channels
+BLE_ADV_ACCESS_ADDR = 0x8E89BED6
+
+# compressed capture formats (see BtlePcapngArchive), their file extension
+# and default level
+ARCHIVE_CODECS = {'gzip': '.gz', 'zstd': '.zst'}
+ARCHIVE_LEVELS = {'gzip': 6, 'zstd': 3}
+ARCHIVE_INDEX_COLUMNS = ['block', 'offset', 'fileOffset']
+
+# field index of the epoch time in a decoded record, the first 6 fields are
+# the same as the tshark output fields (BTLE_TIME .. BTLE_CRCOK)
+BTLE_EPOCH = 6
+
+# Streaming decoder for a pcapng byte stream captured from the Nordic nRF
+# Sniffer.  Bytes can be fed in chunks of any size; complete blocks are
+# parsed as they arrive and each packet is decoded into a record with the
+# same fields tshark is asked for in runTshark plus the epoch time:
+#
+#   (time, channel, scan addr, adv addr, rssi, crc ok, epoch)
+#
+# time is formatted like tshark's '-t ad' column (local time), channel and
+# rssi are strings as tshark prints them and crc ok is 0 or 1.
+class BtlePcapngDecoder:
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.buf = bytearray()
+        self.pos = 0
+        self.endian = '<'
+        self.interfaces = list()
+
+        # stream offset of the first byte of the buffer, always the start of
+        # a block, and the offset just past the last complete block
+        self.bufOffset = 0
+        self.offset = 0
+
+        # counters
+        self.blocks = 0
+        self.packets = 0
+        self.skipped = 0
+
+        # packets lost between the sniffer board and the capture, found from
+        # gaps in the Nordic packet counter, and jumps in the counter too big
+        # to be lost packets (sniffer restarted or the stream was resynced)
+        self.lastCounter = None
+        self.lost = 0
+        self.resyncs = 0
+
+        # corrupt blocks (bad length or trailer) found in the stream and the
+        # bytes skipped looking for the next good block
+        self.badBlocks = 0
+        self.skippedBytes = 0
+        self.resyncing = False
+
+        # packets dropped for an RSSI byte out of range, the byte is the 
+        # magnitude of the (negative) RSSI so above 128 can't be stored
+        self.badRssi = 0
+
+        # caches for the strings repeated on every packet
+        self.addrCache = dict()
+        self.lastSec = None
+        self.lastPrefix = ''
+        self.chStr = [str(i) for i in range(256)]
+        self.rssiStr = [str(-i) for i in range(129)]
+
+    # drop the bytes after the last complete block, so the stream can be 
+    # resumed at self.offset (e.g. after the connection dropped mid block)
+    def discardPartial(self):
+        del self.buf[self.pos:]
+
+    # tee sink interface, decode the chunk and pass the records to the
+    # callback
+    def write(self, data):
+        records = self.feed(data)
+        if records and self.callback is not None:
+            self.callback(records)
+
+    # add bytes to the stream and return the list of records decoded from
+    # the blocks completed by them
+    def feed(self, data):
+        self.buf += data
+        records = list()
+
+        buf = self.buf
+        pos = self.pos
+        while len(buf) - pos >= 12:
+            btype, blen = struct.unpack_from(self.endian + 'II', buf, pos)
+
+            # the section header sets the byte order for the section
+            if btype == PCAPNG_SHB:
+                bom, = struct.unpack_from('<I', buf, pos + 8)
+                if bom == PCAPNG_BOM or bom == PCAPNG_BOM_SWAPPED:
+                    self.endian = '<' if bom == PCAPNG_BOM else '>'
+                    btype, blen = struct.unpack_from(self.endian + 'II', buf, pos)
+                    self.interfaces = list()
+                else:
+                    blen = 0
+
+            # a corrupt block, skip to the next packet or section header
+            if blen < 12 or blen % 4 != 0 or blen > PCAPNG_MAX_BLOCK:
+                pos = self.resync(buf, pos)
+                continue
+            if len(buf) - pos < blen:
+                break
+            trailer, = struct.unpack_from(self.endian + 'I', buf, pos + blen - 4)
+            if trailer != blen:
+                pos = self.resync(buf, pos)
+                continue
+
+            if btype == PCAPNG_EPB:
+                record = self.decodeEpb(buf, pos, blen)
+                if record is not None:
+                    records.append(record)
+            elif btype == PCAPNG_IDB:
+                self.decodeIdb(buf, pos, blen)
+
+            pos = pos + blen
+            self.blocks = self.blocks + 1
+            self.resyncing = False
+
+        # drop the consumed blocks once they make up most of the buffer
+        if pos > 65536 and pos > len(buf) // 2:
+            del buf[:pos]
+            self.bufOffset = self.bufOffset + pos
+            pos = 0
+        self.pos = pos
+        self.offset = self.bufOffset + pos
+
+        return records
+
+    # Skip the corrupt block at pos, returning the position of the next 
+    # block that looks good (or where to carry on looking once more bytes 
+    # arrive).  A packet counter jump after it is counted as a resync.
+    def resync(self, buf, pos):
+        if not self.resyncing:
+            self.badBlocks = self.badBlocks + 1
+            self.resyncing = True
+            if self.badBlocks <= 10:
+                print('Decoder: corrupt pcapng block at offset ' + str(self.bufOffset + pos) + ', looking for the next block')
+        nextPos = findBlockStart(buf, pos + 1, self.endian)
+        self.skippedBytes = self.skippedBytes + nextPos - pos
+        return nextPos
+
+    # interface description, save the link type and timestamp resolution
+    def decodeIdb(self, buf, pos, blen):
+        linkType, = struct.unpack_from(self.endian + 'H', buf, pos + 8)
+        tsPerSec = 1000000
+
+        # walk the options looking for if_tsresol
+        opt = pos + 16
+        end = pos + blen - 4
+        while opt + 4 <= end:
+            code, length = struct.unpack_from(self.endian + 'HH', buf, opt)
+            if code == 0:
+                break
+            if code == 9 and length == 1:
+                tsresol = buf[opt + 4]
+                if tsresol & 0x80:
+                    tsPerSec = 2 ** (tsresol & 0x7f)
+                else:
+                    tsPerSec = 10 ** tsresol
+            opt = opt + 4 + ((length + 3) & ~3)
+
+        self.interfaces.append((linkType, tsPerSec))
+
+    # format a 6 byte little endian BLE address as tshark does
+    def getAddr(self, buf, pos):
+        key = bytes(buf[pos:pos+6])
+        addr = self.addrCache.get(key)
+        if addr is None:
+            addr = ':'.join('%02x' % b for b in reversed(key))
+            self.addrCache[key] = addr
+        return addr
+
+    # enhanced packet block, decode the Nordic BLE packet
+    def decodeEpb(self, buf, pos, blen):
+        ifId, tsHigh, tsLow, capLen = struct.unpack_from(self.endian + 'IIII', buf, pos + 8)
+        if ifId >= len(self.interfaces) or self.interfaces[ifId][0] != LINKTYPE_NORDIC_BLE:
+            self.skipped = self.skipped + 1
+            return None
+
+        p = pos + 28
+        if capLen < NORDIC_RSSI + 1:
+            self.skipped = self.skipped + 1
+            return None
+
+        # the counter is 16 bits and wraps
+        counter, = struct.unpack_from('<H', buf, p + NORDIC_PKT_COUNTER)
+        if self.lastCounter is not None:
+            gap = (counter - self.lastCounter - 1) & 0xffff
+            if gap > NORDIC_MAX_LOST:
+                self.resyncs = self.resyncs + 1
+            else:
+                self.lost = self.lost + gap
+        self.lastCounter = counter
+
+        pktId = buf[p + NORDIC_PKT_ID]
+        if pktId != NORDIC_EVENT_PACKET and not (pktId == NORDIC_EVENT_PACKET_ADV_PDU and buf[p + NORDIC_PROTO_VER] >= 3):
+            self.skipped = self.skipped + 1
+            return None
+
+        rssi = buf[p + NORDIC_RSSI]
+        if rssi >= len(self.rssiStr):
+            self.badRssi = self.badRssi + 1
+            return None
+
+        self.packets = self.packets + 1
+
+        # timestamp, converted to microseconds
+        tsPerSec = self.interfaces[ifId][1]
+        ts = (tsHigh << 32) | tsLow
+        if tsPerSec != 1000000:
+            ts = ts * 1000000 // tsPerSec
+        sec = ts // 1000000
+        usec = ts % 1000000
+        if sec != self.lastSec:
+            self.lastSec = sec
+            self.lastPrefix = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sec))
+        timestamp = self.lastPrefix + '.%06d' % usec
+
+        flags = buf[p + NORDIC_FLAGS]
+        channel = buf[p + NORDIC_CHANNEL]
+
+        # BLE packet: access address, PDU header, length and the payload
+        scanAddr = ''
+        advAddr = ''
+        ble = p + NORDIC_HDR_LEN + buf[p + NORDIC_HDR_LEN]
+        end = p + capLen
+        if ble + 6 <= end:
+            accessAddr, = struct.unpack_from('<I', buf, ble)
+            pduType = buf[ble + 4] & 0x0f
+            payload = ble + 6
+            if accessAddr == BLE_ADV_ACCESS_ADDR:
+                if pduType in (BLE_SCAN_REQ, BLE_CONNECT_IND):
+                    # ScanA/InitA first, then AdvA
+                    if payload + 12 <= end:
+                        if pduType == BLE_SCAN_REQ:
+                            scanAddr = self.getAddr(buf, payload)
+                        advAddr = self.getAddr(buf, payload + 6)
+                elif pduType == BLE_ADV_EXT_IND:
+                    # AdvA is only there if flagged in the extended header
+                    if payload + 8 <= end and (buf[payload] & 0x3f) > 0 and (buf[payload + 1] & 0x01):
+                        advAddr = self.getAddr(buf, payload + 2)
+                elif payload + 6 <= end:
+                    advAddr = self.getAddr(buf, payload)
+
+        return (timestamp, self.chStr[channel], scanAddr, advAddr, self.rssiStr[rssi],
+                flags & NORDIC_FLAG_CRCOK, sec + usec/1.0e6)
+
+# Return the position of the next enhanced packet or section header block
+# in buf from pos on, or where to carry on looking once more bytes arrive if
+# there isn't one yet.  Used to pick up a corrupt stream again.
+def findBlockStart(buf, pos, endian='<'):
+    epbType = struct.pack(endian + 'I', PCAPNG_EPB)
+    shbType = struct.pack('<I', PCAPNG_SHB)
+    while True:
+        found = [p for p in (buf.find(epbType, pos), buf.find(shbType, pos)) if p >= 0]
+        if not found:
+            return max(pos, len(buf) - 11)
+        pos = min(found)
+        if len(buf) - pos < 12:
+            return pos
+
+        btype, blen = struct.unpack_from(endian + 'II', buf, pos)
+        if btype == PCAPNG_SHB:
+            bom, = struct.unpack_from('<I', buf, pos + 8)
+            if bom == PCAPNG_BOM or bom == PCAPNG_BOM_SWAPPED:
+                return pos
+        elif blen >= 32 and blen % 4 == 0 and blen <= PCAPNG_MAX_BLOCK:
+            return pos
+        pos = pos + 1
+
+# Decode the packets in a pcapng file, or in its first length bytes, one 
+# chunk at a time and yield the records.  Compressed captures (.gz, .zst)
+# are decompressed one frame at a time.
+def iterPcapngFile(fname, length=None, chunkSize=1048576):
+    if getArchiveCodec(fname) is not None:
+        yield from iterPcapngData(BtlePcapngArchiveReader(fname).iterData(length))
+        return
+
+    with open(fname, 'rb') as inFile:
+        yield from iterPcapngData(iterFileChunks(inFile, length, chunkSize))
+
+# yield the chunks of an open file up to length bytes (or to the end)
+def iterFileChunks(inFile, length=None, chunkSize=1048576):
+    remaining = length
+    while remaining is None or remaining > 0:
+        data = inFile.read(chunkSize if remaining is None else min(chunkSize, remaining))
+        if not data:
+            break
+        if remaining is not None:
+            remaining = remaining - len(data)
+        yield data
+
+# decode the packets in a pcapng stream given as chunks of bytes and yield
+# the records
+def iterPcapngData(chunks):
+    decoder = BtlePcapngDecoder()
+    for data in chunks:
+        yield from decoder.feed(data)
+
+# Decode all packets in a pcapng file (which can be compressed), or in its 
+# first length bytes, and return the list of records.
+def readPcapngFile(fname, length=None, chunkSize=1048576):
+    return list(iterPcapngFile(fname, length, chunkSize))
+
+# Copy the packets timestamped within [tStart, tEnd) from the part of a 
+# pcapng file between the byte offsets start and end (block boundaries) to a 
+# new file, after the section and interface blocks from the start of the 
+# file.  end is normally the decoder offset of a capture still being written.
+# Returns the records decoded from the copied packets.
+def copyPcapngSegment(fname, outName, start, end, tStart, tEnd):
+    with open(fname, 'rb') as inFile:
+        header = readPcapngHeader(inFile)
+        inFile.seek(start)
+        return writePcapngSegment(outName, header, iterFileChunks(inFile, end - start), tStart, tEnd)
+
+# Write the packets timestamped within [tStart, tEnd) from chunks (the bytes
+# of complete blocks from a capture with the given header blocks) to a new
+# file after the header, and return the records decoded from them
+def writePcapngSegment(outName, header, chunks, tStart, tEnd):
+    with open(outName, 'wb') as outFile:
+        return list(iterPcapngSegment(outFile, header, chunks, tStart, tEnd))
+
+# Write the header and then the packets timestamped within [tStart, tEnd) 
+# from chunks to the open outFile, yielding the records decoded from the 
+# packets as they are written.  The chunks are gone through a block at a 
+# time, so only the block being copied is held in memory.
+def iterPcapngSegment(outFile, header, chunks, tStart, tEnd):
+    decoder = BtlePcapngDecoder()
+    decoder.feed(header)
+    outFile.write(header)
+
+    buf = bytearray()
+    for data in chunks:
+        buf += data
+        pos = 0
+        while len(buf) - pos >= 12:
+            btype, blen = struct.unpack_from(decoder.endian + 'II', buf, pos)
+            if blen < 12:
+                return
+            if len(buf) - pos < blen:
+                break
+            if btype == PCAPNG_EPB:
+                ifId, tsHigh, tsLow = struct.unpack_from(decoder.endian + 'III', buf, pos + 8)
+                if ifId < len(decoder.interfaces):
+                    t = ((tsHigh << 32) | tsLow) / decoder.interfaces[ifId][1]
+                    if t >= tStart and t < tEnd:
+                        block = bytes(buf[pos:pos+blen])
+                        outFile.write(block)
+                        yield from decoder.feed(block)
+            pos = pos + blen
+        del buf[:pos]
+
+# Return the blocks before the first packet of an open pcapng file, which
+# describe the capture (section header and interfaces)
+def readPcapngHeader(inFile):
+    header = bytearray()
+    while True:
+        block = inFile.read(8)
+        if len(block) < 8:
+            break
+        btype, blen = struct.unpack_from('<II', block)
+        if btype == PCAPNG_SHB:
+            bom, = struct.unpack('<I', inFile.read(4))
+            btype, blen = struct.unpack_from('<II' if bom == PCAPNG_BOM else '>II', block)
+            block = block + struct.pack('<I', bom)
+        if btype == PCAPNG_EPB or btype == PCAPNG_SPB:
+            break
+        header += block + inFile.read(blen - len(block))
+    return bytes(header)
+
+# Return the offset just past the last complete block of a pcapng file that
+# may end part way through a block (e.g. a copy of a stream that dropped),
+# walking the block headers from start, which must be a block boundary.
+def findBlockEnd(fname, start=0):
+    size = os.path.getsize(fname)
+    with open(fname, 'rb') as inFile:
+        head = inFile.read(12)
+        if len(head) < 12:
+            return 0
+        bom, = struct.unpack_from('<I', head, 8)
+        endian = '<' if bom == PCAPNG_BOM else '>'
+
+        pos = start
+        while pos + 8 <= size:
+            inFile.seek(pos)
+            btype, blen = struct.unpack(endian + 'II', inFile.read(8))
+            if blen < 12 or pos + blen > size:
+                break
+            pos = pos + blen
+    return pos
+
+# Yield (pos, type, length, endian) for each complete block in data from pos
+# on, following the byte order set by section headers.  Corrupt blocks are 
+# skipped like the decoder does (see findBlockStart), so the positions of 
+# the blocks yielded can jump over them.
+def iterPcapngBlocks(data, pos=0, endian='<'):
+    while len(data) - pos >= 12:
+        btype, blen = struct.unpack_from(endian + 'II', data, pos)
+        if btype == PCAPNG_SHB:
+            bom, = struct.unpack_from('<I', data, pos + 8)
+            if bom == PCAPNG_BOM or bom == PCAPNG_BOM_SWAPPED:
+                endian = '<' if bom == PCAPNG_BOM else '>'
+                btype, blen = struct.unpack_from(endian + 'II', data, pos)
+            else:
+                blen = 0
+        if blen < 12 or blen % 4 != 0 or blen > PCAPNG_MAX_BLOCK:
+            pos = findBlockStart(data, pos + 1, endian)
+            continue
+        if len(data) - pos < blen:
+            break
+        trailer, = struct.unpack_from(endian + 'I', data, pos + blen - 4)
+        if trailer != blen:
+            pos = findBlockStart(data, pos + 1, endian)
+            continue
+        yield pos, btype, blen, endian
+        pos = pos + blen
+
+# Return the zstandard module, None if it is not installed.  It is optional
+# and only imported when a zstd compressed capture is used.
+def getZstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+# return a decompressor for one frame of a capture compressed with codec
+def getDecompressor(codec):
+    if codec == 'gzip':
+        return zlib.decompressobj(wbits=31)
+    return getZstandard().ZstdDecompressor().decompressobj()
+
+# return the compression codec of a capture file from its extension, None 
+# if it is not compressed
+def getArchiveCodec(fname):
+    for codec, ext in ARCHIVE_CODECS.items():
+        if fname.endswith(ext):
+            return codec
+    return None
+
+# Compressed copy of a pcapng stream, written as the stream arrives (it can
+# be used as a BtleTee sink, normally through its own BtleStage).  The 
+# stream is cut at block boundaries into frames of about frameSize bytes 
+# that are compressed on their own, a gzip member or a zstd frame, so the 
+# file is still a normal .gz or .zst file.  The first block, stream offset
+# and file offset of each frame go into an index next to it (fname.idx), 
+# so a reader can start at any block by decompressing one frame.  zstd 
+# needs the zstandard module and compresses with threads worker threads (0
+# compresses on the calling thread).  The stream can be read back while it
+# is being written (iterData), so the archive can stand in for an 
+# uncompressed copy of the stream.
+class BtlePcapngArchive:
+    def __init__(self, fname, codec='gzip', level=None, threads=0, frameSize=1048576):
+        self.fname = fname
+        self.codec = codec
+        self.level = level if level is not None else ARCHIVE_LEVELS[codec]
+        self.frameSize = frameSize
+
+        if codec == 'gzip':
+            self.compress = lambda data: gzip.compress(data, self.level, mtime=0)
+        elif codec == 'zstd' and getZstandard() is not None:
+            self.compress = getZstandard().ZstdCompressor(level=self.level, threads=threads).compress
+        else:
+            raise ValueError("Unsupported capture compression " + str(codec))
+
+        self.outFile = open(fname, 'wb')
+        self.indexFile = open(fname + '.idx', 'w')
+        self.indexFile.write(','.join(ARCHIVE_INDEX_COLUMNS) + '\n')
+
+        # stream bytes not compressed yet, starting at a block, and the end 
+        # of the complete blocks in them
+        self.pending = bytearray()
+        self.pos = 0
+        self.endian = '<'
+
+        # blocks and stream offset before the pending bytes
+        self.blocks = 0
+        self.pendingBlocks = 0
+        self.offset = 0
+
+        # stream and file offset of each frame written, for reading the 
+        # stream back.  The condition guards the pending bytes and the 
+        # offsets against the readers and wakes up waitFor.
+        self.frameOffsets = list()
+        self.fileOffsets = list()
+        self.cond = threading.Condition()
+
+        # counters
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.frames = 0
+
+    # tee sink interface, add a chunk of the stream and compress a frame 
+    # once there are frameSize bytes of complete blocks
+    def write(self, data):
+        with self.cond:
+            self.bytesIn = self.bytesIn + len(data)
+            self.pending += data
+            self.cond.notify_all()
+        while True:
+            for pos, btype, blen, endian in iterPcapngBlocks(self.pending, self.pos, self.endian):
+                self.pos = pos + blen
+                self.endian = endian
+                self.pendingBlocks = self.pendingBlocks + 1
+                if self.pos >= self.frameSize:
+                    break
+            if self.pos < self.frameSize:
+                break
+            self.writeFrame()
+
+    # compress the complete blocks into a frame, the index line is written
+    # after the frame so it never points past the end of the file
+    def writeFrame(self):
+        if self.pos == 0:
+            return
+        frame = self.compress(bytes(self.pending[:self.pos]))
+        self.outFile.write(frame)
+        self.outFile.flush()
+        self.indexFile.write(str(self.blocks) + ',' + str(self.offset) + ',' + str(self.bytesOut) + '\n')
+        self.indexFile.flush()
+
+        with self.cond:
+            self.frameOffsets.append(self.offset)
+            self.fileOffsets.append(self.bytesOut)
+            self.bytesOut = self.bytesOut + len(frame)
+            self.frames = self.frames + 1
+            self.blocks = self.blocks + self.pendingBlocks
+            self.offset = self.offset + self.pos
+            self.pendingBlocks = 0
+            del self.pending[:self.pos]
+            self.pos = 0
+
+    # drop the bytes after the last complete block, like 
+    # BtlePcapngDecoder.discardPartial, when the stream is resumed
+    def discardPartial(self):
+        with self.cond:
+            self.bytesIn = self.bytesIn - (len(self.pending) - self.pos)
+            del self.pending[self.pos:]
+
+    # compress the rest of the complete blocks and close the files
+    def close(self):
+        self.writeFrame()
+        with self.cond:
+            self.outFile.close()
+            self.indexFile.close()
+            self.cond.notify_all()
+
+    # return the stream offset just past the last complete block written
+    def getEnd(self):
+        with self.cond:
+            return self.offset + self.pos
+
+    # Wait until the stream up to offset has been written, at most timeout
+    # seconds (None waits for it or for the archive to be closed).  Returns
+    # False if it hasn't been by then.
+    def waitFor(self, offset, timeout=None):
+        with self.cond:
+            self.cond.wait_for(lambda: self.bytesIn >= offset or self.outFile.closed, timeout)
+            return self.bytesIn >= offset
+
+    # Yield the stream from offset start up to end (default all of it) as 
+    # written so far, one frame at a time.  The frames are read back from 
+    # the file and the bytes not compressed yet come from memory, so it can
+    # be called from any thread while the stream is being written.
+    def iterData(self, start=0, end=None):
+        with self.cond:
+            bounds = self.frameOffsets + [self.offset]
+            fileOffsets = self.fileOffsets + [self.bytesOut]
+            end = self.bytesIn if end is None else min(end, self.bytesIn)
+            tail = bytes(self.pending[max(start - self.offset, 0):max(end - self.offset, 0)])
+
+        idx = max(bisect.bisect_right(bounds, start) - 1, 0)
+        with open(self.fname, 'rb') as inFile:
+            for idx in range(idx, len(bounds) - 1):
+                if bounds[idx] >= end:
+                    break
+                inFile.seek(fileOffsets[idx])
+                data = getDecompressor(self.codec).decompress(inFile.read(fileOffsets[idx + 1] - fileOffsets[idx]))
+                yield data[max(start - bounds[idx], 0):end - bounds[idx]]
+        if tail:
+            yield tail
+
+    # return the blocks before the first packet of the stream (section 
+    # header and interfaces)
+    def getHeader(self):
+        return readPcapngHeader(io.BytesIO(next(self.iterData(), b'')))
+
+    # return a dict of the current counters
+    def getStats(self):
+        return {'bytesIn': self.bytesIn, 'bytesOut': self.bytesOut, 'frames': self.frames}
+
+    def report(self):
+        print('Archive {}: {} bytes in, {} compressed to {} ({:3.1f}%) in {} frames'.format(
+              self.fname, self.bytesIn, self.offset, self.bytesOut, 100.0*self.bytesOut/self.offset if self.offset else 0,
+              self.frames))
+
+# Random access to a capture written by BtlePcapngArchive, by block index.  
+# Only the frame holding the first block wanted is decompressed, not the 
+# ones before it.  If there is no index (e.g. a capture gzipped by hand) it
+# is rebuilt by reading the file through once.
+class BtlePcapngArchiveReader:
+    def __init__(self, fname):
+        self.fname = fname
+        self.codec = getArchiveCodec(fname)
+        if self.codec == 'zstd' and getZstandard() is None:
+            raise ValueError("Reading " + fname + " needs the zstandard module")
+
+        # first block, stream offset and file offset of each frame
+        self.frameBlocks = list()
+        self.frameOffsets = list()
+        self.fileOffsets = list()
+        if os.path.exists(fname + '.idx'):
+            self.readIndex()
+        else:
+            self.buildIndex()
+
+        # the blocks before the first packet describe the capture, they are
+        # fed to the decoder before blocks from the middle of the capture
+        self.header = b''
+        if self.fileOffsets:
+            self.header = readPcapngHeader(io.BytesIO(self.readFrame(0)))
+        self.headerBlocks = sum(1 for block in iterPcapngBlocks(self.header))
+
+    def readIndex(self):
+        with open(self.fname + '.idx', 'r') as indexFile:
+            indexFile.readline()
+            for line in indexFile:
+                block, offset, fileOffset = line.rstrip('\n').split(',')
+                self.frameBlocks.append(int(block))
+                self.frameOffsets.append(int(offset))
+                self.fileOffsets.append(int(fileOffset))
+
+    # Decompress the frames one after the other, noting where each starts.
+    # The file is streamed through the decompressor a chunk at a time; the
+    # input left over at the end of a frame (unused_data) starts the next.
+    def buildIndex(self, chunkSize=1048576):
+        block = 0
+        offset = 0
+        endian = '<'
+        readOffset = 0
+        pending = bytearray()
+        decompressor = None
+        data = b''
+        with open(self.fname, 'rb') as inFile:
+            while True:
+                if not data:
+                    data = inFile.read(chunkSize)
+                    if not data:
+                        break
+                    readOffset = readOffset + len(data)
+                if decompressor is None:
+                    decompressor = getDecompressor(self.codec)
+                    frame = (block, offset, readOffset - len(data))
+
+                out = decompressor.decompress(data)
+                offset = offset + len(out)
+                pending += out
+                end = 0
+                for pos, btype, blen, endian in iterPcapngBlocks(pending, 0, endian):
+                    block = block + 1
+                    end = pos + blen
+                del pending[:end]
+
+                if decompressor.eof:
+                    self.frameBlocks.append(frame[0])
+                    self.frameOffsets.append(frame[1])
+                    self.fileOffsets.append(frame[2])
+                    data = decompressor.unused_data
+                    decompressor = None
+                else:
+                    data = b''
+
+    # return the decompressed frame idx
+    def readFrame(self, idx):
+        with open(self.fname, 'rb') as inFile:
+            inFile.seek(self.fileOffsets[idx])
+            if idx + 1 < len(self.fileOffsets):
+                data = inFile.read(self.fileOffsets[idx + 1] - self.fileOffsets[idx])
+            else:
+                data = inFile.read()
+        return getDecompressor(self.codec).decompress(data)
+
+    # yield the decompressed stream one frame at a time, or its first 
+    # length bytes
+    def iterData(self, length=None):
+        for idx in range(len(self.fileOffsets)):
+            if length is not None and self.frameOffsets[idx] >= length:
+                break
+            data = self.readFrame(idx)
+            if length is not None:
+                data = data[:length - self.frameOffsets[idx]]
+            yield data
+
+    # yield the blocks (as bytes) from block index start on, up to end
+    def iterBlocks(self, start=0, end=None):
+        idx = bisect.bisect_right(self.frameBlocks, start) - 1
+        if idx < 0:
+            return
+        block = self.frameBlocks[idx]
+        endian = '<'
+        for idx in range(idx, len(self.fileOffsets)):
+            frame = self.readFrame(idx)
+            for pos, btype, blen, endian in iterPcapngBlocks(frame, 0, endian):
+                if end is not None and block >= end:
+                    return
+                if block >= start:
+                    yield frame[pos:pos + blen]
+                block = block + 1
+
+    # Decode the packets in the blocks from start up to end and return the 
+    # records.  The header is decoded first unless start is inside it.
+    def readRecords(self, start=0, end=None):
+        decoder = BtlePcapngDecoder()
+        if start >= self.headerBlocks:
+            decoder.feed(self.header)
+        records = list()
+        for block in self.iterBlocks(start, end):
+            records.extend(decoder.feed(block))
+        return records
+
+# Compress a pcapng file with BtlePcapngArchive to fname plus the codec's
+# extension, returning the name of the compressed file
+def compressPcapngFile(fname, codec='gzip', level=None, threads=0, chunkSize=1048576, frameSize=1048576):
+    archive = BtlePcapngArchive(fname + ARCHIVE_CODECS[codec], codec, level, threads, frameSize)
+    with open(fname, 'rb') as inFile:
+        while True:
+            data = inFile.read(chunkSize)
+            if not data:
+                break
+            archive.write(data)
+    archive.close()
+    return archive.fname
+
+# Compare the decoder against the btle_sniffer_*.csv written for the same
+# capture (time, address, RSSI, epoch and channel of every CRC ok packet) and,
+# if tshark is installed, against the tshark fields used by runTshark.
+# Returns the number of mismatches.
+def validateFile(fname):
+    records = readPcapngFile(fname)
+    mismatches = 0
+
+    codec = getArchiveCodec(fname)
+    csvName = fname[:-len(ARCHIVE_CODECS[codec])] if codec is not None else fname
+    csvName = csvName.replace('.pcapng', '.csv')
+    if os.path.exists(csvName):
+        rows = list()
+        with open(csvName, 'r') as csvFile:
+            for line in csvFile:
+                data = line.rstrip('\n').split(',')
+                if len(data) == 7 and data[1] == 'Bluetooth':
+                    rows.append(data)
+
+        # the csv only has CRC ok packets and is missing the final packet(s)
+        decoded = [r for r in records if r[5]]
+        for i, row in enumerate(rows):
+            if i >= len(decoded):
+                print(csvName, " row ", i, ": no packet decoded")
+                mismatches = mismatches + 1
+                continue
+            r = decoded[i]
+            expected = (row[0], row[2], row[3], row[5], row[6])
+            got = (r[0], r[3], r[4], str(r[BTLE_EPOCH]), r[1])
+            if got != expected:
+                print(csvName, " row ", i, ": ", got, " != ", expected)
+                mismatches = mismatches + 1
+        print(csvName, ": ", len(rows), " rows checked")
+
+    if shutil.which('tshark') is not None:
+        cmd = ["tshark", "-r", fname, "-T", "fields", "-E", "separator=,",
+               "-e", "_ws.col.Time", "-e", "nordic_ble.channel",
+               "-e", "btle.scanning_address", "-e", "btle.advertising_address",
+               "-e", "nordic_ble.rssi", "-e", "nordic_ble.crcok", "-t", "ad"]
+        lines = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True).stdout.splitlines()
+        for i, line in enumerate(lines):
+            data = line.split(',')
+            crcOk = {'1': 1, 'True': 1, '0': 0, 'False': 0}.get(data[5], data[5]) if len(data) >= 6 else None
+            if i >= len(records) or tuple(data[:5]) + (crcOk,) != records[i][:6]:
+                print(fname, " packet ", i, ": ", records[i][:6] if i < len(records) else None, " != ", data)
+                mismatches = mismatches + 1
+        print(fname, ": ", len(lines), " tshark packets checked")
+
+    return mismatches
+
+# print usage info
+def usage():
+    print("\nDescription: decode Nordic BLE sniffer pcapng captures and validate the decoder against the captured CSV/tshark output.\n")
+    print("\nUsage:\n")
+    print(" ",__file__, " [-h] [-z time_zone] [-a codec[:level]] file.pcapng ...\n")
+    print("     -h: help\n")
+    print("     -z time_zone: time zone the capture was taken in, e.g. America/New_York")
+    print("     -a codec[:level]: compress the captures to file.pcapng.gz (gzip) or file.pcapng.zst (zstd) with a block")
+    print("         index instead of validating them, the level defaults to 6 for gzip and 3 for zstd")
+    print("\n")
+
+# main function for command line entry point
+def main(argv):
+    codec = None
+    level = None
+
+    # grab command line args
+    try:
+        opts, args = getopt.getopt(argv,"hz:a:",["tz=","archive="])
+    except getopt.GetoptError:
+        usage()
+        return 1
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            return 0
+        elif opt in ("-z", "--tz"):
+            os.environ['TZ'] = arg
+            time.tzset()
+        elif opt in ("-a", "--archive"):
+            codec, _, level = arg.partition(':')
+            level = int(level) if level else None
+            if codec not in ARCHIVE_CODECS:
+                usage()
+                return 1
+
+    if not args:
+        usage()
+        return 1
+
+    if codec is not None:
+        for fname in args:
+            outName = compressPcapngFile(fname, codec, level)
+            print(outName + ": {} -> {} bytes".format(os.path.getsize(fname), os.path.getsize(outName)))
+        return 0
+
+    mismatches = 0
+    for fname in args:
+        mismatches = mismatches + validateFile(fname)
+
+    print("Total mismatches: ", mismatches)
+    return 1 if mismatches else 0
+
+# callable from command line
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import time
+import collections
+
+import numpy
+
+# Reduce a long series to at most two points (the min and the max) per 
+# horizontal pixel, so the cost of drawing it is bounded by the width of the
+# axes rather than the number of samples.  xs must be in ascending order.
+def decimateMinMax(xs, ys, width):
+    n = len(xs)
+    if width < 1 or n <= 2*width:
+        return xs, ys
+
+    x = numpy.asarray(xs, dtype=numpy.float64)
+    y = numpy.asarray(ys, dtype=numpy.float64)
+
+    # index of the first sample in each pixel column, dropping empty columns
+    edges = numpy.linspace(x[0], x[-1], width + 1)[:-1]
+    starts = numpy.unique(numpy.searchsorted(x, edges, side='left'))
+    ends = numpy.append(starts[1:], n) - 1
+
+    outX = numpy.empty(2*len(starts))
+    outY = numpy.empty(2*len(starts))
+    outX[0::2] = x[starts]
+    outX[1::2] = x[ends]
+    outY[0::2] = numpy.minimum.reduceat(y, starts)
+    outY[1::2] = numpy.maximum.reduceat(y, starts)
+    return outX, outY
+
+# Live RSSI plot that creates one line per channel once and then only updates
+# the line data.  The axes backgrounds are cached on every full draw and each
+# update restores them and blits the lines, so a full redraw is only needed 
+# when the title or the axis limits change.  The time taken by each update is
+# kept in frameTimes and reported once the capture is over.
+class BtleLivePlot:
+    def __init__(self, fig, axes, marker=""):
+        self.fig = fig
+        self.axes = axes
+        self.title = None
+        self.windowLen = 0
+        self.backgrounds = None
+        self.lines = list()
+        for ax in self.axes:
+            line, = ax.plot([], [], linewidth=1, marker=marker, animated=True)
+            self.lines.append(line)
+            self.resetLimits(ax, self.windowLen)
+
+        self.frameTimes = collections.deque(maxlen=100)
+        self.numFrames = 0
+        self.fig.canvas.mpl_connect('draw_event', self.onDraw)
+
+    # full draw happened (first draw, resize, new limits), cache the new 
+    # backgrounds and draw the lines on top of them
+    def onDraw(self, event):
+        canvas = self.fig.canvas
+        self.backgrounds = [canvas.copy_from_bbox(ax.bbox) for ax in self.axes]
+        for ax, line in zip(self.axes, self.lines):
+            ax.draw_artist(line)
+
+    # set the initial axis limits for a new title or window length
+    def resetLimits(self, ax, windowLen):
+        ax.set_xlim(0, windowLen if windowLen > 0 else 60)
+        ax.set_ylim(-100, -20)
+
+    # expand the axis limits to fit the data, returns True if they changed.
+    # With a window the x axis slides forward a quarter window at a time.
+    def updateLimits(self, ax, xs, stats, windowLen):
+        if not xs:
+            return False
+
+        changed = False
+        xMin, xMax = ax.get_xlim()
+        if xs[-1] > xMax:
+            if windowLen > 0:
+                ax.set_xlim(xs[-1] - windowLen, xs[-1] + windowLen/4)
+            else:
+                ax.set_xlim(0, max(60, xs[-1]*1.5))
+            changed = True
+
+        yMin, yMax = ax.get_ylim()
+        if stats.min < yMin or stats.max > yMax:
+            ax.set_ylim(min(yMin, stats.min - 5), max(yMax, stats.max + 5))
+            changed = True
+
+        return changed
+
+    # update the plot with the data in the address index entry, showing the
+    # last windowLen seconds or the full capture if windowLen is 0
+    def update(self, entry, title, marker="", windowLen=0):
+        start = time.perf_counter()
+        canvas = self.fig.canvas
+
+        redraw = self.backgrounds is None or title != self.title or windowLen != self.windowLen
+        if title != self.title or windowLen != self.windowLen:
+            self.title = title
+            self.windowLen = windowLen
+            for ch, ax in zip(("Ch 37 ", "Ch 38 ", "Ch 39 "), self.axes):
+                ax.set_title(ch + title)
+                self.resetLimits(ax, windowLen)
+
+        for i in range(3):
+            ax = self.axes[i]
+            line = self.lines[i]
+            xs, ys = entry.getData(i, windowLen)
+            line.set_marker(marker)
+            line.set_data(*decimateMinMax(xs, ys, int(ax.bbox.width)))
+            if self.updateLimits(ax, xs, entry.stats[i], windowLen):
+                redraw = True
+
+        if redraw:
+            canvas.draw()
+        else:
+            for ax, line, background in zip(self.axes, self.lines, self.backgrounds):
+                canvas.restore_region(background)
+                ax.draw_artist(line)
+                canvas.blit(ax.bbox)
+
+        self.frameTimes.append(time.perf_counter() - start)
+        self.numFrames = self.numFrames + 1
+
+    # print the number of frames drawn and the average and max frame time 
+    # over the recent frames
+    def report(self):
+        if not self.frameTimes:
+            return
+        print('Plot: {} frames, avg {:3.1f} ms, max {:3.1f} ms over the last {}'.format(
+              self.numFrames, sum(self.frameTimes) / len(self.frameTimes) * 1000, 
+              max(self.frameTimes) * 1000, len(self.frameTimes)))
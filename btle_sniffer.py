@@ -1,119 +1,468 @@
 #!/usr/bin/env python3
 
-import matplotlib
-import matplotlib.pyplot as pyplot
-import matplotlib.animation as animation
-from matplotlib import style
-
 import sys
 import os
 import time
-import math
-import statistics
 import getopt
-import logging
 import subprocess
 import threading
-import readline
-
-import PySimpleGUI as sg
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.backends.backend_tkagg import (NavigationToolbar2Tk as NavigationToolbar)
+import queue
+import copy
+import itertools
+import contextlib
+import asyncio
+import select
+import selectors
+import signal
 
 from datetime import datetime
-import time
-
-matplotlib.use('TkAgg')
-
-# field indexes for BLTE data
-BTLE_TIME = 0
-BTLE_CH = 1
-BTLE_SCAN_ADDR = 2
-BTLE_ADV_ADDR = 3
-BTLE_RSSI = 4
-BTLE_CRCOK = 5
-
-class BtleMetaData:
-    def __init__(self):
-
-        self.testEnv = ''
-        self.device = ''
-        self.range = ''
-        self.angle = ''
-        self.txPower = ''
-        self.gps = ''
-        
-        self.getDefaults()
-    
-    def setDefaults(self):
-        with open('defaults.txt', 'w') as defaultFile:
-            print("Writing default metadata...")
-            defaultFile.write('testEnv,' + self.testEnv + '\n')
-            defaultFile.write('device,' + self.device + '\n')
-            defaultFile.write('range,' + self.range + '\n')
-            defaultFile.write('angle,' + self.angle + '\n')
-            defaultFile.write('txPower,' + self.txPower + '\n')
-            defaultFile.write('gps,' + self.gps + '\n')
-
-    def getDefaults(self):
-        with open('defaults.txt','r') as defaultFile:
-            print("Reading default metadata...")
-            lines = defaultFile.readlines()
-
-            for line in lines:
-                line = line.rstrip()
-                val = line.split(',')
-                if len(val) != 2:
-                    print("Unexpected default value line!")
-                    continue
-                
-                if val[0] == "testEnv":
-                    self.testEnv = val[1]
-                if val[0] == "device":
-                    self.device= val[1]
-                if val[0] == "range":
-                    self.range = val[1]
-                if val[0] == "angle":
-                    self.angle = val[1]
-                if val[0] == "txPower":
-                    self.txPower = val[1]
-                if val[0] == "gps":
-                    self.gps = val[1]
 
+from btle_data import BTLE_TIME, BTLE_CH, BTLE_SCAN_ADDR, BTLE_ADV_ADDR, BTLE_RSSI, BTLE_CRCOK
+from btle_data import CSV_TIME, CSV_TYPE, CSV_ADDR, CSV_RSSI, CSV_TX_POWER, CSV_EPOCH, CSV_CH
+from btle_data import BTLE_CH_INDEX, BTLE_MAX_RATE, BTLE_RSSI_VALUES
+from btle_data import (BtleMetaData, BtleTimeParser, RssiStats, BtleRingBuffer, BtleAddrEntry, 
+                       BtleStatsIndex, BtleOutReader, makeDataRow)
+from btle_pcapng import (BtlePcapngDecoder, BtlePcapngArchive, readPcapngFile, iterPcapngFile, iterPcapngSegment,
+                         findBlockEnd, compressPcapngFile, ARCHIVE_CODECS, BTLE_EPOCH)
+import btle_pcapng
+from btle_metrics import BtleMetrics, BtleMetricsLog, BtleSampler
+from btle_multi import BtleEndpoint, BtleMerger, BtleDedup, mergeRecords, parseEndpoint
+import btle_ssh
+
+# The GUI modules (and the plot, which needs numpy) are only imported by 
+# loadGui, so a headless capture never loads matplotlib, Tk or PySimpleGUI.
+matplotlib = None
+pyplot = None
+animation = None
+style = None
+sg = None
+FigureCanvasTkAgg = None
+NavigationToolbar = None
+BtleLivePlot = None
+
+def loadGui():
+    global matplotlib, pyplot, animation, style, sg, FigureCanvasTkAgg, NavigationToolbar, BtleLivePlot
+    if sg is not None:
         return
 
-    def makeOutputLine(self, name, val):
-        output = str(datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f') + ',' + name + ',' + val.replace(',','.'))
-        return output + '\n'
-
-    def getOutput(self):
-        output = list()
-        output.append(self.makeOutputLine("Environment", self.testEnv))
-        output.append(self.makeOutputLine("Device", self.device))
-        output.append(self.makeOutputLine("Range", self.range))
-        output.append(self.makeOutputLine("Angle", self.angle))
-        output.append(self.makeOutputLine("TxPower", self.txPower))
-        output.append(self.makeOutputLine("GPS", self.gps))
-        return output
-    
+    import matplotlib
+    import matplotlib.pyplot as pyplot
+    import matplotlib.animation as animation
+    from matplotlib import style
+
+    import PySimpleGUI as sg
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+    from matplotlib.backends.backend_tkagg import (NavigationToolbar2Tk as NavigationToolbar)
+
+    from btle_plot import BtleLivePlot
+
+    matplotlib.use('TkAgg')
+
+# capture file wireshark writes on the sniffer host
+PI_CAPTURE_FILE = "/home/ubuntu/nRF52/rb/rb.pcapng"
+
+
+# Writes the MIT-LL data file while the capture is running.  Decoded records
+# are queued by the capture thread and converted and appended to the file by
+# a pipeline stage (a bounded queue, see BtleStage).  The start of the file is reserved for the metadata,
+# which is only known at the end of the capture, and holds a padding line 
+# until then (the padding is a metadata line with an unknown name, readers
+# ignore it).  Finishing the file only has to fill in that region.
+class BtleCsvWriter:
+    def __init__(self, fname, txPower, headerSize=4096, colWriter=None):
+        self.fname = fname
+        self.txPower = txPower
+        self.headerSize = headerSize
+        self.colWriter = colWriter
+        self.rows = 0
+
+        self.outFile = open(fname, 'wb')
+        self.outFile.write(self.makeHeader([]))
+        self.stage = BtleStage('csv', self.writeRecords, maxDepth=256)
+
+    # return the metadata lines followed by a padding line that fills the 
+    # reserved region, or None if they don't fit
+    def makeHeader(self, metadataLines):
+        header = ''.join(metadataLines).encode('utf-8')
+        pad = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f') + ',Padding,'
+        numSpaces = self.headerSize - len(header) - len(pad) - 1
+        if numSpaces < 0:
+            return None
+        return header + (pad + ' '*numSpaces + '\n').encode('utf-8')
+
+    # queue a batch of decoded records, called from the capture thread
+    def put(self, records):
+        self.stage.put(records)
+
+    def writeRecords(self, records):
+        rows = list()
+        for data in records:
+            if not data[BTLE_CRCOK]:
+                continue
+            rows.append(makeDataRow(data, data[BTLE_EPOCH], self.txPower))
+            if self.colWriter is not None:
+                self.colWriter.append(data[BTLE_EPOCH], data[BTLE_CH], data[BTLE_RSSI], data[BTLE_ADV_ADDR])
+
+        if rows:
+            rows.append('')
+            self.outFile.write('\n'.join(rows).encode('utf-8'))
+            self.rows = self.rows + len(rows) - 1
+
+        # flush when caught up so the file on disk stays current
+        if self.stage.queue.empty():
+            self.outFile.flush()
+
+    # Write the remaining rows and fill in the metadata.  Returns False if 
+    # the file could not be finished in place (the metadata doesn't fit the
+    # reserved region or the Tx power changed) and has to be regenerated.
+    def finish(self, metadataLines, txPower):
+        self.stage.close()
+
+        if self.colWriter is not None:
+            self.colWriter.metaLines = list(metadataLines)
+            self.colWriter.close()
+
+        header = self.makeHeader(metadataLines)
+        if header is None or txPower != self.txPower:
+            self.outFile.close()
+            return False
+
+        self.outFile.seek(0)
+        self.outFile.write(header)
+        self.outFile.close()
+        return True
+
+# Streaming tee that copies bytes from a source fd to one or more sink fds.
+# Data is read in large chunks into a single reusable buffer and the pump 
+# blocks until the fds are ready instead of polling.  A sink that cannot keep
+# up applies backpressure; the number of times a sink was not ready and the
+# time spent waiting for it are counted.  A sink whose reader has gone away
+# (broken pipe) is dropped and the rest keep going until the source ends.
+# Sinks are fds, or objects with a write() method that are called in line 
+# (e.g. an in-process decoder).
+class BtleTee:
+    def __init__(self, src, sinks, chunkSize=65536, reportInterval=10):
+        self.src = src
+        self.sinks = list(sinks)
+        self.active = [True] * len(self.sinks)
+        self.reportInterval = reportInterval
+
+        self.buf = bytearray(chunkSize)
+        self.view = memoryview(self.buf)
+
+        # counters
+        self.bytesIn = 0
+        self.chunks = 0
+        self.bytesOut = [0] * len(self.sinks)
+        self.backpressure = [0] * len(self.sinks)
+        self.waitTime = [0.0] * len(self.sinks)
+        self.bytesPerSec = 0.0
+        self.startTime = None
+
+        # sinks are written non-blocking so a full pipe is seen as backpressure
+        for fd in self.sinks:
+            if isinstance(fd, int):
+                os.set_blocking(fd, False)
+
+    # write all of data to the sink, waiting for it to become writable if it
+    # is full.  Returns False if the sink was dropped.
+    def writeSink(self, idx, data):
+        fd = self.sinks[idx]
+        if not isinstance(fd, int):
+            try:
+                fd.write(data)
+            except ValueError as e:
+                print('Tee: sink ', idx, ' failed (', e, '), dropping it')
+                self.active[idx] = False
+                return False
+            self.bytesOut[idx] = self.bytesOut[idx] + len(data)
+            return True
+
+        while len(data) > 0:
+            try:
+                n = os.write(fd, data)
+            except BlockingIOError:
+                n = 0
+            except (BrokenPipeError, ConnectionResetError):
+                print('Tee: sink ', idx, ' closed, dropping it')
+                self.active[idx] = False
+                return False
+
+            self.bytesOut[idx] = self.bytesOut[idx] + n
+            data = data[n:]
+            if len(data) > 0:
+                self.backpressure[idx] = self.backpressure[idx] + 1
+                start = time.perf_counter()
+                select.select([], [fd], [])
+                self.waitTime[idx] = self.waitTime[idx] + time.perf_counter() - start
+
+        return True
+
+    # Read from a new source, e.g. the stream reconnected after it dropped.
+    # The counters carry on.
+    def setSource(self, src):
+        self.src = src
+
+    # replace sink idx with a new fd, e.g. a restarted process
+    def setSink(self, idx, fd):
+        if isinstance(fd, int):
+            os.set_blocking(fd, False)
+        self.sinks[idx] = fd
+        self.active[idx] = True
+
+    # return a dict of the current counters
+    def getStats(self):
+        return {'bytesIn': self.bytesIn, 'chunks': self.chunks, 'bytesPerSec': self.bytesPerSec,
+                'bytesOut': list(self.bytesOut), 'backpressure': list(self.backpressure),
+                'waitTime': list(self.waitTime)}
+
+    def report(self):
+        print('Tee: {:3.1f} kB/s, {} bytes in {} chunks, backpressure {}, wait {}'.format(
+              self.bytesPerSec/1000, self.bytesIn, self.chunks, self.backpressure,
+              ['{:3.2f}s'.format(t) for t in self.waitTime]))
+
+    # copy until the source reaches end of file
+    def run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.src, selectors.EVENT_READ)
+
+        self.startTime = time.perf_counter()
+        lastReport = self.startTime
+        lastBytes = self.bytesIn
+        while True:
+            # block until there is data, waking up to report the rate
+            if selector.select(timeout=self.reportInterval):
+                n = os.readv(self.src, [self.buf])
+                if n == 0:
+                    break
+
+                self.bytesIn = self.bytesIn + n
+                self.chunks = self.chunks + 1
+                data = self.view[:n]
+                for idx in range(len(self.sinks)):
+                    if self.active[idx]:
+                        self.writeSink(idx, data)
+
+            now = time.perf_counter()
+            if now - lastReport >= self.reportInterval:
+                self.bytesPerSec = (self.bytesIn - lastBytes) / (now - lastReport)
+                lastReport = now
+                lastBytes = self.bytesIn
+                self.report()
+
+        selector.close()
+        self.report()
+
+# One stage of the capture pipeline.  A worker thread takes items from a 
+# bounded queue and passes them to func.  When the queue is full the producer
+# blocks until there is room, so a slow stage pushes back on the stages 
+# before it instead of using more and more memory.  The queue depth, the 
+# number of times the producer found the queue full and the time it spent 
+# waiting are counted.  The stage can be used as a BtleTee sink.  After 
+# maxErrors errors in a row the stage is marked failed: it takes no more
+# items and the items it is given are counted as dropped.
+class BtleStage:
+    def __init__(self, name, func, maxDepth=64, maxErrors=10):
+        self.name = name
+        self.func = func
+        self.maxDepth = maxDepth
+        self.maxErrors = maxErrors
+        self.queue = queue.Queue(maxDepth)
+
+        # counters, items dropped by put and by the worker once failed
+        self.items = 0
+        self.peakDepth = 0
+        self.full = 0
+        self.waitTime = 0.0
+        self.errors = 0
+        self.failed = False
+        self.dropped = 0
+        self.discarded = 0
+
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    # queue an item, blocking while the queue is full
+    def put(self, item):
+        if self.failed:
+            self.dropped = self.dropped + 1
+            return
+
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.full = self.full + 1
+            start = time.perf_counter()
+            self.queue.put(item)
+            self.waitTime = self.waitTime + time.perf_counter() - start
+
+        self.items = self.items + 1
+        self.peakDepth = max(self.peakDepth, self.queue.qsize())
+
+    # tee sink interface, the tee reuses its buffer so queue a copy
+    def write(self, data):
+        self.put(bytes(data))
+
+    def run(self):
+        errorsInRow = 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+
+            # keep taking items after errors, a dead worker would block the 
+            # producer
+            if self.failed:
+                self.discarded = self.discarded + 1
+            else:
+                try:
+                    self.func(item)
+                    errorsInRow = 0
+                except Exception as e:
+                    self.errors = self.errors + 1
+                    errorsInRow = errorsInRow + 1
+                    print('Stage ', self.name, ' error: ', e)
+                    if errorsInRow >= self.maxErrors:
+                        print('Stage ', self.name, ' failed after ', errorsInRow, ' errors in a row, dropping its input')
+                        self.failed = True
+            self.queue.task_done()
+
+    # wait until the items already queued have been processed
+    def drain(self):
+        self.queue.join()
+
+    # process the items already queued and stop the worker thread
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    # return a dict of the current counters
+    def getStats(self):
+        return {'name': self.name, 'depth': self.queue.qsize(), 'maxDepth': self.maxDepth,
+                'peakDepth': self.peakDepth, 'items': self.items, 'full': self.full,
+                'waitTime': self.waitTime, 'errors': self.errors, 'failed': self.failed,
+                'dropped': self.dropped + self.discarded}
+
+    def report(self):
+        print('Stage {}: depth {}/{} (peak {}), {} items, full {} times, wait {:3.2f}s, {} errors{}'.format(
+              self.name, self.queue.qsize(), self.maxDepth, self.peakDepth, self.items, 
+              self.full, self.waitTime, self.errors,
+              ', FAILED, {} dropped'.format(self.dropped + self.discarded) if self.failed else ''))
+
 # Class that implements all BTLE sniffer functionality.  Create and update GUI,
 # send commands to RaspPi, receive data stream and process it.
 class BtleSniffer:
     # Constructor, init all class vars and call init routine for the PiSniffer
-    def __init__(self, _filter = "", autoMode=False):
+    def __init__(self, _filter = "", autoMode=False, blitPlot=True, windowLen=0, useTshark=False, writeColumnar=False, liveWrite=False, sshSession=None, headless=False, statsInterval=10, metricsFile=None, metricsInterval=10, showMetrics=False, profileFile=None, endpoints=None, skew=2.0, dedupWindow=10, dedupTolerance=0, resumeStream=True, archiveCodec=None, archiveLevel=None, archiveThreads=0, detachCapture=False, captureDuration=0):
         print("BtleSniffer init")
+
+        # connection to the sniffer host, shared between instances unless one
+        # is given (e.g. a BtleLocalSession for testing)
+        self.ssh = sshSession if sshSession is not None else btle_ssh.getSession()
+
+        # Sniffers to capture from (BtleEndpoint), by default the one board on
+        # the sniffer host.  The streams of several sniffers are decoded 
+        # separately and merged into one time ordered stream by the merge 
+        # stage, which waits at most skew seconds for a sniffer that falls 
+        # behind.  Several sniffers are only supported with the built in 
+        # decoder and without segments.
+        if not endpoints:
+            endpoints = [BtleEndpoint(self.ssh)]
+        self.endpoints = list(endpoints)
+        names = [endpoint.name for endpoint in self.endpoints]
+        for idx, endpoint in enumerate(self.endpoints):
+            endpoint.idx = idx
+            if names.count(endpoint.name) > 1:
+                endpoint.name = endpoint.name + '_' + str(idx)
+            if len(self.endpoints) > 1:
+                endpoint.bufName = 'buf_' + endpoint.name + '.pcapng'
+        self.merger = BtleMerger(len(self.endpoints), skew) if len(self.endpoints) > 1 else None
+        self.mergeStage = None
+        if self.merger is not None and useTshark:
+            print("tshark is not supported with several sniffers, using the built in decoder")
+            useTshark = False
+
+        # drop packets seen twice (see BtleDedup) before they are counted or
+        # written, remembering dedupWindow seconds of packets (0 turns it off)
+        self.dedup = BtleDedup(dedupWindow, dedupTolerance) if dedupWindow > 0 else None
+
+        # If a stream drops (e.g. the network to the sniffer host blipped) 
+        # while wireshark is still capturing, reconnect and carry on from the
+        # end of the last complete pcapng block instead of losing the rest of
+        # the capture.  streamStop is set once the capture is over, so the
+        # stream processes terminated then are not resumed.
+        self.resumeStream = resumeStream
+        self.streamStop = threading.Event()
+
+        # Run the capture on the host detached from the ssh session (see 
+        # BtleEndpoint.getDetachedCaptureCmd), so it carries on through an 
+        # outage long enough to drop the session and the stream can be 
+        # resumed from it.  There is no wireshark window then, the capture 
+        # is stopped with kill.
+        self.detachCapture = detachCapture
+
+        # Compress each stream as it arrives (see BtlePcapngArchive), with 
+        # 'gzip' or 'zstd' (None turns it off).  The compressed copy takes 
+        # the place of buf.pcapng: the segments, resetPlotData and a resumed
+        # stream read it back, and it is kept with the data files when the 
+        # capture ends.
+        if archiveCodec == 'zstd' and btle_pcapng.getZstandard() is None:
+            print("zstd needs the zstandard module, compressing the capture with gzip")
+            archiveCodec = 'gzip'
+            archiveLevel = None
+        self.archiveCodec = archiveCodec
+        self.archiveLevel = archiveLevel
+        self.archiveThreads = archiveThreads
+
         self.autoMode = autoMode
+        self.blitPlot = blitPlot
+
+        # run only the capture, decode and data file pipeline without the 
+        # plot and the UI (no GUI modules are loaded), printing the stats 
+        # every statsInterval seconds instead.  The metadata comes from the
+        # defaults file like in autoMode.
+        self.headless = headless
+        self.statsInterval = statsInterval
+
+        # stop a headless capture after this many seconds, 0 captures until
+        # wireshark exits or ctrl-c
+        self.captureDuration = captureDuration
+
+        # decode the pcapng stream with a local tshark process writing to 
+        # btle_sniffer.out instead of the built in decoder
+        self.useTshark = useTshark
+
+        # length of the live view in seconds, 0 shows the full capture
+        self.windowLen = windowLen
+
+        # also write the capture in the columnar format (.btlc)
+        self.writeColumnar = writeColumnar
+
+        # write the data file while capturing instead of at the end, only 
+        # supported with the built in decoder
+        self.liveWrite = liveWrite and not useTshark
+        if liveWrite and useTshark:
+            print("Live data file writing is not supported with tshark, writing at the end")
+        self.csvWriter = None
+        self.dataFileDone = False
 
         self.mainProcess = None
         self.wiresharkProcess = None
         self.tsharkProcess = [None, None]
-        self.t = [None,None,None]
+        self.tee = None
+
+        # event loop that manages the remote processes, and an event set 
+        # once the capture file on the sniffer host starts growing
+        self.loop = None
+        self.captureStarted = threading.Event()
 
         self.fig = None
         self.ax1 = None
         self.ax2 = None
         self.ax3 = None
         self.ani = None
+        self.livePlot = None
         self.window = None
         self.figCanvasAgg = None
         self.pausePlot = False
@@ -122,12 +471,66 @@ class BtleSniffer:
         self.runFlag = False
 
         self.advAddrs = set()
-        self.rssiCounts = dict({'*': '*'})
         self.plotMarker = ""
         self.hideInfrequent = True
         self.infrequentThresh = 10
         self.suppressNonNullScanAddr = True
 
+        # persistent reader and per-address, per-channel buffers and stats
+        self.outReader = BtleOutReader()
+        self.decoder = None
+
+        # pipeline stages used with the built in decoder: the tee (byte pump)
+        # feeds the decode stage, which feeds the aggregate stage that owns 
+        # the index.  The UI thread takes a snapshot of the index under the
+        # lock on each timeout.
+        self.decodeStage = None
+        self.aggregateStage = None
+        self.indexLock = threading.Lock()
+        self.numTicks = 0
+
+        # Segments of a long running capture, e.g. one per chamber angle.  The
+        # decode stage tracks the newest packet time and the smallest delay 
+        # seen between a packet's time and its arrival here, which is used to
+        # line up the (local clock) segment markers with the packet times.
+        self.segment = None
+        self.segmentThreads = list()
+
+        # positioner angle tracks of the running segments (BtleAngleTrack), 
+        # fed with the accepted packets by the decode stage
+        self.angleTracks = list()
+        self.decodeCond = threading.Condition()
+        self.lastEpoch = 0
+        self.clockLag = None
+        self.captureDone = False
+        self.aggregatedOffset = 0
+        self.statsIndex = BtleStatsIndex(self.windowLen, keepSamples=not headless)
+        self.t0 = None
+        self.timeParser = BtleTimeParser()
+
+        # Counters and timers of the hot paths (rows parsed and dropped by 
+        # reason, parse, draw and stats times, packet to display latency).
+        # They are appended to metricsFile as JSON every metricsInterval 
+        # seconds if it is set and shown below the plot if showMetrics is 
+        # set.  The packet to display latency uses the packet times from the
+        # sniffer host, corrected by clockLag so the host clocks don't have 
+        # to be in sync.  Only the live path is counted, not the packets 
+        # read again when the index is rebuilt (linesCounted is the number of
+        # tshark output lines already counted).  If profileFile is set the 
+        # whole session is run under the sampling profiler and its stacks are
+        # written to profileFile.
+        self.metrics = BtleMetrics()
+        self.metricsFile = metricsFile
+        self.metricsInterval = metricsInterval
+        self.metricsLog = None
+        self.showMetrics = showMetrics and not headless
+        self.profileFile = profileFile
+        self.sampler = None
+        self.latestEpoch = 0
+        self.oldestUndisplayed = None
+        self.linesRead = 0
+        self.linesCounted = 0
+
         # stats
         self._min = [0,0,0]
         self._max = [0,0,0]
@@ -146,35 +549,47 @@ class BtleSniffer:
         #print('BtleSniffer dtor')
         pass
 
-    # Generic routine to send a command to the RaspPi.  Only for use with 
-    # commands that return and don'thang until killed.  This is used to send 
-    # init commands.  Command is specified in _cmdStr arg.
+    # return the ssh command line that runs cmdStr on the RaspPi, with X11 
+    # forwarding if x11 is set
+    def getSshCmd(self, cmdStr, x11=False):
+        return self.ssh.getCmd(cmdStr, x11)
+
+    # Run a command on the RaspPi (or the host of another sniffer if its
+    # session is given) and wait for it to exit.  Only for use with commands
+    # that return and don't hang until killed.  Returns the return code and 
+    # the output.
+    async def runPiSnifferCmd(self, _cmdStr, verbose=True, session=None):
+        cmd = session.getCmd(_cmdStr) if session is not None else self.getSshCmd(_cmdStr)
+        process = await asyncio.create_subprocess_exec(*cmd,
+                                                       stdout=subprocess.PIPE)
+        output, _ = await process.communicate()
+        output = output.decode('utf-8', 'replace')
+        if verbose:
+            print(output)
+            print('RETURN CODE', process.returncode)
+        return process.returncode, output
+
+    # Generic routine to send a command to the RaspPi from synchronous code.
+    # This is used to send init commands.  Command is specified in _cmdStr arg.
     def sendPiSnifferCmd(self, _cmdStr):
-        # ssh command to stream a pacapng file over ssh from the rasp pi to the 
-        # local machine and then use tshark to dissect the packets
-        cmd =  ["ssh", "ubuntu@pi_sniffer", _cmdStr]
-
-        # open the process and save the process object as a class member variable
-        process = subprocess.Popen(cmd, 
-                           stdout=subprocess.PIPE,
-                           universal_newlines=True)
+        return asyncio.run(self.runPiSnifferCmd(_cmdStr))
 
-        # monitor the process and wait for exit
-        while True:
-            output = process.stdout.readline()
-
-            # wait for process to exit
-            return_code = process.poll()
-            if return_code is not None:
-                print(output)
-                print('RETURN CODE', return_code)
-                break
-    
     # Initialization routine for setting up the RaspPi.  This turns off 
-    # bluetooth and shuts off WiFi to allow for clean data collections.
+    # bluetooth and shuts off WiFi to allow for clean data collections.  Both
+    # are sent as one command and skipped if they are already off.  With 
+    # several sniffers each host is set up once.
     def initPiSniffer(self):
-        self.sendPiSnifferCmd("sudo systemctl stop bluetooth")
-        self.sendPiSnifferCmd("sudo ifconfig wlan0 down")
+        sessions = list()
+        for endpoint in self.endpoints:
+            session = endpoint.getSession()
+            if endpoint.getInitCmd() is not None and session not in [s for s, cmd in sessions]:
+                sessions.append((session, endpoint.getInitCmd()))
+
+        for session, cmd in sessions:
+            if session is self.ssh:
+                self.sendPiSnifferCmd(cmd)
+            else:
+                asyncio.run(self.runPiSnifferCmd(cmd, session=session))
 
     # wait for main process to exit, if it is running
     def wait(self):
@@ -182,12 +597,156 @@ class BtleSniffer:
             self.mainProcess.join()
         else:
             print("main process not running!")
+        self.waitSegments()
+        self.stopMetrics()
+
+    # start the metrics log and the profiler, if they are wanted
+    def startMetrics(self):
+        if self.metricsFile is not None and self.metricsLog is None:
+            self.metricsLog = BtleMetricsLog(self.metricsFile, self.metrics, self.metricsInterval, self.getPipelineStats)
+            self.metricsLog.start()
+        if self.profileFile is not None and self.sampler is None:
+            self.sampler = BtleSampler()
+            self.sampler.start()
+
+    # write the last metrics line and the profile, and report the plot frame
+    # times
+    def stopMetrics(self):
+        if self.livePlot is not None:
+            self.livePlot.report()
+        if self.metricsLog is not None:
+            self.metricsLog.stop()
+            self.metricsLog = None
+            print("Wrote metrics to " + self.metricsFile)
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler.write(self.profileFile)
+            self.sampler.report()
+            self.sampler = None
+            print("Wrote profile to " + self.profileFile)
+
+    # Start a segment of the running capture at the marker time t (local 
+    # clock, default now).  The segment gets a copy of the current metadata
+    # so it can be changed for the next segment straight away.  If an angle
+    # track is given it is started with the segment and the angle of each
+    # packet is written with the segment files.  Only supported with the 
+    # built in decoder.  Returns False if there is no capture running.
+    def startSegment(self, t=None, angleTrack=None):
+        if self.decoder is None:
+            print("No capture running, can't start a segment!")
+            return False
+        if self.merger is not None:
+            print("Segments are only supported with a single sniffer!")
+            return False
+
+        if self.segment is not None:
+            self.endSegment(t)
+
+        # packets from before the marker were all decoded before it, so the
+        # segment starts at or after the current decoder offset
+        t = time.time() if t is None else t
+        self.segment = (t, self.decoder.offset, copy.copy(self.metaData), angleTrack)
+        if angleTrack is not None:
+            angleTrack.start(t)
+            with self.decodeCond:
+                self.angleTracks.append(angleTrack)
+        print("Starting segment at " + datetime.fromtimestamp(t).strftime('%H:%M:%S.%f') + ", angle " + self.metaData.angle)
+        return True
+
+    # End the current segment at the marker time t (local clock, default now)
+    # and write its data file, stats and pcapng in the background.  Returns 
+    # the thread writing them, or None if no segment was started.
+    def endSegment(self, t=None):
+        if self.segment is None:
+            return None
+
+        t = time.time() if t is None else t
+        tStart, offset, metaData, angleTrack = self.segment
+        self.segment = None
+        if angleTrack is not None:
+            angleTrack.stop(t)
+
+        thread = threading.Thread(target=self.writeSegment, args=(tStart, t, offset, metaData, angleTrack))
+        thread.start()
+        self.segmentThreads.append(thread)
+        return thread
+
+    # wait for the segment files still being written
+    def waitSegments(self):
+        while self.segmentThreads:
+            self.segmentThreads.pop(0).join()
+
+    # Write the files for the packets between the marker times tStart and 
+    # tEnd, which start at offset in the stream.  The files are named after 
+    # the start of the segment.
+    def writeSegment(self, tStart, tEnd, offset, metaData, angleTrack=None, timeout=None):
+        # wait until the stream has caught up with the end of the segment, or
+        # the capture is over.  If the stream never got there the segment is
+        # short, which is logged and noted in its stats files.
+        with self.decodeCond:
+            lag = self.clockLag if self.clockLag is not None else 0
+            pStart = tStart - lag
+            pEnd = tEnd - lag
+            self.decodeCond.wait_for(lambda: self.lastEpoch >= pEnd or self.captureDone, timeout)
+            shortfall = pEnd - max(self.lastEpoch, pStart)
+            end = self.decoder.offset
+            if angleTrack in self.angleTracks:
+                self.angleTracks.remove(angleTrack)
+
+        # the pcapng, the data file and the stats are written in one pass over
+        # the segment, a block at a time
+        fname = "btle_sniffer_" + datetime.fromtimestamp(tStart).strftime("%m-%d-%Y-%H%M%S.csv")
+        pcapngName = fname.replace('csv', 'pcapng')
+        header, chunks = self.endpoints[0].readCapture(offset, end)
+        index = BtleStatsIndex(keepSamples=False)
+        with open(pcapngName, 'wb') as pcapngFile:
+            records = self.iterSegmentRecords(iterPcapngSegment(pcapngFile, header, chunks, pStart, pEnd), index, pStart)
+            numRows = self.writeDataFile(fname, metaData.getOutput(), records, str(metaData.txPower))
+        if self.archiveCodec is not None:
+            compressPcapngFile(pcapngName, self.archiveCodec, self.archiveLevel, self.archiveThreads)
+            os.remove(pcapngName)
+
+        statsNames = [str('stats_' + fname).replace('csv', 'txt'), str('stats_all_' + fname).replace('csv', 'txt')]
+        self.dumpStats(statsNames[0], index=index)
+        self.dumpStats(statsNames[1], allAddrs=True, index=index)
+        if shortfall > 0:
+            print("Segment " + fname + " is short, the stream stopped {:.1f} s before its end".format(shortfall))
+            for statsName in statsNames:
+                with open(statsName, "a") as statsFile:
+                    statsFile.write("short  = {:.1f} s\n".format(shortfall))
+        if angleTrack is not None:
+            angleTrack.flush()
+            angleTrack.writeFiles(fname)
+            print("Segment angles: " + str(len(angleTrack.times)) + " positions, " + str(len(angleTrack.packets)) + 
+                  " packets, " + str(angleTrack.outside) + " outside the track")
+        print("Wrote segment " + fname + ", " + str(numRows) + " packets, angle " + metaData.angle)
+
+    # pass the records of a segment on without the duplicates, adding the 
+    # ones counted in the stats to the index of the segment (the same packets
+    # as the live view) on the way
+    def iterSegmentRecords(self, records, index, pStart):
+        for chunk in self.iterDedupChunks(records):
+            for data in chunk:
+                if self.acceptPacket(data):
+                    index.add(data[BTLE_ADV_ADDR], data[BTLE_CH], data[BTLE_EPOCH] - pStart, data[BTLE_RSSI])
+                yield data
     
     # Killing the wireshark process will force all other threads/subprocesses 
-    # to terminate.
+    # to terminate.  The process belongs to the capture event loop, so it is
+    # terminated from there.
     def kill(self):
-        if self.wiresharkProcess != None:
-            self.wiresharkProcess.terminate()
+        if self.loop is not None and not self.loop.is_closed():
+            for endpoint in self.endpoints:
+                if endpoint.capturePid is not None:
+                    asyncio.run_coroutine_threadsafe(self.stopDetachedCapture(endpoint), self.loop)
+                elif endpoint.process is not None:
+                    self.loop.call_soon_threadsafe(self.terminateProcess, endpoint.process)
+
+    def terminateProcess(self, process):
+        try:
+            process.terminate()
+        except ProcessLookupError:
+            pass
 
     # Creates the master window used for holding the plot and the UI controls.
     def masterPlotWindow(self, canvas, figure, update=False):
@@ -210,6 +769,7 @@ class BtleSniffer:
     def plotRSSI(self):
         if self.runFlag == True:
             # set up plot
+            loadGui()
             style.use('ggplot')
 
             # determine max size to make the figure
@@ -242,17 +802,26 @@ class BtleSniffer:
             self.ax3.set_title("Ch 39 All BTLE Devices")
             self.fig.tight_layout()
 
+            # the blitted plot hooks the canvas draw event, so it is created 
+            # once the figure has been added to the window
+            self.livePlot = None
+
     # This function must be called periodically to read new data and plot it.
+    # Returns True if the plot was updated.
     def animatePlot(self, i, window):
-        # open the file containing data to plot and read.  Data is stored as 
-        # CSV so split before using.
-        lines = open('btle_sniffer.out','r').readlines()
-        xs1 = []
-        ys1 = []
-        xs2 = []
-        ys2 = []
-        xs3 = []
-        ys3 = []
+        # read only the packets received since the last call from the data 
+        # file and add them to the per-channel buffers.  With the built in 
+        # decoder the aggregate stage has already done this.
+        if self.useTshark:
+            with self.metrics.timed('parse'):
+                lines = self.outReader.readLines()
+                with self.indexLock:
+                    self.processLines(lines)
+
+        # report the pipeline counters every 20 calls (10s)
+        self.numTicks = self.numTicks + 1
+        if self.numTicks % 20 == 0:
+            self.reportPipeline()
 
         # Plot title
         title = ""
@@ -261,124 +830,409 @@ class BtleSniffer:
         else:
             title = self.filter
 
-        # loop over all data read
-        num = 0
-        rssiCounts = dict({"*":"*"})
-        t0 = 0
-        for line in lines:
-            line = line.rstrip()
-            # FIXME - skip the first line, it is garbage
-            num = num + 1
-            if num == 1:
-                continue
-            if num == len(lines):
-                continue
+        # copy of the aggregates for the selected address
+        with self.metrics.timed('snapshot'):
+            entry = self.getSnapshot()
+
+        if self.showMetrics:
+            self.updateMetricsPanel(window)
 
+        # update the plot (3 subplots)
+        if not pyplot.fignum_exists(self.fig.number) or self.pausePlot:
+            return False
+
+        with self.metrics.timed('draw'):
+            if self.livePlot is not None:
+                self.livePlot.update(entry, title, self.plotMarker, self.windowLen)
+            else:
+                xs1, ys1 = entry.getData(0, self.windowLen)
+                xs2, ys2 = entry.getData(1, self.windowLen)
+                xs3, ys3 = entry.getData(2, self.windowLen)
+
+                self.ax1.clear()
+                self.ax1.set_title("Ch 37 " + title)
+                self.ax1.set_xlabel("Time (s)")
+                self.ax1.set_ylabel("RSSI (dB)")
+                self.ax1.plot(xs1, ys1, linewidth=1, marker=self.plotMarker)
+                self.ax2.clear()
+                self.ax2.set_title("Ch 38 " + title)
+                self.ax2.set_xlabel("Time (s)")
+                self.ax2.set_ylabel("RSSI (dB)")
+                self.ax2.plot(xs2, ys2, linewidth=1, marker=self.plotMarker)
+                self.ax3.clear()
+                self.ax3.set_title("Ch 39 " + title)
+                self.ax3.set_xlabel("Time (s)")
+                self.ax3.set_ylabel("RSSI (dB)")
+                self.ax3.plot(xs3, ys3, linewidth=1, marker=self.plotMarker)
+
+        # update the stats panel on the window using new data
+        with self.metrics.timed('updateStats'):
+            self.updateStats(window, entry)
+        return True
+
+    # Record the latency of the oldest packet added since the last frame, 
+    # once the frame is on the screen.  If nothing was drawn (the plot is
+    # paused) the packets are not counted.  The packet time is moved to the
+    # local clock with clockLag, the smallest lag seen between the two 
+    # clocks, so this is the latency on top of the fastest packet delivery.
+    def markDisplayed(self, drawn=True):
+        with self.indexLock:
+            oldest = self.oldestUndisplayed
+            self.oldestUndisplayed = None
+        if drawn and oldest is not None:
+            lag = self.clockLag if self.clockLag is not None else 0
+            self.metrics.addTime('latency.display', time.time() - oldest - lag)
+
+    # return a dict of the tee, stage and decoder counters for the metrics log
+    def getPipelineStats(self):
+        stats = {'clockLag': self.clockLag}
+        if self.tee is not None:
+            stats['tee'] = self.tee.getStats()
+        stats['stages'] = [stage.getStats() for stage in self.getStages()]
+        stats['failedStages'] = [stage.name for stage in self.getStages() if stage.failed]
+        if self.merger is not None:
+            stats['sniffers'] = [endpoint.getStats() for endpoint in self.endpoints]
+            stats['merge'] = self.merger.getStats()
+        if self.dedup is not None:
+            stats['dedup'] = self.dedup.getStats()
+        archives = [endpoint.archive.getStats() for endpoint in self.endpoints if endpoint.archive is not None]
+        if archives:
+            stats['archives'] = archives
+        if self.decoder is not None:
+            stats['decoder'] = {'offset': self.decoder.offset, 'packets': self.decoder.packets, 'lost': self.decoder.lost,
+                                'resyncs': self.decoder.resyncs, 'skipped': self.decoder.skipped,
+                                'badBlocks': self.decoder.badBlocks, 'skippedBytes': self.decoder.skippedBytes,
+                                'badRssi': self.decoder.badRssi}
+        return stats
+
+    # show the main counters and timers in the metrics panel below the plot
+    def updateMetricsPanel(self, window):
+        metrics = self.metrics
+        rate = sum([endpoint.tee.bytesPerSec/1000 for endpoint in self.endpoints if endpoint.tee is not None])
+        window["-MetRows-"].update('{} rows, {:3.1f} kB/s'.format(metrics.getCounter('rows'), rate))
+        failed = [stage for stage in self.getStages() if stage.failed]
+        window["-MetDrops-"].update('crc {}, scan {}, rssi {}, short {}, dup {}{}'.format(metrics.getCounter('dropped.crc'),
+                                    metrics.getCounter('dropped.scanAddr'), metrics.getCounter('dropped.rssi'),
+                                    metrics.getCounter('dropped.shortLine'),
+                                    self.dedup.removed if self.dedup is not None else 0,
+                                    ', ' + ' '.join([stage.name for stage in failed]) + ' FAILED' if failed else ''))
+        for key, name in (("-MetParse-", 'parse' if self.useTshark else 'decode'), ("-MetDraw-", 'draw'), 
+                          ("-MetStats-", 'updateStats'), ("-MetLatency-", 'latency.display')):
+            timer = metrics.getTimer(name)
+            if timer is not None:
+                stats = timer.getStats()
+                window[key].update('{:3.1f} ms (max {:3.1f})'.format(stats['recentAvg']*1000, stats['recentMax']*1000))
+
+    # Parse newly read lines from the data file and append them to the 
+    # per-channel buffers.  The buffers and the RSSI counters persist between
+    # calls so only new packets are processed on each timeout.  Duplicate 
+    # packets are dropped first.  After resetPlotData the lines are read 
+    # again from the start, the ones already counted in the metrics are not
+    # counted again.
+    def processLines(self, lines):
+        dedup = self.dedup
+        rows = 0
+        lag = None
+        now = time.time()
+        for line in lines:
+            self.linesRead = self.linesRead + 1
+            live = self.linesRead > self.linesCounted
             if len(line) > 1:
                 data = line.split(',')
                 if len(data) >= 6:
-                    # check if the CRC is bad, if it is skip this packet
-                    crcOk = int(data[BTLE_CRCOK])
-                    if not crcOk:
+                    try:
+                        t = self.timeParser.parse(data[BTLE_TIME])
+                    except ValueError:
+                        if live:
+                            self.metrics.count('dropped.badTime')
+                            print("ERROR: bad time ", data[BTLE_TIME], " ", self.outReader.lineNum)
                         continue
+                    if live:
+                        rows = rows + 1
+                    if dedup is not None and dedup.isDuplicate(t, data[BTLE_ADV_ADDR], data[BTLE_CH], data[BTLE_RSSI]):
+                        continue
+                    if self.processPacket(data, t, live) and live:
+                        lag = now - t if lag is None else min(lag, now - t)
+                elif live:
+                    self.metrics.count('dropped.shortLine')
+                    print("ERROR: unexpected data length ", len(data), " ", self.outReader.lineNum)
+        self.linesCounted = max(self.linesCounted, self.linesRead)
+        self.metrics.count('rows', rows)
+        if lag is not None:
+            with self.decodeCond:
+                if self.clockLag is None or lag < self.clockLag:
+                    self.clockLag = lag
+
+    # Add records from the built in decoder to the per-channel buffers.  
+    # live is False when the records are read again to rebuild the index, 
+    # they were counted in the metrics already.
+    def processRecords(self, records, live=True):
+        if live:
+            self.metrics.count('rows', len(records))
+        for record in records:
+            self.processPacket(record, record[BTLE_EPOCH], live)
+
+    # Add a single packet to the per-channel buffers, the epoch time t is 
+    # parsed from the timestamp field if not given.  Dropped packets are 
+    # counted in the metrics by reason, if the packet is live.  Returns True
+    # if the packet was added.
+    def processPacket(self, data, t=None, live=True):
+        reason = self.getDropReason(data)
+        if reason is not None:
+            if live:
+                self.metrics.count(reason)
+            return False
+
+        # convert timestamp to seconds since start of capture
+        if t is None:
+            t = self.timeParser.parse(data[BTLE_TIME])
+
+        # oldest new packet waiting for the display, for the latency
+        if live and t > self.latestEpoch:
+            if self.oldestUndisplayed is None:
+                self.oldestUndisplayed = t
+            self.latestEpoch = t
+        
+        # get the first timestamp to use in calculating the display
+        # time (seconds since start of capture)
+        if self.t0 is None:
+            self.t0 = t
+
+        # add to the index, this counts the RSSI samples for the 
+        # address and separates the data by channel (37, 38 or 39)
+        self.statsIndex.add(data[BTLE_ADV_ADDR], data[BTLE_CH], t - self.t0, data[BTLE_RSSI])
+        return True
+
+    # return True if the packet should be counted in the stats
+    def acceptPacket(self, data):
+        return self.getDropReason(data) is None
+
+    # return the metrics counter for the reason the packet is not counted in
+    # the stats, or None if it is
+    def getDropReason(self, data):
+        # check if the CRC is bad, if it is skip this packet
+        crcOk = int(data[BTLE_CRCOK])
+        if not crcOk:
+            return 'dropped.crc'
+
+        # check scan addr, only look at packets with NULL scan 
+        # addr, others are phone to phone
+        if self.suppressNonNullScanAddr:
+            scanAddr = data[BTLE_SCAN_ADDR]
+            if scanAddr != '':
+                return 'dropped.scanAddr'
+
+        # an RSSI that can't be stored (the built in decoder drops these 
+        # already, tshark prints them)
+        if data[BTLE_RSSI] not in BTLE_RSSI_VALUES:
+            return 'dropped.rssi'
+
+        return None
+
+    # Decode stage of a sniffer (the first by default), decode a chunk of its
+    # stream and pass the batch of records on, to the merge stage if there 
+    # are several sniffers.  Packets on other channels than the one the 
+    # sniffer is pinned to are counted.
+    def decodeBytes(self, data, endpoint=None):
+        if endpoint is None:
+            endpoint = self.endpoints[0]
+        badRssi = endpoint.decoder.badRssi
+        with self.metrics.timed('decode' if self.merger is None else 'decode.' + endpoint.name):
+            records = endpoint.decoder.feed(data)
+        if endpoint.decoder.badRssi != badRssi:
+            self.metrics.count('dropped.rssi', endpoint.decoder.badRssi - badRssi)
+        if not records:
+            return
 
-                    # check scan addr, only look at packets with NULL scan 
-                    # addr, others are phone to phone
-                    if self.suppressNonNullScanAddr:
-                        scanAddr = data[BTLE_SCAN_ADDR]
-                        if scanAddr != '':
-                            continue
-
-                    # convert timestamp to seconds since start of capture
-                    s = data[BTLE_TIME]
-                    d = datetime.strptime(s, "%Y-%m-%d %H:%M:%S.%f")
-                    t = time.mktime(d.timetuple()) + d.microsecond/1.0e6
-                    
-                    # get the first timestamp to use in calculating the display
-                    # time (seconds since start of capture)
-                    if num == 2:
-                        t0 = t
-
-                    # count the number of RSSI samples for this address
-                    if data[BTLE_ADV_ADDR] in rssiCounts:
-                        rssiCounts[data[BTLE_ADV_ADDR]] = rssiCounts[data[BTLE_ADV_ADDR]] + 1 
-                    else:
-                        rssiCounts[data[BTLE_ADV_ADDR]] = 1
-
-                    # check if this address is the selected one (or none means show all)
-                    if (data[BTLE_ADV_ADDR].lower() == self.filter.lower()) or self.filter == "":
-                        # separate the data by channel (37, 38 or 39)
-                        if data[BTLE_CH] == "37":
-                            xs1.append(float(t-t0))
-                            ys1.append(float(data[BTLE_RSSI]))
-                        if data[BTLE_CH] == "38":
-                            xs2.append(float(t-t0))
-                            ys2.append(float(data[BTLE_RSSI]))
-                        if data[BTLE_CH] == "39":
-                            xs3.append(float(t-t0))
-                            ys3.append(float(data[BTLE_RSSI]))
-
-                else:
-                    print("ERROR: unexpected data length ", len(data), " ", num)
+        if endpoint.channel is not None:
+            endpoint.offChannel = endpoint.offChannel + sum([1 for record in records if record[BTLE_CH] != endpoint.channel])
 
-        # update the plot (3 subplots)
-        if pyplot.fignum_exists(self.fig.number) and not self.pausePlot:
-            self.ax1.clear()
-            self.ax1.set_title("Ch 37 " + title)
-            self.ax1.set_xlabel("Time (s)")
-            self.ax1.set_ylabel("RSSI (dB)")
-            self.ax1.plot(xs1, ys1, linewidth=1, marker=self.plotMarker)
-            self.ax2.clear()
-            self.ax2.set_title("Ch 38 " + title)
-            self.ax2.set_xlabel("Time (s)")
-            self.ax2.set_ylabel("RSSI (dB)")
-            self.ax2.plot(xs2, ys2, linewidth=1, marker=self.plotMarker)
-            self.ax3.clear()
-            self.ax3.set_title("Ch 39 " + title)
-            self.ax3.set_xlabel("Time (s)")
-            self.ax3.set_ylabel("RSSI (dB)")
-            self.ax3.plot(xs3, ys3, linewidth=1, marker=self.plotMarker)
+        if self.mergeStage is not None:
+            self.mergeStage.put((endpoint.idx, records))
+        else:
+            self.forwardRecords(endpoint.decoder.offset, records)
+
+    # Merge stage, add a batch of records from one sniffer to the merge and
+    # pass on the records it releases, tagged with the number of records
+    # released so far.
+    def mergeRecords(self, batch):
+        idx, records = batch
+        with self.metrics.timed('merge'):
+            records = self.merger.add(idx, records)
+        if records:
+            self.forwardRecords(self.merger.released, records)
+
+    # Drop the duplicate records from a batch and pass the rest to the data
+    # file writer and to the aggregate stage, tagged with offset: the stream
+    # offset just past its last packet (or the merge count with several 
+    # sniffers).
+    def forwardRecords(self, offset, records):
+        if self.dedup is not None:
+            with self.metrics.timed('dedup'):
+                records = self.dedup.filter(records)
+            if not records:
+                return
+
+        if self.csvWriter is not None:
+            self.csvWriter.put(records)
+        self.aggregateStage.put((offset, records))
+
+        lag = time.time() - records[-1][BTLE_EPOCH]
+        with self.decodeCond:
+            self.lastEpoch = records[-1][BTLE_EPOCH]
+            if self.clockLag is None or lag < self.clockLag:
+                self.clockLag = lag
+            if self.angleTracks:
+                self.addAngleRecords(records)
+            self.decodeCond.notify_all()
+
+    # add the accepted records to the angle tracks, with their times moved
+    # to the local clock
+    def addAngleRecords(self, records):
+        for data in records:
+            if self.acceptPacket(data):
+                t = data[BTLE_EPOCH] + self.clockLag
+                for track in self.angleTracks:
+                    track.add(t, data[BTLE_EPOCH], data[BTLE_ADV_ADDR], data[BTLE_CH], data[BTLE_RSSI])
+
+    # Aggregate stage, add a batch of records to the index and remember its
+    # offset.  A batch without records is queued by resetPlotData to rebuild
+    # the index, which then covers exactly the batches added before it.
+    def aggregateRecords(self, batch):
+        offset, records = batch
+        if records is None:
+            self.rebuildIndex()
+            return
+        with self.metrics.timed('aggregate'), self.indexLock:
+            self.processRecords(records)
+            self.aggregatedOffset = offset
+
+    # return the running pipeline stages
+    def getStages(self):
+        stages = [endpoint.decodeStage for endpoint in self.endpoints] + [self.mergeStage, self.aggregateStage]
+        stages = stages + [endpoint.archiveStage for endpoint in self.endpoints]
+        if self.csvWriter is not None:
+            stages.append(self.csvWriter.stage)
+        return [stage for stage in stages if stage is not None]
+
+    # print the queue depths and counters of the pipeline
+    def reportPipeline(self):
+        for endpoint in self.endpoints:
+            if self.merger is not None or endpoint.reconnects > 0:
+                endpoint.report()
+            if endpoint.tee is not None:
+                endpoint.tee.report()
+        for stage in self.getStages():
+            stage.report()
+        if self.dedup is not None:
+            self.dedup.report()
+        for endpoint in self.endpoints:
+            if endpoint.archive is not None:
+                endpoint.archive.report()
+        if self.merger is not None:
+            self.merger.report()
+        elif self.decoder is not None:
+            print('Decoder: {} packets, {} lost by the sniffer, {} resyncs, {} skipped, {} corrupt blocks ({} bytes), {} bad RSSI'.format(
+                  self.decoder.packets, self.decoder.lost, self.decoder.resyncs, self.decoder.skipped,
+                  self.decoder.badBlocks, self.decoder.skippedBytes, self.decoder.badRssi))
+
+    # Clear the index and build it again.  Used when the scan suppression 
+    # setting changes.  With tshark the data file reader is rewound so the
+    # next timeout reads it all again.  The records of the built in decoder
+    # are not kept, so the aggregate stage is asked to rebuild the index 
+    # from the local copy of the stream (rebuildIndex), which keeps the 
+    # rebuild off the UI thread and in order with the live batches.  Once 
+    # the stage has stopped the index is rebuilt here.
+    def resetPlotData(self):
+        if self.useTshark or self.decoder is None:
+            with self.indexLock:
+                self.outReader.reset()
+                self.statsIndex.reset()
+                self.t0 = None
+                self.linesRead = 0
+                if self.dedup is not None:
+                    self.dedup.reset()
+            return
 
-            # update the stats panel on the window using new data
-            self.updateStats(window, ys1,ys2,ys3)
-        
-        # update the class var that holds all RSSI counters
-        self.rssiCounts = rssiCounts
+        stage = self.aggregateStage
+        if stage is not None and stage.thread.is_alive() and not stage.failed:
+            stage.put((None, None))
+        else:
+            self.rebuildIndex()
+
+    # Rebuild the index from the local copy of the stream up to the offset 
+    # of the last batch the aggregate stage added.  With several sniffers 
+    # the copies of the streams are merged again, up to the number of 
+    # records the merge had released.  The records are streamed and added
+    # chunkSize at a time, releasing the index lock in between so the UI 
+    # can take snapshots of the partly built index.
+    def rebuildIndex(self, chunkSize=5000):
+        with self.indexLock:
+            self.statsIndex.reset()
+            self.t0 = None
+            length = self.aggregatedOffset
+
+        if self.merger is None:
+            records = iter(self.endpoints[0].iterCapture(length))
+        else:
+            with self.merger.lock:
+                lengths = [endpoint.decoder.offset for endpoint in self.endpoints]
+            iters = [endpoint.iterCapture(end) for endpoint, end in zip(self.endpoints, lengths)]
+            records = itertools.islice(mergeRecords(iters), length)
+
+        for chunk in self.iterDedupChunks(records, chunkSize):
+            with self.indexLock:
+                self.processRecords(chunk, live=False)
+
+    # Yield the records read back from the capture chunkSize at a time, 
+    # without the duplicates, using a new window so the live one is not 
+    # disturbed
+    def iterDedupChunks(self, records, chunkSize=5000):
+        dedup = None
+        if self.dedup is not None:
+            dedup = BtleDedup(self.dedup.window, self.dedup.tolerance)
+        records = iter(records)
+        while True:
+            chunk = list(itertools.islice(records, chunkSize))
+            if not chunk:
+                return
+            yield chunk if dedup is None else dedup.filter(chunk)
+
+    # return the index entry for the currently selected address
+    def getFilterEntry(self):
+        entry = self.statsIndex.get(self.filter)
+        if entry is None:
+            entry = BtleAddrEntry(self.filter)
+        return entry
+
+    # return a copy of the entry for the currently selected address, only
+    # holding the samples in the live view window
+    def getSnapshot(self):
+        with self.indexLock:
+            return self.getFilterEntry().snapshot(self.windowLen)
+
+    # copy the current running stats of the entry (by default a snapshot of
+    # the selected address) into the class vars used for display and for the
+    # stats file.  Returns False if there is not enough data yet.
+    def calcStats(self, entry=None):
+        if entry is None:
+            entry = self.getSnapshot()
+        allStats = [stats.getStats() for stats in entry.stats]
+        if None in allStats:
+            return False
+
+        for i in range(3):
+            self._min[i], self._max[i], self._mean[i], self._median[i], \
+                self._mode[i], self._std[i], self._range[i] = allStats[i]
+
+        return True
 
     # calculate new stats and then post them to the screen widgets for display
-    def updateStats(self, window, rssi1, rssi2, rssi3):
-        if not rssi1 or not rssi2 or not rssi3:
+    def updateStats(self, window, entry=None):
+        if not self.calcStats(entry):
             print("RSSI not received yet!")
             return
 
-        self._min[0] = min(rssi1) 
-        self._min[1] = min(rssi2) 
-        self._min[2] = min(rssi3) 
-
-        self._max[0] = max(rssi1) 
-        self._max[1] = max(rssi2) 
-        self._max[2] = max(rssi3) 
-
-        self._mean[0] = statistics.mean(rssi1) 
-        self._mean[1] = statistics.mean(rssi2) 
-        self._mean[2] = statistics.mean(rssi3) 
-
-        self._median[0] = statistics.median(rssi1) 
-        self._median[1] = statistics.median(rssi2) 
-        self._median[2] = statistics.median(rssi3) 
-
-        self._mode[0] = (max(set(rssi1), key=rssi1.count)) 
-        self._mode[1] = (max(set(rssi2), key=rssi2.count)) 
-        self._mode[2] = (max(set(rssi3), key=rssi3.count)) 
-
-        self._std[0] = statistics.stdev(rssi1) 
-        self._std[1] = statistics.stdev(rssi2) 
-        self._std[2] = statistics.stdev(rssi3) 
-
-        self._range[0] = self._max[0] - self._min[0] 
-        self._range[1] = self._max[1] - self._min[1] 
-        self._range[2] = self._max[2] - self._min[2] 
-
         window["-Min1-"].update(str(self._min[0]))
         window["-Min2-"].update(str(self._min[1]))
         window["-Min3-"].update(str(self._min[2]))
@@ -408,18 +1262,16 @@ class BtleSniffer:
         window["-Rng3-"].update(str(self._range[2]))
 
     # Create a list of addresses plus the associated RSSI count on each for 
-    # display in the UI ComboBox.  If the hideInfrequent flag is set then don't
-    # add those to the list.
+    # display in the UI ComboBox, sorted by count.  If the hideInfrequent flag
+    # is set then don't add those to the list.
     def getAddrList(self):
-        addrs = list()
-        for k, v in self.rssiCounts.items():
-            if k != "":
-                if k == "*":
-                    addrs.append(str(k) + ' ' + str(v))
-                elif (self.hideInfrequent and int(v) > self.infrequentThresh) or (not self.hideInfrequent):
-                    addrs.append(str(k) + ' ' + str(v))
+        minCount = self.infrequentThresh if self.hideInfrequent else 0
+        addrs = ['* *']
+        with self.indexLock:
+            for entry in self.statsIndex.getSorted(minCount):
+                addrs.append(entry.getLabel())
 
-        return sorted(addrs)
+        return addrs
 
     # This routine runs the loop that reads data from the UI window and then 
     # performs the requested actions.
@@ -442,6 +1294,8 @@ class BtleSniffer:
                         [sg.Checkbox("Show data points", default=False, font=("Courier", 10), key="-ShowDataPoints-")],
                         [sg.Checkbox("Pause plot updates", default=False, font=("Courier", 10), key="-PausePlot-")],
                         [sg.Checkbox("Suppress BT Scans", default=True, font=("Courier", 10), key="-SuppressScans-")],
+                        [sg.Text('Plot window (s, 0=all): ', font=("Courier", 10)), 
+                         sg.Input(str(self.windowLen), size=(8,1), font=("Courier", 10), key="-Window-")],
                         [sg.Button('OK'), sg.Button('Refresh Addr List')] ]
             
             col2 = [ [sg.Text('   Stats ', size=(10,1), font=("Courier",10)), sg.Text('Ch 37', size=(10,1), font=("Courier",10)), sg.Text('Ch 38', size=(10,1), font=("Courier",10)), sg.Text('Ch 39', size=(10,1), font=("Courier",10))],
@@ -454,8 +1308,20 @@ class BtleSniffer:
                     [sg.Text('    Rng   ', size=(10,1), font=("Courier",10)), sg.Text(str(self._range[0]), key="-Rng1-", size=(10,1), font=("Courier",10)), sg.Text(str(self._range[1]), key="-Rng2-", size=(10,1), font=("Courier",10)), sg.Text(str(self._range[2]), key="-Rng3-", size=(10,1), font=("Courier",10))]
                   ]
 
+            # optional col3 contains the metrics of the capture pipeline
+            col3 = [ [sg.Text('Metrics', size=(10,1), font=("Courier",10))],
+                     [sg.Text('Rows     ', font=("Courier",10)), sg.Text('', key="-MetRows-", size=(28,1), font=("Courier",10))],
+                     [sg.Text('Dropped  ', font=("Courier",10)), sg.Text('', key="-MetDrops-", size=(28,1), font=("Courier",10))],
+                     [sg.Text('Parse    ', font=("Courier",10)), sg.Text('', key="-MetParse-", size=(28,1), font=("Courier",10))],
+                     [sg.Text('Draw     ', font=("Courier",10)), sg.Text('', key="-MetDraw-", size=(28,1), font=("Courier",10))],
+                     [sg.Text('Stats    ', font=("Courier",10)), sg.Text('', key="-MetStats-", size=(28,1), font=("Courier",10))],
+                     [sg.Text('Latency  ', font=("Courier",10)), sg.Text('', key="-MetLatency-", size=(28,1), font=("Courier",10))] ]
+
+            columns = [sg.Column(col1), sg.Column(col2)]
+            if self.showMetrics:
+                columns.append(sg.Column(col3))
             layout = [  [sg.Canvas(size=(figW, figH), key="canvas")], 
-                        [sg.Column(col1), sg.Column(col2)]]
+                        columns]
             
             # Create the Window
             window = sg.Window('RSSI Filter', layout, resizable=True, finalize=True)
@@ -463,6 +1329,8 @@ class BtleSniffer:
 
             # add the plot to the window
             self.figCanvasAgg = self.masterPlotWindow(window['canvas'].TKCanvas, self.fig)
+            if self.blitPlot:
+                self.livePlot = BtleLivePlot(self.fig, [self.ax1, self.ax2, self.ax3], self.plotMarker)
 
             # Event Loop to process "events" and get the "values" of the inputs
             done = False
@@ -475,7 +1343,7 @@ class BtleSniffer:
                 # OK - update display based on user input
                 # Timeout - allows for periodic screen updates/plot animation, or 
                 #           exiting when wireshark is killed
-                if not self.runFlag:
+                if not self.runFlag and not self.dataFileDone:
                     self.generateDataFile()
                 
                 if event in (None, "Exit"):
@@ -491,10 +1359,11 @@ class BtleSniffer:
                     # get the value chosen to filter on
                     print('Filtering ', values["-ComboList-"])
                     v = values["-ComboList-"].split(" ")
+                    _filter = self.filter
                     if len(v) == 2:
                         if v[0] == "*":
                             v[0] = ""
-                        self.filter = v[0]
+                        _filter = v[0]
                     else:
                         print("Unexpected value length: ", len(v))
                     
@@ -510,7 +1379,25 @@ class BtleSniffer:
 
                     self.pausePlot = values["-PausePlot-"]
 
-                    self.suppressNonNullScanAddr = values['-SuppressScans-']
+                    # change the length of the live view window
+                    try:
+                        windowLen = float(values["-Window-"])
+                    except ValueError:
+                        windowLen = -1
+                    if windowLen < 0:
+                        print("Invalid plot window: ", values["-Window-"])
+                    elif windowLen != self.windowLen:
+                        self.windowLen = windowLen
+                        with self.indexLock:
+                            self.statsIndex.setWindow(windowLen)
+
+                    # switching the address is a lookup in the index, but the 
+                    # index only holds the unsuppressed packets so rebuild it
+                    # when the scan suppression setting changes
+                    self.filter = _filter
+                    if values['-SuppressScans-'] != self.suppressNonNullScanAddr:
+                        self.suppressNonNullScanAddr = values['-SuppressScans-']
+                        self.resetPlotData()
 
                 elif event in (None, "-Timeout-"):
                     # check if the exit flag was set, if so exit this loop and quit.  
@@ -519,8 +1406,13 @@ class BtleSniffer:
                         print("runFlag set to False, exiting...")
                         done = True
                     else:
-                        self.animatePlot(0, window)
-                        self.figCanvasAgg = self.masterPlotWindow(window['canvas'].TKCanvas, self.fig, update=True)
+                        drawn = self.animatePlot(0, window)
+
+                        # the blitted plot draws directly on the canvas
+                        if self.livePlot is None:
+                            with self.metrics.timed('render'):
+                                self.figCanvasAgg = self.masterPlotWindow(window['canvas'].TKCanvas, self.fig, update=True)
+                        self.markDisplayed(drawn)
                 else:
                     print("Unknown event: ", event)
 
@@ -528,78 +1420,236 @@ class BtleSniffer:
 
         print("Exiting mainUiLoop")
 
-    # Spawn threads for capturing btle RSSI and other info
+    # Loop used in place of the UI when running headless.  Waits for the 
+    # capture to end, reading new tshark output and printing the stats every
+    # statsInterval seconds, then writes the data file.  The capture is 
+    # stopped after captureDuration seconds, if set, or on ctrl-c (see 
+    # interruptCapture).  Either way the loop carries on until the capture 
+    # has ended so the data file holds everything that was streamed.
+    def headlessLoop(self):
+        print("Running headless, printing stats every " + str(self.statsInterval) + " s, ctrl-c to stop\n")
+        stopTime = None
+        if self.captureDuration > 0:
+            stopTime = time.time() + self.captureDuration
+        while self.runFlag == True:
+            interval = self.statsInterval
+            if stopTime is not None:
+                if time.time() >= stopTime:
+                    print("Capture duration of " + str(self.captureDuration) + " s reached, stopping the capture")
+                    stopTime = None
+                    self.kill()
+                else:
+                    interval = min(interval, stopTime - time.time())
+            self.mainProcess.join(interval)
+            if self.useTshark:
+                with self.metrics.timed('parse'):
+                    lines = self.outReader.readLines()
+                    with self.indexLock:
+                        self.processLines(lines)
+            self.printStats()
+
+        self.generateDataFile()
+        print("Exiting headlessLoop")
+
+    # SIGINT handler of a headless capture.  Stops the capture instead of 
+    # raising KeyboardInterrupt, which would leave the capture threads running
+    # and the data file unwritten.
+    def interruptCapture(self, signum, frame):
+        print("\nStopping the capture")
+        self.kill()
+
+    # print the packet counts and the running stats of the selected address
+    def printStats(self):
+        with self.indexLock:
+            entry = self.getFilterEntry()
+            count = entry.count
+            allStats = [stats.getStats() for stats in entry.stats]
+            numAddrs = len(self.statsIndex.entries)
+
+        self.reportPipeline()
+        name = self.filter if self.filter != "" else "All BTLE Devices"
+        print(datetime.now().strftime('%H:%M:%S') + " " + name + ": " + str(count) + " packets, " + str(numAddrs) + " addrs")
+        for ch, stats in zip(("37", "38", "39"), allStats):
+            if stats is None:
+                print("  Ch " + ch + ": RSSI not received yet!")
+            else:
+                print("  Ch " + ch + ": min {:3.0f} max {:3.0f} mean {:3.2f} median {:3.1f} mode {:3.0f} std {:3.2f}".format(*stats[:6]))
+
+    # Spawn threads for capturing btle RSSI and other info, and start the UI
+    # once the capture file on the RaspPi starts growing
     def run(self):
         print("run")
         self.runFlag = True
+        self.captureStarted.clear()
+        self.startMetrics()
         self.mainProcess = threading.Thread(target=self.spawnThreads)
         self.mainProcess.start()
 
-        time.sleep(12)
+        if self.headless:
+            # only the main thread gets signals
+            mainThread = threading.current_thread() is threading.main_thread()
+            if mainThread:
+                previous = signal.signal(signal.SIGINT, self.interruptCapture)
+            self.captureStarted.wait()
+            self.headlessLoop()
+            if mainThread:
+                signal.signal(signal.SIGINT, previous)
+            return
+
+        # the GUI modules load while the sniffer host starts capturing
+        loadGui()
+        self.captureStarted.wait()
         self.plotRSSI()
         self.mainUiLoop() 
 
-    # spawn all threads, then wait for wireshark thread to exit and set the 
-    # runFlag to false to cause other threads to quit.
+    # run the capture on its own event loop, then set the runFlag to false to
+    # cause other threads to quit
     def spawnThreads(self):
         print("spawnThreads")
-
-        # spawn wireshark
-        self.t[0] = threading.Thread(target=self.runWireshark)
-        self.t[0].start()
-
-        # Give wireshark time to open, there is no other direct way to do this, 
-        # so use sleep. Then spawn tshark that runs on the local machine.
-        time.sleep(10)      
-        self.t[1] = threading.Thread(target=self.runTshark)
-        self.t[1].start()
-
-        # wait for wireshark to exit, then send SIGTERM to tshark
-        self.t[0].join()
-
-        # terminate other subprocesses and wait for them to finish
-        self.tsharkProcess[0].terminate()
-        self.tsharkProcess[1].terminate()
-        self.t[1].join()
-        
+        asyncio.run(self.runCapture())
         self.runFlag = False
 
+    # Start wireshark on the RaspPi and, as soon as it is writing the capture 
+    # file, start streaming the file.  Then wait for wireshark to exit and 
+    # terminate the stream.  Nothing here polls: the event loop waits on the
+    # process exits and the stream is pumped by the tee.
+    async def runCapture(self):
+        self.loop = asyncio.get_running_loop()
+        self.streamStop.clear()
+
+        # start from empty capture files so their size shows when wireshark
+        # has started capturing, each sniffer on the same host gets its own
+        for endpoint in self.endpoints:
+            if endpoint.captureFile is None:
+                endpoint.captureFile = PI_CAPTURE_FILE
+                if endpoint.idx > 0:
+                    endpoint.captureFile = PI_CAPTURE_FILE.replace('.pcapng', '_' + endpoint.name + '.pcapng')
+        await asyncio.gather(*[self.runPiSnifferCmd("rm -f " + endpoint.captureFile + "; touch " + endpoint.captureFile,
+                                                    session=endpoint.getSession()) for endpoint in self.endpoints])
+        await asyncio.gather(*[self.runWireshark(endpoint) for endpoint in self.endpoints])
+        self.wiresharkProcess = self.endpoints[0].process
+
+        exited = [asyncio.ensure_future(self.waitForExit(endpoint)) for endpoint in self.endpoints]
+        started = asyncio.ensure_future(asyncio.gather(*[self.waitForCapture(endpoint) for endpoint in self.endpoints]))
+        await asyncio.wait(exited + [started], return_when=asyncio.FIRST_COMPLETED)
+
+        if not started.done():
+            started.cancel()
+            print("wireshark exited before the capture started!")
+            self.runFlag = False
+            self.kill()
+            await asyncio.wait(exited)
+        else:
+            # stream and decode the captures on worker threads until wireshark
+            # exits, then send SIGTERM to the stream processes
+            stream = asyncio.ensure_future(asyncio.to_thread(self.runTshark))
+            self.captureStarted.set()
+            await asyncio.wait(exited)
+
+            self.streamStop.set()
+            for proc in self.tsharkProcess + [endpoint.streamProcess for endpoint in self.endpoints]:
+                if proc is not None:
+                    proc.terminate()
+            await stream
+
+        for endpoint in self.endpoints:
+            print('RETURN CODE', endpoint.process.returncode)
+
+        # let the UI start (and exit) even if there was no capture
+        self.captureStarted.set()
+
+    # wait until the capture file of the sniffer is not empty any more, 
+    # checking every interval seconds
+    async def waitForCapture(self, endpoint, interval=0.5):
+        while True:
+            returnCode, output = await self.runPiSnifferCmd("stat -c %s " + endpoint.captureFile, verbose=False,
+                                                            session=endpoint.getSession())
+            if returnCode == 0 and output.strip().isdigit() and int(output) > 0:
+                print("Capture file " + endpoint.captureFile + " is growing, starting the stream")
+                return
+            await asyncio.sleep(interval)
+
     # Remotely run wireshark on the sniffer host, start capturing immediately on
     # the sniffer interface, and redirect its output to a file for reading.  This
     # is all a workaround for the fact that the Nordic Semi Btle Sniffer does not
     # work with tshark and requires wireshark with the Nodic Semi toolbar plugin.
     # Nordic Semi plans to support tshark in a future release but there is no date
     # for that yet.
-    def runWireshark(self):
-        # ssh command to stream a pacapng file over ssh from the rasp pi to the 
-        # local machine and then use tshark to dissect the packets
-        cmd =  ["ssh", "-X", "ubuntu@pi_sniffer", 
-                "rm -f /home/ubuntu/nRF52/rb/rb.pcapng; touch /home/ubuntu/nRF52/rb/rb.pcapng; wireshark", 
-                "-i /dev/ttyACM0", "-k", "-w /home/ubuntu/nRF52/rb/rb.pcapng"]
-
-        # open the process and save the process object as a class member variable
-        process = subprocess.Popen(cmd, 
-                           stdout=subprocess.PIPE,
-                           universal_newlines=True)
-        self.wiresharkProcess = process
-
-        # monitor the process and wait for exit
-        while True:
-            # wait for process to exit
-            return_code = process.poll()
-            if return_code is not None:
-                print('RETURN CODE', return_code)
-                break
+    async def runWireshark(self, endpoint):
+        if self.detachCapture:
+            await self.startDetachedCapture(endpoint)
+            return
+
+        cmd = endpoint.getSession().getCmd(endpoint.getCaptureCmd(), x11=True)
+
+        # start the process and save the process object in the endpoint, its
+        # output is not used
+        endpoint.process = await asyncio.create_subprocess_exec(*cmd, 
+                                                                stdout=subprocess.DEVNULL)
+
+    # Start the capture on the host detached from the ssh session and save 
+    # its pid in the endpoint.  endpoint.process is then the ssh session 
+    # watching it, or the one that failed to start it.
+    async def startDetachedCapture(self, endpoint):
+        endpoint.capturePid = None
+        cmd = endpoint.getSession().getCmd(endpoint.getDetachedCaptureCmd())
+        endpoint.process = await asyncio.create_subprocess_exec(*cmd,
+                                                                stdout=subprocess.PIPE)
+        output, _ = await endpoint.process.communicate()
+        output = output.decode('utf-8', 'replace').strip()
+        if endpoint.process.returncode != 0 or not output.isdigit():
+            print("Couldn't start the capture of " + endpoint.name + " on the host!")
+            return
+
+        endpoint.capturePid = int(output)
+        print("Capture of " + endpoint.name + " running on the host as pid " + output)
+        await self.watchDetachedCapture(endpoint)
+
+    # watch the detached capture of the sniffer from a new ssh session
+    async def watchDetachedCapture(self, endpoint):
+        cmd = endpoint.getSession().getCmd(endpoint.getWatchCmd())
+        endpoint.process = await asyncio.create_subprocess_exec(*cmd,
+                                                                stdout=subprocess.DEVNULL)
+
+    # Wait for the capture of the sniffer to end.  If the session watching
+    # a detached capture drops while the capture is still running it is 
+    # watched again, every second until the host answers.
+    async def waitForExit(self, endpoint):
+        await endpoint.process.wait()
+        while endpoint.capturePid is not None and endpoint.process.returncode != 0:
+            print(datetime.now().strftime('%H:%M:%S') + " Lost the session watching the capture of " + endpoint.name 
+                  + ", reconnecting")
+            await asyncio.sleep(1)
+            await self.watchDetachedCapture(endpoint)
+            await endpoint.process.wait()
+
+    # Stop the detached capture of the sniffer.  If the host can't be 
+    # reached the capture is left running and no longer watched.
+    async def stopDetachedCapture(self, endpoint):
+        returnCode, output = await self.runPiSnifferCmd(endpoint.getStopCmd(), verbose=False,
+                                                        session=endpoint.getSession())
+        if returnCode != 0:
+            print("Couldn't stop the capture of " + endpoint.name + " (pid " + str(endpoint.capturePid) + 
+                  ") on the host, leaving it running")
+            endpoint.capturePid = None
+            self.terminateProcess(endpoint.process)
     
     # Spawn system processes to grab wireshark data from the remote sniffer host.
     # SSH is used to run the tail command to stream bytes from the capture file.
     # The output of this process is redirected to a pipe and then written to the 
     # input of a local instance of tshark running with stdin as its input vector.
     # The tshark process stdout is redirected to the file btle_sniffer.out.
+    # Unless useTshark is set, the stream of each sniffer is decoded in 
+    # process by BtlePcapngDecoder and the records are queued for the UI 
+    # instead.
     def runTshark(self):
 
-        cmd1 =  ["ssh", "ubuntu@pi_sniffer", "tail", "-c +1", 
-                 "-f /home/ubuntu/nRF52/rb/rb.pcapng"]
+        if not self.useTshark:
+            self.runDecoder([self.getStreamCmd(endpoint) for endpoint in self.endpoints])
+            return
+
+        endpoint = self.endpoints[0]
+        cmd1 = self.getStreamCmd(endpoint)
 
         cmd2 = ["tshark", "-r", "-", "-T", "fields", "-E", "separator=,", 
                 "-e", "_ws.col.Time", "-e", "nordic_ble.channel", 
@@ -607,13 +1657,10 @@ class BtleSniffer:
                 "-e", "nordic_ble.rssi", "-e", "nordic_ble.crcok", "-t", "ad"]
                 
 
-        # open the process and save the process object as a class member variable
-        proc1 = subprocess.Popen(cmd1, 
-                           stdout=subprocess.PIPE,
-                           universal_newlines=False)
-        self.tsharkProcess[0] = proc1
-
-
+        # a new output file, none of its lines have been counted yet
+        with self.indexLock:
+            self.linesRead = 0
+            self.linesCounted = 0
         f = open("btle_sniffer.out", "w")
         proc2 = subprocess.Popen(cmd2, 
                            stdin=subprocess.PIPE,
@@ -621,38 +1668,225 @@ class BtleSniffer:
                            universal_newlines=False)
         self.tsharkProcess[1] = proc2
 
-        # monitor the process and wait for exit
-        ret1 = None
-        ret2 = None
-        outFilename = 'buf.pcapng'
-        with open(outFilename, "wb") as outFile:
+        # copy the pcapng stream to tshark and to a local copy (buf.pcapng or
+        # the archive) until the ssh process exits, then let tshark finish 
+        # and wait for both to exit
+        offset = 0
+        delay = 1
+        self.startArchive(endpoint)
+        with self.openLocalCopy(endpoint) as outFile:
+            self.tee = BtleTee(None, [proc2.stdin.fileno()] + self.getCopySinks(endpoint, outFile))
+            endpoint.tee = self.tee
             while True:
-                if ret1 is None:
-                    binPcap = proc1.stdout.read(256)
-                    ret1 = proc1.poll()
-                    outFile.write(binPcap)
-                else:
-                    binPcap = None
+                # open the process and save the process object as a class member variable
+                proc1 = subprocess.Popen(cmd1, 
+                                   stdout=subprocess.PIPE,
+                                   universal_newlines=False)
+                self.tsharkProcess[0] = proc1
+                if self.streamStop.is_set():
+                    proc1.terminate()
+
+                bytesIn = self.tee.bytesIn
+                self.tee.setSource(proc1.stdout.fileno())
+                self.tee.run()
+                ret1 = proc1.wait()
+                proc1.stdout.close()
+                if not self.canResume():
+                    break
 
-                if ret2 is None:
-                    if binPcap is not None:
-                        proc2.stdin.write(binPcap)
-                    ret2 = proc2.poll()
-                
-                # wait for proc1  and proc2 to exit
-                if (ret1 is not None) and (ret2 is not None):
-                    print('RETURN CODE ', ret1, ', ', ret2)
+                # tshark can't be told to drop the part of a block it already
+                # has, so it is restarted on the capture header and the rest
+                # of the stream, appending to btle_sniffer.out
+                if endpoint.archive is None:
+                    offset = findBlockEnd(endpoint.bufName, offset)
+                    os.ftruncate(outFile.fileno(), offset)
+                    os.lseek(outFile.fileno(), offset, os.SEEK_SET)
+                else:
+                    self.discardArchivePartial(endpoint)
+                    offset = endpoint.archive.getEnd()
+                delay = 1 if self.tee.bytesIn > bytesIn else min(delay * 2, 30)
+                if not self.waitToResume(endpoint, offset, delay):
                     break
+
+                try:
+                    proc2.stdin.close()
+                except BrokenPipeError:
+                    pass
+                proc2.wait()
+                proc2 = subprocess.Popen(cmd2, 
+                                   stdin=subprocess.PIPE,
+                                   stdout=f,
+                                   universal_newlines=False)
+                self.tsharkProcess[1] = proc2
+                header, chunks = endpoint.readCapture(offset, offset)
+                proc2.stdin.write(header)
+                proc2.stdin.flush()
+                self.tee.setSink(0, proc2.stdin.fileno())
+                cmd1 = self.getStreamCmd(endpoint, offset)
+        self.stopArchive(endpoint)
+
+        try:
+            proc2.stdin.close()
+        except BrokenPipeError:
+            pass
+        ret2 = proc2.wait()
+        f.close()
+        print('RETURN CODE ', ret1, ', ', ret2)
+
+    # return the command that streams the capture file of the sniffer from
+    # byte offset on
+    def getStreamCmd(self, endpoint, offset=0):
+        return endpoint.getSession().getCmd("tail -c +" + str(offset + 1) + " -f " + endpoint.captureFile, keepAlive=True)
+
+    # Start the compressed copy of the stream of the sniffer, if wanted.  It
+    # is compressed on its own stage with a deep queue, so a slow compressor
+    # doesn't hold up the tee and the decoder.
+    def startArchive(self, endpoint):
+        if self.archiveCodec is None:
+            return
+        endpoint.archive = BtlePcapngArchive(endpoint.bufName + ARCHIVE_CODECS[self.archiveCodec], self.archiveCodec,
+                                             self.archiveLevel, self.archiveThreads)
+        name = 'archive' if self.merger is None else 'archive ' + endpoint.name
+        endpoint.archiveStage = BtleStage(name, endpoint.archive.write, maxDepth=1024)
+
+    # Open buf.pcapng for the local copy of the stream of the sniffer, or 
+    # nothing (the file is None) if the archive is the copy
+    def openLocalCopy(self, endpoint):
+        if endpoint.archive is None:
+            return open(endpoint.bufName, "wb")
+        return contextlib.nullcontext()
+
+    # return the tee sinks for the local copy of the stream, buf.pcapng 
+    # (outFile) or the archive
+    def getCopySinks(self, endpoint, outFile):
+        if endpoint.archive is None:
+            return [outFile.fileno()]
+        return [endpoint.archiveStage]
+
+    # drop the part of a block the compressed copy has when the stream is 
+    # resumed
+    def discardArchivePartial(self, endpoint):
+        if endpoint.archive is not None:
+            endpoint.archiveStage.drain()
+            endpoint.archive.discardPartial()
+
+    # compress the rest of the stream and close the compressed copy
+    def stopArchive(self, endpoint):
+        if endpoint.archive is not None:
+            endpoint.archiveStage.close()
+            endpoint.archive.close()
+
+    # a dropped stream is resumed unless the capture is over
+    def canResume(self):
+        return self.resumeStream and self.runFlag and not self.streamStop.is_set()
+
+    # Count a reconnect of the stream of the sniffer at offset and wait delay
+    # seconds first.  Returns False if the capture is over by then.
+    def waitToResume(self, endpoint, offset, delay):
+        endpoint.reconnects = endpoint.reconnects + 1
+        endpoint.checkpoint = offset
+        print(datetime.now().strftime('%H:%M:%S') + " Stream of " + endpoint.name + " dropped, resuming at byte " 
+              + str(offset) + " in " + str(delay) + " s")
+        return not self.streamStop.wait(delay)
     
+    # Stream the pcapng capture of each sniffer (cmds has the stream command
+    # of each) to its local copy and through the decode stages, the merge 
+    # stage if there are several, and the aggregate stage into the index, 
+    # which animatePlot takes snapshots of.
+    def runDecoder(self, cmds):
+        if self.liveWrite:
+            fname = "btle_sniffer_" + datetime.now().strftime("%m-%d-%Y-%H%M%S.csv")
+            colWriter = self.getColumnarWriter(fname)
+            self.csvWriter = BtleCsvWriter(fname, str(self.metaData.txPower), colWriter=colWriter)
+
+        self.aggregateStage = BtleStage('aggregate', self.aggregateRecords)
+        if self.merger is not None:
+            self.mergeStage = BtleStage('merge', self.mergeRecords)
+        for endpoint in self.endpoints:
+            self.startArchive(endpoint)
+            endpoint.decoder = BtlePcapngDecoder()
+            name = 'decode' if self.merger is None else 'decode ' + endpoint.name
+            endpoint.decodeStage = BtleStage(name, lambda data, endpoint=endpoint: self.decodeBytes(data, endpoint))
+        self.decoder = self.endpoints[0].decoder
+        self.decodeStage = self.endpoints[0].decodeStage
+
+        # the first stream is pumped on this thread, the rest on their own
+        threads = list()
+        for endpoint, cmd in list(zip(self.endpoints, cmds))[1:]:
+            thread = threading.Thread(target=self.streamEndpoint, args=(endpoint, cmd), name='stream ' + endpoint.name)
+            thread.start()
+            threads.append(thread)
+        self.streamEndpoint(self.endpoints[0], cmds[0])
+        for thread in threads:
+            thread.join()
+
+        # let the stages finish the data already queued
+        for endpoint in self.endpoints:
+            endpoint.decodeStage.close()
+        if self.mergeStage is not None:
+            self.mergeStage.close()
+            records = self.merger.flush()
+            if records:
+                self.forwardRecords(self.merger.released, records)
+        self.aggregateStage.close()
+        for endpoint in self.endpoints:
+            self.stopArchive(endpoint)
+        self.reportPipeline()
+
+        with self.decodeCond:
+            self.captureDone = True
+            self.decodeCond.notify_all()
+
+    # Copy the stream of one sniffer to its local copy and its decode stage
+    # until the stream process exits.  If it exits while still capturing, 
+    # the stream is resumed after the last block the decoder completed, 
+    # dropping the part of a block after it from the decoder and the copy.
+    def streamEndpoint(self, endpoint, cmd):
+        delay = 1
+        with self.openLocalCopy(endpoint) as outFile:
+            endpoint.tee = BtleTee(None, self.getCopySinks(endpoint, outFile) + [endpoint.decodeStage])
+            if endpoint.idx == 0:
+                self.tee = endpoint.tee
+
+            while True:
+                proc = subprocess.Popen(cmd, 
+                                   stdout=subprocess.PIPE,
+                                   universal_newlines=False)
+                endpoint.streamProcess = proc
+                if self.streamStop.is_set():
+                    proc.terminate()
+
+                bytesIn = endpoint.tee.bytesIn
+                endpoint.tee.setSource(proc.stdout.fileno())
+                endpoint.tee.run()
+                print('RETURN CODE ', proc.wait())
+                proc.stdout.close()
+                if not self.canResume():
+                    break
+
+                endpoint.decodeStage.drain()
+                offset = endpoint.decoder.offset
+                endpoint.decoder.discardPartial()
+                if endpoint.archive is None:
+                    os.ftruncate(outFile.fileno(), offset)
+                    os.lseek(outFile.fileno(), offset, os.SEEK_SET)
+                else:
+                    self.discardArchivePartial(endpoint)
+                delay = 1 if endpoint.tee.bytesIn > bytesIn else min(delay * 2, 30)
+                if not self.waitToResume(endpoint, offset, delay):
+                    break
+                cmd = self.getStreamCmd(endpoint, offset)
+
     def getMetadata(self):
         # flag indicating when all metadata has been entered 
         metaDataDone = False
 
-        if self.autoMode == True:
+        if self.autoMode == True or self.headless:
             metaDataDone = True
 
         # widgets on window layout
         while not metaDataDone:
+            loadGui()
             layout = [[sg.Text('Test Env'), sg.Input(key='-TestEnv-', default_text=self.metaData.testEnv)],
                       [sg.Text('Device  '), sg.Input(key='-Device-', default_text=self.metaData.device)],
                       [sg.Text('Range   '), sg.Input(key='-Range-', default_text=self.metaData.range)],
@@ -713,93 +1947,227 @@ class BtleSniffer:
                     metaDataDone = True
                     done = True
 
+    # yield the packets of the capture one at a time without the duplicates,
+    # decoded from the pcapng file or read from the tshark output file
+    def getCapturedPackets(self):
+        if self.dedup is None:
+            yield from self.iterCapturedPackets()
+            return
+
+        dedup = BtleDedup(self.dedup.window, self.dedup.tolerance)
+        for data in self.iterCapturedPackets():
+            t = self.timeParser.parse(data[BTLE_TIME]) if self.useTshark else data[BTLE_EPOCH]
+            if not dedup.isDuplicate(t, data[BTLE_ADV_ADDR], data[BTLE_CH], data[BTLE_RSSI]):
+                yield data
+
+    def iterCapturedPackets(self):
+        if not self.useTshark and self.merger is not None:
+            yield from mergeRecords([endpoint.iterCapture() for endpoint in self.endpoints])
+            return
+        if not self.useTshark:
+            yield from self.endpoints[0].iterCapture()
+            return
+
+        with open("btle_sniffer.out", "r") as inFile:
+            # skip first and last lines, they are both garbage.  The file is 
+            # read one line ahead so the last line is known without loading
+            # the whole file.
+            inFile.readline()
+            line = inFile.readline()
+            for nextLine in inFile:
+                # split line into fields
+                data = line.rstrip('\n').split(',')
+                line = nextLine
+
+                if len(data) < 6:
+                    print("generateDataFile: unexpected line length, skipping!")
+                    continue
+
+                yield data
+
     # This routine is called when the wireshark capture is terminated.  It 
     # finalizes the data collection by generating a data file in the 
     # recommended format using Metadata that the user is prompted for.  An
     # image file containing the currently displayed plot is also generated.
+    # If the data file was written during the capture only the metadata is 
+    # added to it.
     # 
     def generateDataFile(self):
+        # the segments read the copy of the stream, let them finish before
+        # it is moved
+        self.waitSegments()
+
         # grab the metadata for this capture
         self.getMetadata()
+        metadataLines = self.metaData.getOutput()
 
-        with open("btle_sniffer_" + datetime.now().strftime("%m-%d-%Y-%H%M%S.csv"), "w") as outFile, open("btle_sniffer.out", "r") as inFile:
-
-            for metadataLine in self.metaData.getOutput():
+        if self.csvWriter is not None:
+            fname = self.csvWriter.fname
+            if not self.csvWriter.finish(metadataLines, str(self.metaData.txPower)):
+                print("Rewriting " + fname + " with the updated metadata")
+                self.writeDataFile(fname, metadataLines)
+        else:
+            fname = "btle_sniffer_" + datetime.now().strftime("%m-%d-%Y-%H%M%S.csv")
+            self.writeDataFile(fname, metadataLines)
+
+        # create files containing statistics for the selected address and 
+        # for every address seen
+        self.dumpStats(str('stats_' + os.path.basename(fname)).replace('csv', 'txt'))
+        self.dumpStats(str('stats_all_' + os.path.basename(fname)).replace('csv', 'txt'), allAddrs=True)
+
+        # copy the pcapng file, or the file of each sniffer.  If the stream 
+        # was compressed the compressed copy and its index are kept instead.
+        for endpoint in self.endpoints:
+            outName = os.path.basename(fname).replace('.csv', '.pcapng')
+            if self.merger is not None:
+                outName = outName.replace('.pcapng', '_' + endpoint.name + '.pcapng')
+            if endpoint.archive is None:
+                os.rename(endpoint.bufName, outName)
+            else:
+                outName = outName + ARCHIVE_CODECS[self.archiveCodec]
+                os.rename(endpoint.archive.fname, outName)
+                os.rename(endpoint.archive.fname + '.idx', outName + '.idx')
+
+        self.dataFileDone = True
+
+    # return the columnar writer for the data file fname, or None if the
+    # columnar file is not wanted.  btle_columnar (and numpy) is only 
+    # imported when it is used.
+    def getColumnarWriter(self, fname, metadataLines=[]):
+        if not self.writeColumnar:
+            return None
+        from btle_columnar import BtleColumnarWriter
+        return BtleColumnarWriter(fname.replace('csv', 'btlc'), metadataLines)
+
+    # convert the whole capture, or the given packets, to a data file in the
+    # MIT-LL format.  Returns the number of packets written.
+    def writeDataFile(self, fname, metadataLines, packets=None, txPower=None, batchSize=4096):
+        with open(fname, "w") as outFile:
+            for metadataLine in metadataLines:
                 outFile.write(metadataLine)
 
-            # read all lines from the input file
-            inLines = inFile.readlines()
+            colWriter = self.getColumnarWriter(outFile.name, metadataLines)
 
-            # iterate for all lines read to create a new output format
-            lineNum = -1 
-            for line in inLines:
-                lineNum = lineNum+1
-                # skip first and last lines, they are both garbage
-                if lineNum == 0:
-                    continue
-                elif lineNum == len(inLines)-1:
-                    continue
-                
-                # split line into fields
-                data = line.rstrip('\n').split(',')
+            if txPower is None:
+                txPower = str(self.metaData.txPower)
+            if packets is None:
+                packets = self.getCapturedPackets()
 
-                if len(data) < 6:
-                    print("generateDataFile: unexpected line length, skipping!")
-                    continue
-                
+            # iterate for all packets captured to create a new output format,
+            # the rows are written in batches
+            rows = list()
+            numRows = 0
+            for data in packets:
                 # make sure the CRC is ok, if not then throw this packet away
                 crcOk = int(data[BTLE_CRCOK])
                 if not crcOk:
                     continue
 
-                # create numeric time value from timestamp
-                s = data[BTLE_TIME]
-                d = datetime.strptime(s, "%Y-%m-%d %H:%M:%S.%f")
-                t = time.mktime(d.timetuple()) + d.microsecond/1.0e6
+                # create numeric time value from timestamp, the parser cache
+                # is already warm from the live session
+                if self.useTshark:
+                    t = self.timeParser.parse(data[BTLE_TIME])
+                else:
+                    t = data[BTLE_EPOCH]
 
                 # create output in format required by MIT-LL
-                newLine = data[BTLE_TIME] + ',' +  \
-                          'Bluetooth' + ',' +  \
-                          str(data[BTLE_ADV_ADDR]) + ',' + \
-                          str(data[BTLE_RSSI]) + ',' + \
-                          str(self.metaData.txPower) + ',' + \
-                          str(t) + ',' + \
-                          str(data[BTLE_CH]) + '\n'
+                rows.append(makeDataRow(data, t, txPower))
+                numRows = numRows + 1
+                if colWriter is not None:
+                    colWriter.append(t, data[BTLE_CH], data[BTLE_RSSI], data[BTLE_ADV_ADDR])
 
                 # write the output
-                outFile.write(newLine)
-
-            # create a file containing statistics
-            self.dumpStats(str('stats_' + os.path.basename(outFile.name)).replace('csv', 'txt'))
-
-            # copy the pcapng file
-            os.rename('buf.pcapng', os.path.basename(outFile.name).replace('csv', 'pcapng'))
-
-    # dump calculated RSSI stats to a file
-    def dumpStats(self, fname):
+                if len(rows) >= batchSize:
+                    rows.append('')
+                    outFile.write('\n'.join(rows))
+                    rows = list()
+
+            if rows:
+                rows.append('')
+                outFile.write('\n'.join(rows))
+
+            if colWriter is not None:
+                colWriter.close()
+
+        return numRows
+
+    # write the stats for each channel to the file
+    def writeStats(self, statsFile, stats):
+        for i in range(3):
+            if i == 0:
+                statsFile.write('Ch 37 Stats:\n')
+            elif i == 1:
+                statsFile.write('Ch 38 Stats:\n')
+            elif i == 2:
+                statsFile.write('Ch 39 Stats:\n')
+                 
+            statsFile.write("min    = " + str(stats[i][0]) + '\n') 
+            statsFile.write("max    = " + str(stats[i][1]) + '\n') 
+            statsFile.write("mean   = " + str(stats[i][2]) + '\n') 
+            statsFile.write("median = " + str(stats[i][3]) + '\n') 
+            statsFile.write("mode   = " + str(stats[i][4]) + '\n') 
+            statsFile.write("std    = " + str(stats[i][5]) + '\n') 
+            statsFile.write("range  = " + str(stats[i][6]) + '\n\n') 
+
+    # return the stats of each channel of the entry, zeros if there is not
+    # enough data
+    def getEntryStats(self, entry):
+        stats = list()
+        for chStats in entry.stats:
+            chStats = chStats.getStats()
+            stats.append(chStats if chStats is not None else (0,0,0,0,0,0,0))
+        return stats
+
+    # dump calculated RSSI stats to a file.  If allAddrs is set the stats for
+    # every advertising address are written, otherwise only the selected one.
+    # The stats come from the live index unless another one is given.
+    def dumpStats(self, fname, allAddrs=False, index=None):
         with open(fname,"w") as statsFile:
-            for i in range(3):
-                if i == 0:
-                    statsFile.write('Ch 37 Stats:\n')
-                elif i == 1:
-                    statsFile.write('Ch 38 Stats:\n')
-                elif i == 2:
-                    statsFile.write('Ch 39 Stats:\n')
-                     
-                statsFile.write("min    = " + str(self._min[i]) + '\n') 
-                statsFile.write("max    = " + str(self._max[i]) + '\n') 
-                statsFile.write("mean   = " + str(self._mean[i]) + '\n') 
-                statsFile.write("median = " + str(self._median[i]) + '\n') 
-                statsFile.write("mode   = " + str(self._mode[i]) + '\n') 
-                statsFile.write("std    = " + str(self._std[i]) + '\n') 
-                statsFile.write("range  = " + str(self._range[i]) + '\n\n') 
+            if not allAddrs:
+                if index is None:
+                    self.calcStats()
+                    self.writeStats(statsFile, list(zip(self._min, self._max, self._mean, self._median,
+                                                        self._mode, self._std, self._range)))
+                else:
+                    entry = index.get(self.filter)
+                    self.writeStats(statsFile, self.getEntryStats(entry if entry is not None else BtleAddrEntry()))
+                return
+
+            if index is None:
+                index = self.statsIndex
+            for entry in [index.allEntry] + index.getSorted():
+                statsFile.write('Addr ' + entry.addr + ', ' + str(entry.count) + ' packets\n')
+                self.writeStats(statsFile, self.getEntryStats(entry))
 
 # print usage info
 def usage():
     print("\nDescription: this program uses the nRF52-DK with installed Bluetooth LE Sniffer firmware to capture and visualize live RSSI data.\n")
     print("\nUsage:\n")
-    print(" ",__file__, " [-h] [-f filter_addr]\n")
+    print(" ",__file__, " [-h] [-H] [-b] [-t] [-l] [-c] [-m] [-M metrics_file] [-P profile_file] [-F fake_bin_dir] [-s sniffer ...] [-k skew_sec] [-d tolerance_ms] [-D window_sec] [-r] [-K] [-z codec[:level[:threads]]] [-T duration_sec] [-w window_sec] [-f filter_addr]\n")
     print("     -h: help\n")
+    print("     -H: headless, capture and write the data file without the plot and UI, printing the stats periodically.")
+    print("         ctrl-c stops the capture and writes the data file")
+    print("     -T duration_sec: stop a headless capture after duration_sec seconds")
+    print("     -b: redraw the whole plot on each update instead of blitting")
+    print("     -t: decode the capture with a local tshark process instead of the built in decoder")
+    print("     -F fake_bin_dir: run the sniffer host commands locally, using the commands in fake_bin_dir (for testing)")
+    print("     -s sniffer: capture from this sniffer, [host][:device[:channel]], e.g. ubuntu@pi_sniffer:/dev/ttyACM1:38.")
+    print("         Repeat to capture from several sniffers at once.  The host gen makes a fake sniffer (btle_gen.py).")
+    print("     -k skew_sec: how long to wait for a sniffer that falls behind the others (default 2)")
+    print("     -d tolerance_ms: drop packets with the same address, channel and RSSI up to tolerance_ms apart as duplicates")
+    print("         (default 0, only the exact same time)")
+    print("     -D window_sec: how long duplicate packets are looked for (default 10, 0 turns off duplicate removal)")
+    print("     -r: don't resume a stream that drops while capturing, end the capture instead")
+    print("     -K: keep capturing on the sniffer host if the ssh session drops (wireshark runs detached on a virtual")
+    print("         display, xvfb-run, so there is no wireshark window)")
+    print("     -z codec[:level[:threads]]: compress the capture as it arrives with gzip or zstd and keep the compressed")
+    print("         file instead of the .pcapng.  zstd needs the zstandard module and compresses with threads threads")
+    print("     -l: write the data file while capturing (built in decoder only)")
+    print("     -c: also write the capture in the memory mappable columnar format (.btlc)")
+    print("     -m: show the pipeline metrics below the stats")
+    print("     -M metrics_file: append the pipeline metrics to metrics_file as a JSON line every 10 s")
+    print("     -P profile_file: run the sampling profiler over the session and write the stacks to profile_file")
+    print("     -w window_sec: only show the last window_sec seconds in the live plot (default 0, full capture)")
     print("     -f filter_addr: display only bluetooth data with specified advertising address.")
     print("     The filter address can be adjusted live by enter 'filter' into the command prompt")
     print("\n")
@@ -807,10 +2175,30 @@ def usage():
 # main function for command line entry point
 def main(argv):
     _filter = ""
+    blitPlot = True
+    windowLen = 0
+    useTshark = False
+    writeColumnar = False
+    liveWrite = False
+    sshSession = None
+    headless = False
+    showMetrics = False
+    metricsFile = None
+    profileFile = None
+    endpointArgs = list()
+    skew = 2.0
+    dedupTolerance = 0
+    dedupWindow = 10
+    resumeStream = True
+    archiveCodec = None
+    archiveLevel = None
+    archiveThreads = 0
+    detachCapture = False
+    captureDuration = 0
 
     # grab command line args
     try:
-        opts, args = getopt.getopt(argv,"hf:i:",["filter=,iter="])
+        opts, args = getopt.getopt(argv,"hHbtclmrKf:i:w:F:M:P:s:k:d:D:z:T:",["filter=,iter="])
     except getopt.GetoptError:
         usage()
         return
@@ -822,10 +2210,60 @@ def main(argv):
             return
         elif opt in ("-f", "--filter"):
             _filter = arg
+        elif opt == "-b":
+            blitPlot = False
+        elif opt == "-w":
+            windowLen = float(arg)
+        elif opt == "-t":
+            useTshark = True
+        elif opt == "-c":
+            writeColumnar = True
+        elif opt == "-l":
+            liveWrite = True
+        elif opt == "-F":
+            sshSession = btle_ssh.BtleLocalSession(arg)
+        elif opt == "-H":
+            headless = True
+        elif opt == "-m":
+            showMetrics = True
+        elif opt == "-M":
+            metricsFile = arg
+        elif opt == "-P":
+            profileFile = arg
+        elif opt == "-s":
+            endpointArgs.append(arg)
+        elif opt == "-k":
+            skew = float(arg)
+        elif opt == "-d":
+            dedupTolerance = float(arg) / 1000
+        elif opt == "-D":
+            dedupWindow = float(arg)
+        elif opt == "-r":
+            resumeStream = False
+        elif opt == "-K":
+            detachCapture = True
+        elif opt == "-T":
+            captureDuration = float(arg)
+        elif opt == "-z":
+            parts = arg.split(':')
+            archiveCodec = parts[0]
+            if archiveCodec not in ARCHIVE_CODECS:
+                usage()
+                return
+            if len(parts) > 1 and parts[1] != "":
+                archiveLevel = int(parts[1])
+            if len(parts) > 2:
+                archiveThreads = int(parts[2])
         #elif opt == "-v":
         #    verbose = True
 
-    sniffer = BtleSniffer(_filter=_filter)
+    endpoints = [parseEndpoint(arg, sshSession, idx) for idx, arg in enumerate(endpointArgs)]
+    sniffer = BtleSniffer(_filter=_filter, blitPlot=blitPlot, windowLen=windowLen, useTshark=useTshark, writeColumnar=writeColumnar, liveWrite=liveWrite, sshSession=sshSession, headless=headless, 
+                          metricsFile=metricsFile, showMetrics=showMetrics, profileFile=profileFile,
+                          endpoints=endpoints, skew=skew, dedupWindow=dedupWindow, dedupTolerance=dedupTolerance,
+                          resumeStream=resumeStream, archiveCodec=archiveCodec, archiveLevel=archiveLevel,
+                          archiveThreads=archiveThreads, detachCapture=detachCapture,
+                          captureDuration=captureDuration)
     sniffer.run()
     sniffer.wait()
 
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import time
+import getopt
+import subprocess
+
+# sniffer host
+PI_HOST = "ubuntu@pi_sniffer"
+
+# Init commands for the sniffer host, each with a check that succeeds only if
+# the command still needs to be run.  Bluetooth and WiFi are turned off to
+# allow for clean data collections.
+PI_INIT_CMDS = [("systemctl is-active --quiet bluetooth", "sudo systemctl stop bluetooth"),
+                ("ip -o link show wlan0 | grep -q '[<,]UP[,>]'", "sudo ifconfig wlan0 down")]
+
+# Reusable ssh connection to the sniffer host.  Every command is run with the
+# OpenSSH ControlMaster options, so the first one starts a master connection
+# in the background and the rest are multiplexed over it without a new
+# handshake.  The master is kept for persist seconds after the last command,
+# so it is shared by every BtleSniffer created in that time (and by other
+# processes using the same host).
+#
+# A command run with keepAlive (the capture stream) gets a connection of its
+# own instead, which sends a keepalive every aliveInterval seconds and drops
+# after aliveCount of them go unanswered.  The stream then exits soon after
+# the network to the host goes down, so it can be resumed, while the 
+# multiplexed sessions (wireshark) ride out a short outage.
+class BtleSshSession:
+    def __init__(self, host=PI_HOST, persist=600, controlPath="~/.ssh/btle_sniffer-%C", aliveInterval=5, aliveCount=3):
+        self.host = host
+        self.persist = persist
+        self.controlPath = controlPath
+        self.aliveInterval = aliveInterval
+        self.aliveCount = aliveCount
+
+    def getOptions(self):
+        return ["-o", "ControlMaster=auto", "-o", "ControlPath=" + self.controlPath,
+                "-o", "ControlPersist=" + str(self.persist)]
+
+    def getKeepAliveOptions(self):
+        return ["-o", "ControlPath=none", "-o", "ServerAliveInterval=" + str(self.aliveInterval),
+                "-o", "ServerAliveCountMax=" + str(self.aliveCount)]
+
+    # return the command line that runs cmdStr on the host, with X11
+    # forwarding if x11 is set and on its own connection with keepalives if
+    # keepAlive is set
+    def getCmd(self, cmdStr, x11=False, keepAlive=False):
+        cmd = ["ssh"] + (self.getKeepAliveOptions() if keepAlive else self.getOptions())
+        if x11:
+            cmd.append("-X")
+        return cmd + [self.host, cmdStr]
+
+    # return True if the master connection is running
+    def isConnected(self):
+        cmd = ["ssh"] + self.getOptions() + ["-O", "check", self.host]
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+    # close the master connection
+    def stop(self):
+        cmd = ["ssh"] + self.getOptions() + ["-O", "exit", self.host]
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+# Stand-in for the ssh session that runs the commands on the local machine
+# with bash.  Commands found in binDir (e.g. fake wireshark, sudo and
+# systemctl scripts) are used in place of the real ones, so the capture can
+# be tested without the Pi.  bash runs a single command with exec, so
+# terminating the process terminates the command.
+class BtleLocalSession:
+    def __init__(self, binDir=""):
+        self.binDir = binDir
+
+    def getCmd(self, cmdStr, x11=False, keepAlive=False):
+        cmd = ["bash", "-c", cmdStr]
+        if self.binDir != "":
+            cmd = ["env", "PATH=" + os.path.abspath(self.binDir) + os.pathsep + os.environ.get("PATH", "")] + cmd
+        return cmd
+
+    def isConnected(self):
+        return True
+
+    def stop(self):
+        pass
+
+# Stand-in for the ssh session that doesn't run anything, every command is
+# replaced by true.  Used by the benchmarks, which only need the processing
+# side of BtleSniffer.
+class BtleNullSession(BtleLocalSession):
+    def getCmd(self, cmdStr, x11=False, keepAlive=False):
+        return ["true"]
+
+# return the single remote shell command that runs each init command whose
+# check says it is still needed
+def getInitCmd(initCmds=PI_INIT_CMDS):
+    parts = list()
+    for check, cmd in initCmds:
+        parts.append("if " + check + "; then " + cmd + "; else echo 'already done: " + cmd + "'; fi")
+    return "; ".join(parts)
+
+# session shared by all BtleSniffer instances in this process
+sharedSession = None
+
+def getSession():
+    global sharedSession
+    if sharedSession is None:
+        sharedSession = BtleSshSession()
+    return sharedSession
+
+def setSession(session):
+    global sharedSession
+    sharedSession = session
+
+# print usage info
+def usage():
+    print("\nDescription: run commands on the sniffer host over the shared ssh connection.\n")
+    print("\nUsage:\n")
+    print(" ",__file__, " [-h] [-n num] [-x] [command]\n")
+    print("     -h: help\n")
+    print("     -n num: run the command num times and print the time taken by each")
+    print("     -x: close the shared connection")
+    print("     command: command to run (default runs the init commands)")
+    print("\n")
+
+# main function for command line entry point
+def main(argv):
+    num = 1
+
+    # grab command line args
+    try:
+        opts, args = getopt.getopt(argv,"hn:x",["num=","exit"])
+    except getopt.GetoptError:
+        usage()
+        return 1
+
+    session = getSession()
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            return 0
+        elif opt in ("-n", "--num"):
+            num = int(arg)
+        elif opt in ("-x", "--exit"):
+            session.stop()
+            return 0
+
+    cmdStr = " ".join(args) if args else getInitCmd()
+    ret = 0
+    for i in range(num):
+        start = time.perf_counter()
+        ret = subprocess.run(session.getCmd(cmdStr)).returncode
+        print("RETURN CODE " + str(ret) + " in {:3.3f} s".format(time.perf_counter() - start))
+
+    return ret
+
+# callable from command line
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))